@@ -1,9 +1,12 @@
-from flask import Flask, render_template, jsonify, request
-import requests
+from flask import Flask, Response, render_template, jsonify, request
 import sqlite3
 import threading
 import time
-from scanner import scan_network
+from scanner import Discovery, AnnouncementListener
+import node_client
+import collector
+import proxy_cache
+import health
 import logging
 
 import sys
@@ -51,6 +54,14 @@ except Exception:
 logging.info(f"Starting VoltWise. Data Directory: {DATA_DIR}")
 
 app = Flask(__name__)
+data_collector = collector.Collector(DB_PATH)
+health_monitor = health.HealthMonitor(DB_PATH)
+
+# Proxied responses are reused for this long (seconds); nodes sample once
+# a second, so viewers see data at most half a sample old
+PROXY_TTL = 0.5
+PROXY_STREAM_TIMEOUT = 60
+proxy_responses = proxy_cache.ProxyCache(PROXY_TTL)
 
 def resource_path(relative_path):
     """ Get absolute path to resource, works for dev and for PyInstaller """
@@ -68,12 +79,32 @@ if getattr(sys, 'frozen', False):
     app.static_folder = resource_path('static')
 
 
+# Seconds between fixing the "start all" moment and every node beginning
+# to record; long enough for one request to reach every node first
+START_LEAD = 2.0
+
+NODE_COLUMNS = (
+    ('clock_offset', 'REAL'),     # node clock minus dashboard clock, seconds
+    ('rtt_ms', 'REAL'),           # round trip of the offset measurement
+    ('clock_checked', 'REAL'),    # when the offset was measured
+) + health.HEALTH_COLUMNS
+
 def init_db():
     conn = sqlite3.connect(DB_PATH)
     c = conn.cursor()
     # Nodes table: ip, hostname, last_seen
     c.execute('''CREATE TABLE IF NOT EXISTS nodes 
                  (ip TEXT PRIMARY KEY, hostname TEXT, last_seen REAL, status TEXT)''')
+    # Columns added after the first release
+    existing = {row[1] for row in c.execute("PRAGMA table_info(nodes)")}
+    for name, decl in NODE_COLUMNS:
+        if name not in existing:
+            c.execute(f"ALTER TABLE nodes ADD COLUMN {name} {decl}")
+    # Samples pulled from the nodes by the collector. WAL lets the
+    # dashboard read while the collector writes.
+    c.execute("PRAGMA journal_mode=WAL")
+    collector.create_tables(c)
+    health.create_tables(c)
     conn.commit()
     conn.close()
 
@@ -92,26 +123,79 @@ def get_nodes():
     conn.close()
     return jsonify(nodes)
 
-@app.route('/api/discover', methods=['POST'])
-def discover():
-    # Run scan in background or wait? 
-    # For better UX, we'll run it synchronously for now (up to few seconds) or return "started"
-    # Let's do a quick scan.
-    found_nodes = scan_network() 
-    
+@app.route('/api/nodes/<path:ip>/history')
+def get_node_history(ip):
+    """Status changes of one node, newest first."""
+    limit = request.args.get('limit', 100, type=int)
+    conn = sqlite3.connect(DB_PATH)
+    conn.row_factory = sqlite3.Row
+    c = conn.cursor()
+    c.execute("SELECT timestamp, status, detail FROM node_status_history WHERE ip = ? "
+              "ORDER BY timestamp DESC LIMIT ?", (ip, limit))
+    history = [dict(row) for row in c.fetchall()]
+    conn.close()
+    return jsonify(history)
+
+@app.route('/api/fleet/power')
+def fleet_power():
+    """
+    Site power history from the central store.
+    ?start=&end= (epoch seconds, default the last hour), ?bucket= seconds.
+    """
+    end = request.args.get('end', time.time(), type=float)
+    start = request.args.get('start', end - 3600, type=float)
+    bucket = max(1, request.args.get('bucket', 60, type=int))
+    conn = sqlite3.connect(DB_PATH)
+    result = collector.site_power(conn, start, end, bucket)
+    conn.close()
+    result["bucket"] = bucket
+    return jsonify(result)
+
+@app.route('/api/fleet/latest')
+def fleet_latest():
+    """Current site power and per-node breakdown from the central store."""
+    max_age = request.args.get('max_age', 60, type=float)
     conn = sqlite3.connect(DB_PATH)
+    result = collector.latest_power(conn, max_age)
+    conn.close()
+    return jsonify(result)
+
+@app.route('/api/fleet/collector')
+def collector_status():
+    return jsonify(data_collector.last_round)
+
+def register_nodes(found_nodes):
+    """Adds or refreshes discovered nodes, keeping their stored clock data."""
+    conn = sqlite3.connect(DB_PATH, timeout=10)
     c = conn.cursor()
-    count = 0
     timestamp = time.time()
     for node in found_nodes:
-        # Upsert
-        c.execute("INSERT OR REPLACE INTO nodes (ip, hostname, last_seen, status) VALUES (?, ?, ?, ?)",
-                  (node['ip'], node.get('hostname', 'Unknown'), timestamp, 'online'))
-        count += 1
+        # Upsert; a new node starts out online, after that its status
+        # (and status history) belong to the health monitor
+        c.execute('''INSERT INTO nodes (ip, hostname, last_seen, status) VALUES (?, ?, ?, 'online')
+                     ON CONFLICT(ip) DO UPDATE SET hostname = excluded.hostname,
+                     last_seen = excluded.last_seen''',
+                  (node['ip'], node.get('hostname', 'Unknown'), timestamp))
     conn.commit()
     conn.close()
-    
-    return jsonify({"success": True, "count": count, "nodes": found_nodes})
+
+discovery = Discovery(register_nodes)
+
+@app.route('/api/discover', methods=['GET', 'POST'])
+def discover():
+    """
+    POST starts a background scan, {"networks": ["10.0.0.0/22", ...]}
+    (default: the local /24), {"force": true} to ignore a recent result.
+    GET reports its progress and the nodes found so far.
+    """
+    if request.method == 'POST':
+        data = request.get_json(silent=True) or {}
+        try:
+            started = discovery.start(data.get('networks'), force=bool(data.get('force')))
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        return jsonify(dict(discovery.status(), started=started)), 202
+    return jsonify(discovery.status())
 
 @app.route('/api/proxy/<path:ip>/<path:endpoint>')
 def proxy_request(ip, endpoint):
@@ -120,68 +204,140 @@ def proxy_request(ip, endpoint):
     Example: /api/proxy/192.168.1.50/api/data
     """
     try:
-        url = f"http://{ip}:25500/{endpoint}"
+        path = endpoint
         if request.query_string:
-            url += f"?{request.query_string.decode('utf-8')}"
-            
-        resp = requests.get(url, timeout=3)
-        return (resp.content, resp.status_code, resp.headers.items())
+            path += f"?{request.query_string.decode('utf-8')}"
+
+        if 'text/event-stream' in request.headers.get('Accept', ''):
+            # Live streams (EventSource) go straight through; the read
+            # timeout only has to outlast the node's keepalive interval
+            resp = node_client.get(ip, path, stream=True,
+                                   timeout=(node_client.CONNECT_TIMEOUT, PROXY_STREAM_TIMEOUT))
+            status, headers, body = proxy_cache.passthrough(resp)
+        else:
+            status, headers, body = proxy_responses.get(
+                (ip, path), lambda: node_client.get(ip, path, stream=True))
+        return Response(body, status=status, headers=headers)
     except Exception as e:
         return jsonify({"error": str(e)}), 502
 
-@app.route('/api/recording/start_all', methods=['POST'])
-def start_recording_all():
-    data = request.json
-    event_name = data.get('name', 'Central Recording')
-    
+def _node_ips(online_only=False):
     conn = sqlite3.connect(DB_PATH)
     c = conn.cursor()
-    c.execute("SELECT ip FROM nodes WHERE status='online'")
-    nodes = c.fetchall()
+    if online_only:
+        # Degraded nodes still answer, so they're included
+        c.execute("SELECT ip FROM nodes WHERE status != 'offline'")
+    else:
+        c.execute("SELECT ip FROM nodes")
+    ips = [row[0] for row in c.fetchall()]
     conn.close()
-    
-    results = []
-    
-    for row in nodes:
-        ip = row[0]
-        try:
-            # 1. Create Event on Node
-            create_url = f"http://{ip}:25500/api/events"
-            r1 = requests.post(create_url, json={"name": event_name}, timeout=3)
-            if r1.status_code == 200:
-                event_id = r1.json().get('event_id')
-                # 2. Start Recording
-                start_url = f"http://{ip}:25500/api/recording/start"
-                requests.post(start_url, json={"event_id": event_id}, timeout=3)
-                results.append({"ip": ip, "status": "started"})
-            else:
-                results.append({"ip": ip, "status": "failed_create"})
-        except:
-            results.append({"ip": ip, "status": "unreachable"})
-            
-    return jsonify(results)
+    return ips
 
-@app.route('/api/recording/stop_all', methods=['POST'])
-def stop_recording_all():
+def _measure_clock(ip):
+    """measure_clock for fan_out; nodes without /api/time report no offset."""
+    clock = node_client.measure_clock(ip)
+    if clock is None:
+        return {"status": "unsupported"}
+    offset, rtt = clock
+    return {"status": "ok", "clock_offset": offset, "rtt_ms": round(rtt * 1000, 1)}
+
+def _store_clocks(results):
     conn = sqlite3.connect(DB_PATH)
     c = conn.cursor()
-    c.execute("SELECT ip FROM nodes") # Try stopping on all known nodes
-    nodes = c.fetchall()
+    now = time.time()
+    for r in results:
+        if r.get("clock_offset") is not None:
+            c.execute("UPDATE nodes SET clock_offset = ?, rtt_ms = ?, clock_checked = ? WHERE ip = ?",
+                      (r["clock_offset"], r["rtt_ms"], now, r["ip"]))
+    conn.commit()
     conn.close()
-    
-    for row in nodes:
-        ip = row[0]
-        try:
-            requests.post(f"http://{ip}:25500/api/recording/stop", timeout=2)
-            requests.post(f"http://{ip}:25500/api/events/stop", timeout=2)
-        except:
-            pass
-    return jsonify({"success": True})
+
+@app.route('/api/nodes/clocks', methods=['POST'])
+def measure_clocks():
+    """Re-measures the clock offset of every known node."""
+    results = node_client.fan_out(_node_ips(), _measure_clock)
+    _store_clocks(results)
+    return jsonify(results)
+
+@app.route('/api/recording/start_all', methods=['POST'])
+def start_recording_all():
+    data = request.json
+    event_name = data.get('name', 'Central Recording')
+
+    def prepare(ip):
+        # Everything slow or likely to fail happens before the start time
+        # is fixed: the clock offset and the event on the node
+        clock = _measure_clock(ip)
+        r = node_client.post(ip, '/api/events', json={"name": event_name})
+        if r.status_code != 200:
+            return {**clock, "status": "failed_create"}
+        return {**clock, "status": "prepared", "event_id": r.json().get('event_id')}
+
+    results = node_client.fan_out(_node_ips(online_only=True), prepare)
+    ready = {r["ip"]: r for r in results if r["status"] == "prepared"}
+
+    # Common start on a whole second START_LEAD ahead (dashboard clock).
+    # Each node is sent that moment translated to its own clock and starts
+    # on its first sample at or after it.
+    start_at = float(int(time.time() + START_LEAD) + 1)
+
+    def schedule(ip):
+        node = ready[ip]
+        r = node_client.post(ip, '/api/recording/start',
+                             json={"event_id": node["event_id"],
+                                   "start_at": start_at + (node.get("clock_offset") or 0.0)})
+        if r.status_code != 200:
+            return {"status": "failed_start"}
+        pending = r.json().get("pending")
+        # A node reached after start_at starts right away, out of step with
+        # the others ("late"); firmware without scheduling just starts
+        if pending:
+            return {"status": "scheduled"}
+        return {"status": "late" if pending is False else "started"}
+
+    # One request per node; the socket timeouts bound it, so no node is
+    # left running in the background when we report
+    scheduled = node_client.fan_out(list(ready), schedule,
+                                    deadline=node_client.CONNECT_TIMEOUT + node_client.READ_TIMEOUT + 1)
+    for r in scheduled:
+        # Keep the event id and clock of the preparation with the outcome
+        r.update({k: v for k, v in ready[r["ip"]].items() if k not in r})
+    by_ip = {r["ip"]: r for r in scheduled}
+    results = [by_ip.get(r["ip"], r) for r in results]
+    _store_clocks(results)
+    counts = node_client.summarize(results)
+    return jsonify({
+        "success": counts.get("scheduled", 0) == len(results),
+        "start_at": start_at,
+        "counts": counts,
+        "results": results,
+    })
+
+@app.route('/api/recording/stop_all', methods=['POST'])
+def stop_recording_all():
+    def stop(ip):
+        # Closes the running event and stops recording in one call; a 400
+        # means the node wasn't recording
+        r = node_client.post(ip, '/api/events/stop')
+        if r.status_code == 400:
+            return {"status": "idle"}
+        if r.status_code != 200:
+            return {"status": "failed_stop"}
+        return {"status": "stopped"}
+
+    # Try stopping on all known nodes
+    results = node_client.fan_out(_node_ips(), stop)
+    counts = node_client.summarize(results)
+    failed = len(results) - counts.get("stopped", 0) - counts.get("idle", 0)
+    return jsonify({"success": failed == 0, "counts": counts, "results": results})
 
 if __name__ == '__main__':
     try:
         logging.info("Initializing Database...")
         init_db()
+        data_collector.start()
+        health_monitor.start()
+        AnnouncementListener(register_nodes).start()
         
         # --- System Tray & GUI Setup ---
         logging.info("Importing System Tray Libraries...")
@@ -0,0 +1,220 @@
+"""
+Central copy of every node's samples.
+
+The Collector pulls new samples from all nodes in the background, each
+from its own cursor (the newest timestamp already stored), and keeps them
+in the dashboard database so fleet-wide queries never have to touch the
+Pis. A node that is offline simply keeps its cursor and catches up on the
+next successful pull; samples are keyed by (node_ip, timestamp), so a
+page fetched twice is stored once.
+"""
+from concurrent.futures import ThreadPoolExecutor
+import sqlite3
+import threading
+import time
+
+import node_client
+
+# Node log columns copied into the central store (the node's own row id
+# isn't; its event ids are only meaningful per node)
+SAMPLE_COLUMNS = (
+    'timestamp', 'event_id',
+    'p1_v', 'p1_i', 'p1_p', 'p1_e',
+    'p2_v', 'p2_i', 'p2_p', 'p2_e',
+    'p3_v', 'p3_i', 'p3_p', 'p3_e',
+    'neutral_i',
+)
+
+# Seconds between pull rounds
+COLLECT_INTERVAL = 10
+# Rows per request, and requests per node per round, so a node that comes
+# back after a long outage catches up over a few rounds
+PAGE_ROWS = 5000
+MAX_PAGES = 20
+# Nodes pulled at once. Pulls run on their own pool, so a slow catch-up
+# never holds up the health checks and fleet actions on the shared one.
+COLLECT_WORKERS = 8
+# How far back to start on a node seen for the first time
+INITIAL_BACKFILL = 24 * 3600
+
+TOTAL_POWER_SQL = "COALESCE(p1_p, 0) + COALESCE(p2_p, 0) + COALESCE(p3_p, 0)"
+
+
+def create_tables(c):
+    cols = ", ".join(f"{col} REAL" for col in SAMPLE_COLUMNS if col not in ('timestamp', 'event_id'))
+    # Clustered by node first: each node's samples are one contiguous
+    # range of the table, and appends for a node stay local
+    c.execute(f'''
+    CREATE TABLE IF NOT EXISTS samples (
+        node_ip TEXT NOT NULL,
+        timestamp REAL NOT NULL,
+        event_id INTEGER,
+        {cols},
+        PRIMARY KEY (node_ip, timestamp)
+    ) WITHOUT ROWID
+    ''')
+    # Fleet-wide queries scan by time across all nodes
+    c.execute("CREATE INDEX IF NOT EXISTS idx_samples_timestamp ON samples (timestamp)")
+
+
+class Collector:
+    """Background thread pulling samples from all known nodes."""
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.interval = COLLECT_INTERVAL
+        self._stop = threading.Event()
+        self._thread = None
+        self.last_round = None
+        self._executor = ThreadPoolExecutor(max_workers=COLLECT_WORKERS, thread_name_prefix="collector")
+        # Nodes whose pull is still running, possibly from an earlier round
+        self._busy = set()
+        self._busy_lock = threading.Lock()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.run_once()
+            except Exception as e:
+                print(f"Error in collector: {e}")
+            self._stop.wait(self.interval)
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=10)
+        conn.execute("PRAGMA journal_mode=WAL")
+        return conn
+
+    def run_once(self):
+        """Pulls every node once. Returns the per-node results."""
+        conn = self._connect()
+        try:
+            cursors = self._cursors(conn)
+        finally:
+            conn.close()
+
+        def pull(ip):
+            since = cursors[ip]
+            collected = 0
+            conn = self._connect()
+            with self._busy_lock:
+                self._busy.add(ip)
+            try:
+                for _ in range(MAX_PAGES):
+                    r = node_client.get(ip, '/api/logs', params={"since": since, "limit": PAGE_ROWS})
+                    if r.status_code == 404:
+                        return {"status": "unsupported"}
+                    r.raise_for_status()
+                    page = r.json()
+                    rows = page["rows"]
+                    if list(page["columns"]) != list(SAMPLE_COLUMNS):
+                        # Pick the known columns out of whatever the node
+                        # sends; sensors it doesn't have are left empty
+                        columns = list(page["columns"])
+                        idx = [columns.index(col) if col in columns else None for col in SAMPLE_COLUMNS]
+                        rows = [[None if i is None else row[i] for i in idx] for row in rows]
+                    # Stored page by page, so a round cut short by the
+                    # deadline keeps what it already fetched
+                    self._store(conn, ip, rows)
+                    collected += len(rows)
+                    if rows:
+                        since = rows[-1][0]
+                    if not page["more"]:
+                        break
+            finally:
+                conn.close()
+                with self._busy_lock:
+                    self._busy.discard(ip)
+            return {"status": "ok", "collected": collected}
+
+        # A pull that outlived its round keeps going; don't start another
+        with self._busy_lock:
+            busy = set(self._busy)
+        pulled = node_client.fan_out([ip for ip in cursors if ip not in busy], pull,
+                                     deadline=self.interval, executor=self._executor)
+        by_ip = {r["ip"]: r for r in pulled}
+        results = [by_ip.get(ip) or {"ip": ip, "status": "busy"} for ip in cursors]
+        self.last_round = {"time": time.time(), "nodes": results}
+        return results
+
+    def _cursors(self, conn):
+        """Newest stored timestamp per node, or the backfill start for new ones."""
+        start = time.time() - INITIAL_BACKFILL
+        c = conn.cursor()
+        c.execute("SELECT ip FROM nodes")
+        cursors = {}
+        for (ip,) in c.fetchall():
+            c.execute("SELECT MAX(timestamp) FROM samples WHERE node_ip = ?", (ip,))
+            last = c.fetchone()[0]
+            cursors[ip] = start if last is None else last
+        return cursors
+
+    def _store(self, conn, ip, rows):
+        placeholders = ", ".join("?" * (len(SAMPLE_COLUMNS) + 1))
+        with conn:
+            conn.executemany(
+                f"INSERT OR IGNORE INTO samples (node_ip, {', '.join(SAMPLE_COLUMNS)}) "
+                f"VALUES ({placeholders})",
+                ([ip] + list(row) for row in rows))
+            conn.execute("UPDATE nodes SET last_seen = ? WHERE ip = ?", (time.time(), ip))
+
+
+def site_power(conn, start, end, bucket):
+    """
+    Site power between start and end in `bucket`-second steps: the average
+    total power (all phases) of each node per bucket, and their sum.
+    Returns {"timestamps": [...], "total": [...], "nodes": {ip: [...]}},
+    with None where a node has no samples in a bucket.
+    """
+    c = conn.cursor()
+    c.execute(f'''
+    SELECT CAST(timestamp / ? AS INTEGER) * ? AS bucket, node_ip, AVG({TOTAL_POWER_SQL})
+    FROM samples
+    WHERE timestamp >= ? AND timestamp < ?
+    GROUP BY bucket, node_ip
+    ORDER BY bucket
+    ''', (bucket, bucket, start, end))
+
+    timestamps, total, per_node = [], [], {}
+    for ts, ip, power in c.fetchall():
+        if not timestamps or timestamps[-1] != ts:
+            timestamps.append(ts)
+            total.append(0.0)
+        total[-1] += power
+        series = per_node.setdefault(ip, [])
+        series.extend([None] * (len(timestamps) - 1 - len(series)))
+        series.append(round(power, 2))
+
+    for series in per_node.values():
+        series.extend([None] * (len(timestamps) - len(series)))
+    return {
+        "timestamps": timestamps,
+        "total": [round(p, 2) for p in total],
+        "nodes": per_node,
+    }
+
+
+def latest_power(conn, max_age):
+    """
+    Newest sample of every node not older than max_age seconds, with the
+    site total. Returns {"total": W, "nodes": [{ip, timestamp, power, phases}]}.
+    """
+    cutoff = time.time() - max_age
+    c = conn.cursor()
+    c.execute("SELECT ip FROM nodes")
+    nodes = []
+    for (ip,) in c.fetchall():
+        c.execute(f'''
+        SELECT timestamp, p1_p, p2_p, p3_p, {TOTAL_POWER_SQL} FROM samples
+        WHERE node_ip = ? AND timestamp >= ? ORDER BY timestamp DESC LIMIT 1
+        ''', (ip, cutoff))
+        row = c.fetchone()
+        if row:
+            nodes.append({"ip": ip, "timestamp": row[0], "phases": list(row[1:4]), "power": row[4]})
+    return {"total": round(sum(n["power"] for n in nodes), 2), "nodes": nodes}
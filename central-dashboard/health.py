@@ -0,0 +1,160 @@
+"""
+Node health monitoring.
+
+The HealthMonitor probes every known node concurrently on an interval and
+keeps the outcome in the nodes table: round-trip latency, the node's last
+sample and how far behind its clock it is, Modbus poll errors and the
+recording state. A node is 'online' when all is well, 'degraded' when it
+answers but isn't sampling properly, and 'offline' when it doesn't answer.
+Every change of status is recorded in node_status_history.
+"""
+import sqlite3
+import threading
+import time
+
+import node_client
+
+# Seconds between health rounds
+HEALTH_INTERVAL = 15
+# A node whose newest sample is older than this (seconds, node clock) is
+# lagging
+LAG_LIMIT = 10
+
+# Columns of the nodes table maintained by the monitor
+HEALTH_COLUMNS = (
+    ('latency_ms', 'REAL'),
+    ('last_sample', 'REAL'),        # newest sample, node clock
+    ('lag_s', 'REAL'),              # node clock minus last_sample
+    ('poll_errors', 'INTEGER'),     # Modbus errors since the node started
+    ('quarantined', 'TEXT'),        # comma-separated sensor addresses
+    ('recording', 'INTEGER'),
+    ('event_id', 'INTEGER'),
+    ('last_checked', 'REAL'),
+    ('status_since', 'REAL'),
+    ('status_detail', 'TEXT'),
+)
+
+
+def create_tables(c):
+    c.execute('''
+    CREATE TABLE IF NOT EXISTS node_status_history (
+        ip TEXT NOT NULL,
+        timestamp REAL NOT NULL,
+        status TEXT NOT NULL,
+        detail TEXT
+    )
+    ''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_status_history_ip ON node_status_history (ip, timestamp)")
+
+
+def probe(ip):
+    """Health of one node as a dict of HEALTH_COLUMNS values (and 'status')."""
+    started = time.monotonic()
+    r = node_client.get(ip, '/api/health')
+    latency = (time.monotonic() - started) * 1000
+    if r.status_code == 404:
+        # Nodes from before /api/health: only the latest sample is known
+        r = node_client.get(ip, '/api/data')
+        r.raise_for_status()
+        data = r.json()
+        info = {"time": None, "last_sample": data.get("timestamp"), "event_id": data.get("event_id"),
+                "poll_errors": None, "quarantined": []}
+        info["recording"] = info["event_id"] is not None
+    else:
+        r.raise_for_status()
+        info = r.json()
+
+    last_sample = info.get("last_sample")
+    lag = None
+    if last_sample is not None and info.get("time") is not None:
+        lag = info["time"] - last_sample
+
+    problems = []
+    if last_sample is None:
+        problems.append("no samples")
+    elif lag is not None and lag > LAG_LIMIT:
+        problems.append(f"last sample {lag:.0f}s old")
+    if info.get("quarantined"):
+        problems.append("sensors quarantined: " + ", ".join(str(a) for a in info["quarantined"]))
+
+    return {
+        "status": "degraded" if problems else "online",
+        "status_detail": "; ".join(problems) or None,
+        "latency_ms": round(latency, 1),
+        "last_sample": last_sample,
+        "lag_s": None if lag is None else round(lag, 2),
+        "poll_errors": info.get("poll_errors"),
+        "quarantined": ",".join(str(a) for a in info.get("quarantined") or []) or None,
+        "recording": int(bool(info.get("recording"))),
+        "event_id": info.get("event_id"),
+    }
+
+
+class HealthMonitor:
+    """Background thread running a health round every HEALTH_INTERVAL seconds."""
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.interval = HEALTH_INTERVAL
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.run_once()
+            except Exception as e:
+                print(f"Error in health monitor: {e}")
+            self._stop.wait(self.interval)
+
+    def run_once(self):
+        """Probes every node once and stores the results. Returns them."""
+        conn = sqlite3.connect(self.db_path, timeout=10)
+        try:
+            c = conn.cursor()
+            c.execute("SELECT ip, status, poll_errors FROM nodes")
+            previous = {ip: (status, errors) for ip, status, errors in c.fetchall()}
+
+            results = node_client.fan_out(list(previous), probe)
+            now = time.time()
+            with conn:
+                for result in results:
+                    self._store(c, result, previous[result["ip"]], now)
+        finally:
+            conn.close()
+        return results
+
+    def _store(self, c, result, previous, now):
+        ip = result["ip"]
+        old_status, old_errors = previous
+        if result["status"] in ("online", "degraded"):
+            errors = result["poll_errors"]
+            # New poll errors since the last round also count as degraded
+            if errors is not None and old_errors is not None and errors > old_errors:
+                result["status"] = "degraded"
+                detail = f"{errors - old_errors} new poll errors"
+                result["status_detail"] = "; ".join(filter(None, [result["status_detail"], detail]))
+            values = {name: result[name] for name, _ in HEALTH_COLUMNS if name in result}
+            values["last_seen"] = now
+        else:
+            # Unreachable or timed out; keep the last known readings
+            result["status_detail"] = result["status"]
+            result["status"] = "offline"
+            values = {"status_detail": result["status_detail"]}
+
+        values["status"] = result["status"]
+        values["last_checked"] = now
+        if result["status"] != old_status:
+            values["status_since"] = now
+            c.execute("INSERT INTO node_status_history (ip, timestamp, status, detail) VALUES (?, ?, ?, ?)",
+                      (ip, now, result["status"], result.get("status_detail")))
+
+        assignments = ", ".join(f"{name} = ?" for name in values)
+        c.execute(f"UPDATE nodes SET {assignments} WHERE ip = ?", list(values.values()) + [ip])
@@ -0,0 +1,112 @@
+"""
+HTTP access to the sensor nodes.
+
+All requests go through one pooled requests.Session, so repeated calls to
+the same node reuse a keep-alive connection instead of opening a new TCP
+connection every time. fan_out() runs a call against many nodes at once
+and gives up on the stragglers after a fixed deadline, so fleet-wide
+actions take about as long as the slowest reachable node rather than the
+sum of all timeouts.
+"""
+from concurrent.futures import ThreadPoolExecutor, wait
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+NODE_PORT = 25500
+
+# Connect / read timeouts for a single request to a node (seconds)
+CONNECT_TIMEOUT = 1.0
+READ_TIMEOUT = 3.0
+
+# Upper bound on concurrent node requests, and on idle keep-alive
+# connections kept per node
+MAX_WORKERS = 32
+POOL_SIZE = 4
+
+session = requests.Session()
+_adapter = HTTPAdapter(pool_connections=MAX_WORKERS, pool_maxsize=POOL_SIZE, max_retries=0)
+session.mount('http://', _adapter)
+
+_executor = ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix="node")
+
+
+def node_url(ip, path):
+    return f"http://{ip}:{NODE_PORT}/{path.lstrip('/')}"
+
+
+def get(ip, path, timeout=None, **kwargs):
+    return session.get(node_url(ip, path), timeout=timeout or (CONNECT_TIMEOUT, READ_TIMEOUT), **kwargs)
+
+
+def post(ip, path, timeout=None, **kwargs):
+    return session.post(node_url(ip, path), timeout=timeout or (CONNECT_TIMEOUT, READ_TIMEOUT), **kwargs)
+
+
+def measure_clock(ip, samples=3):
+    """
+    Estimates a node's clock offset (node clock minus ours) from
+    /api/time, NTP style: the node's reading is assumed to be taken
+    halfway through the round trip. The sample with the shortest round
+    trip is used. Returns (offset, rtt) in seconds, or None for nodes
+    running firmware without /api/time.
+    """
+    best = None
+    for _ in range(samples):
+        t0 = time.time()
+        r = get(ip, '/api/time')
+        t1 = time.time()
+        if r.status_code == 404:
+            return None
+        r.raise_for_status()
+        offset = r.json()['time'] - (t0 + t1) / 2
+        rtt = t1 - t0
+        if best is None or rtt < best[1]:
+            best = (offset, rtt)
+    return best
+
+
+def fan_out(ips, fn, deadline=READ_TIMEOUT + CONNECT_TIMEOUT, executor=None):
+    """
+    Calls fn(ip) for every node concurrently and returns a list of
+    {"ip": ..., "status": ..., "elapsed_ms": ...} dicts in the order of `ips`.
+    Runs on the shared pool unless given another `executor`.
+
+    fn returns a dict that is merged into the node's result (it should set
+    "status"). A node that raises is reported as "unreachable", one that
+    hasn't answered after `deadline` seconds as "timeout".
+    """
+    started = time.monotonic()
+
+    def timed(ip):
+        result = fn(ip)
+        result["elapsed_ms"] = round((time.monotonic() - started) * 1000, 1)
+        return result
+
+    executor = executor or _executor
+    futures = [executor.submit(timed, ip) for ip in ips]
+    wait(futures, timeout=deadline)
+
+    results = []
+    for ip, future in zip(ips, futures):
+        entry = {"ip": ip}
+        if not future.done():
+            # Left to finish on its own; its socket timeouts bound it
+            future.cancel()
+            entry["status"] = "timeout"
+        elif future.exception() is not None:
+            entry["status"] = "unreachable"
+            entry["error"] = str(future.exception())
+        else:
+            entry.update(future.result())
+        results.append(entry)
+    return results
+
+
+def summarize(results):
+    """Counts results per status, e.g. {"started": 28, "unreachable": 2}."""
+    counts = {}
+    for r in results:
+        counts[r["status"]] = counts.get(r["status"], 0) + 1
+    return counts
@@ -0,0 +1,121 @@
+"""
+Response cache for /api/proxy.
+
+Identical GET requests for the same node arriving at the same time share
+one upstream request (single flight), and small successful responses are
+kept for a short TTL, so a node sees about one request per endpoint per
+TTL however many browsers are watching it. Responses without a known,
+small Content-Length (exports, streams) are passed through in chunks as
+they arrive instead of being buffered.
+"""
+import threading
+import time
+
+# Headers describing the upstream connection rather than the response,
+# plus the ones that no longer apply once requests has decoded the body
+DROPPED_HEADERS = {
+    'connection', 'keep-alive', 'proxy-authenticate', 'proxy-authorization',
+    'te', 'trailer', 'trailers', 'transfer-encoding', 'upgrade',
+    'content-encoding', 'content-length',
+}
+
+
+def filter_headers(headers):
+    return [(k, v) for k, v in headers.items() if k.lower() not in DROPPED_HEADERS]
+
+
+def passthrough(resp):
+    """(status, headers, body iterator) streaming an open upstream response."""
+    def body():
+        try:
+            # chunk_size=None yields data as soon as it arrives
+            for chunk in resp.iter_content(chunk_size=None):
+                yield chunk
+        finally:
+            resp.close()
+    return resp.status_code, filter_headers(resp.headers), body()
+
+
+class _Flight:
+    """One upstream request in progress, waited on by identical requests."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class ProxyCache:
+
+    def __init__(self, ttl, max_entries=256, max_body=256 * 1024):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_body = max_body
+        self._entries = {}
+        self._flights = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    def get(self, key, fetch):
+        """
+        Returns (status, headers, body) for `key`, calling fetch() (which
+        must open the upstream request with stream=True) only when there
+        is neither a fresh cached response nor a request already in flight.
+        body is bytes, or an iterator for responses passed through.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[0] > time.monotonic():
+                self.hits += 1
+                return entry[1]
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+                self.misses += 1
+
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            if flight.result is not None:
+                with self._lock:
+                    self.coalesced += 1
+                return flight.result
+            # The leader's response was streamed to the leader; a stream
+            # can't be shared, so fetch our own
+            return passthrough(fetch())
+
+        try:
+            resp = fetch()
+            length = resp.headers.get('Content-Length')
+            if length is None or int(length) > self.max_body:
+                return passthrough(resp)
+            flight.result = (resp.status_code, filter_headers(resp.headers), resp.content)
+            if resp.status_code == 200:
+                self._store(key, flight.result)
+            return flight.result
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+
+    def _store(self, key, result):
+        with self._lock:
+            now = time.monotonic()
+            if len(self._entries) >= self.max_entries:
+                # Drop expired entries, then the oldest if still full
+                self._entries = {k: e for k, e in self._entries.items() if e[0] > now}
+                if len(self._entries) >= self.max_entries:
+                    del self._entries[min(self._entries, key=lambda k: self._entries[k][0])]
+            self._entries[key] = (now + self.ttl, result)
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._entries), "hits": self.hits,
+                    "misses": self.misses, "coalesced": self.coalesced}
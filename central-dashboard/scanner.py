@@ -1,10 +1,25 @@
+import asyncio
+import ipaddress
+import json
 import socket
 import threading
-import requests
-import ipaddress
 import time
 
+import node_client
+
 PORT = 25500
+# Nodes broadcast their identity to this UDP port (see sensor-node/announce.py)
+ANNOUNCE_PORT = 25501
+SERVICE = "voltwise-node"
+
+# TCP connect timeout of the first, cheap probe, and how many hosts are
+# probed at once
+CONNECT_TIMEOUT = 0.3
+CONCURRENCY = 256
+# Refuse accidental scans of huge networks (a /20 is 4094 hosts)
+MAX_HOSTS = 4096
+# A finished scan of the same networks is reused for this many seconds
+CACHE_TTL = 300
 
 def get_local_ip():
     try:
@@ -17,42 +32,192 @@ def get_local_ip():
     except:
         return "127.0.0.1"
 
-def check_ip(ip, results):
-    url = f"http://{ip}:{PORT}/api/data"
-    try:
-        resp = requests.get(url, timeout=0.5)
-        if resp.status_code == 200:
-            # It's a VoltWise node!
-            # Try to get hostname/config if possible, or just use IP
-            results.append({"ip": str(ip), "hostname": f"Node {str(ip).split('.')[-1]}"})
-    except:
-        pass
-
-def scan_network():
+def default_networks():
+    """The local /24, used when no networks are given."""
     local_ip = get_local_ip()
     if local_ip == "127.0.0.1":
         return []
+    return [str(ipaddress.ip_network(f"{local_ip}/24", strict=False))]
+
+def scan_hosts(networks):
+    """
+    Addresses to probe in the given CIDRs (e.g. ["10.1.0.0/22"]), without
+    our own. Raises ValueError for malformed or oversized networks.
+    """
+    local_ip = get_local_ip()
+    hosts = []
+    for network in networks:
+        net = ipaddress.ip_network(network, strict=False)
+        if len(hosts) + net.num_addresses > MAX_HOSTS:
+            raise ValueError(f"Refusing to scan more than {MAX_HOSTS} addresses")
+        hosts.extend(str(h) for h in net.hosts() if str(h) != local_ip)
+    return hosts
+
+def identify(ip):
+    """
+    HTTP identity check of a host with port 25500 open. Returns
+    {"ip", "hostname"} for VoltWise nodes, None for anything else.
+    """
+    r = node_client.get(ip, '/api/identity', timeout=(CONNECT_TIMEOUT, 1.0))
+    if r.status_code == 200:
+        info = r.json()
+        if info.get('service') != SERVICE:
+            return None
+        return {"ip": ip, "hostname": info.get('hostname') or f"Node {ip.split('.')[-1]}"}
+    # Nodes from before /api/identity
+    r = node_client.get(ip, '/api/data', timeout=(CONNECT_TIMEOUT, 1.0))
+    if r.status_code == 200:
+        return {"ip": ip, "hostname": f"Node {ip.split('.')[-1]}"}
+    return None
+
+async def _port_open(ip):
+    try:
+        _, writer = await asyncio.wait_for(asyncio.open_connection(ip, PORT), CONNECT_TIMEOUT)
+    except (OSError, asyncio.TimeoutError):
+        return False
+    writer.close()
+    try:
+        await writer.wait_closed()
+    except OSError:
+        pass
+    return True
+
+async def _scan(hosts, concurrency, on_progress):
+    semaphore = asyncio.Semaphore(concurrency)
+    loop = asyncio.get_running_loop()
+    found = []
+    scanned = 0
+
+    async def check(ip):
+        nonlocal scanned
+        async with semaphore:
+            # Only hosts that accept a connection get the (slower) HTTP check
+            if await _port_open(ip):
+                try:
+                    node = await loop.run_in_executor(None, identify, ip)
+                except Exception:
+                    node = None
+                if node:
+                    found.append(node)
+        scanned += 1
+        on_progress(scanned, found)
+
+    await asyncio.gather(*(check(ip) for ip in hosts))
+    return found
+
+def scan_network(networks=None, concurrency=CONCURRENCY, on_progress=None):
+    """
+    Scans the given CIDRs (default: the local /24) and returns the nodes
+    found as [{"ip", "hostname"}]. on_progress(scanned, found) is called
+    after every host.
+    """
+    hosts = scan_hosts(networks or default_networks())
+    return asyncio.run(_scan(hosts, concurrency, on_progress or (lambda scanned, found: None)))
+
+
+class Discovery:
+    """
+    Runs scans in a background thread and keeps the outcome of the last
+    one, so the web request starting a scan returns immediately and the
+    page can poll status() for progress.
+    """
+
+    def __init__(self, on_found):
+        self.on_found = on_found
+        self._lock = threading.Lock()
+        self._status = {"state": "idle", "networks": [], "scanned": 0, "total": 0,
+                        "found": [], "started": None, "finished": None, "error": None}
+
+    def status(self):
+        with self._lock:
+            return dict(self._status, found=list(self._status["found"]))
+
+    def start(self, networks=None, force=False):
+        """
+        Starts a scan unless one is running or the same networks were
+        scanned less than CACHE_TTL ago (unless force). Returns True if a
+        new scan was started. Raises ValueError for invalid networks.
+        """
+        networks = networks or default_networks()
+        hosts = scan_hosts(networks)
+        with self._lock:
+            s = self._status
+            if s["state"] == "running":
+                return False
+            fresh = s["state"] == "done" and time.time() - s["finished"] < CACHE_TTL
+            if fresh and not force and s["networks"] == networks:
+                return False
+            self._status = {"state": "running", "networks": networks, "scanned": 0,
+                            "total": len(hosts), "found": [], "started": time.time(),
+                            "finished": None, "error": None}
+        threading.Thread(target=self._run, args=(hosts,), daemon=True).start()
+        return True
+
+    def _progress(self, scanned, found):
+        with self._lock:
+            self._status["scanned"] = scanned
+            self._status["found"] = list(found)
+
+    def _run(self, hosts):
+        try:
+            found = asyncio.run(_scan(hosts, CONCURRENCY, self._progress))
+            self.on_found(found)
+            with self._lock:
+                self._status.update(state="done", found=found, finished=time.time())
+        except Exception as e:
+            print(f"Error scanning network: {e}")
+            with self._lock:
+                self._status.update(state="error", error=str(e), finished=time.time())
+
+
+class AnnouncementListener:
+    """
+    Listens for the UDP broadcasts nodes send every few seconds and passes
+    each announcing node to on_found, so nodes appear without a scan.
+    """
+
+    def __init__(self, on_found, port=ANNOUNCE_PORT):
+        self.on_found = on_found
+        self.port = port
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        try:
+            sock.bind(('', self.port))
+        except OSError as e:
+            print(f"Not listening for node announcements: {e}")
+            sock.close()
+            return
+        # Wake up regularly to notice stop()
+        sock.settimeout(1.0)
+        try:
+            while not self._stop.is_set():
+                try:
+                    payload, (ip, _) = sock.recvfrom(2048)
+                    info = json.loads(payload)
+                except socket.timeout:
+                    continue
+                except ValueError:
+                    continue
+                if not isinstance(info, dict) or info.get('service') != SERVICE:
+                    continue
+                try:
+                    self.on_found([{"ip": ip, "hostname": info.get('hostname') or f"Node {ip.split('.')[-1]}"}])
+                except Exception as e:
+                    print(f"Error registering announced node {ip}: {e}")
+        finally:
+            sock.close()
 
-    # Assume /24 subnet
-    network_prefix = ".".join(local_ip.split('.')[:-1])
-    
-    threads = []
-    results = []
-    
-    # Scan 1-254
-    for i in range(1, 255):
-        ip = f"{network_prefix}.{i}"
-        if ip == local_ip: continue
-        
-        t = threading.Thread(target=check_ip, args=(ip, results))
-        t.start()
-        threads.append(t)
-        
-    # Wait for all
-    for t in threads:
-        t.join()
-        
-    return results
 
 if __name__ == "__main__":
     print("Scanning...")
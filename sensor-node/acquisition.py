@@ -0,0 +1,80 @@
+from concurrent.futures import ThreadPoolExecutor
+import config
+from modbus_handler import PZEMHandler
+
+
+def configured_buses():
+    """
+    Returns the serial buses to poll as a list of
+    {'port': ..., 'addresses': [...]} dicts. Falls back to the single
+    SERIAL_PORT / SENSOR_ADDRESSES pair when SERIAL_BUSES isn't set.
+    """
+    buses = getattr(config, 'SERIAL_BUSES', None)
+    if buses:
+        return buses
+    return [{'port': config.SERIAL_PORT, 'addresses': config.SENSOR_ADDRESSES}]
+
+
+class MultiBusReader:
+    """
+    Reads sensors spread over several serial buses.
+
+    Each bus gets its own PZEMHandler and a dedicated worker thread, so the
+    buses are polled concurrently and the cycle takes as long as the
+    slowest bus instead of the sum of all of them. The results are merged
+    into one sample keyed by address, the same shape PZEMHandler.read_all
+    returns, so addresses must be unique across buses.
+    """
+
+    def __init__(self, buses):
+        self.handlers = []
+        self._owner = {}
+        for bus in buses:
+            handler = PZEMHandler(bus['port'], bus['addresses'])
+            for address in bus['addresses']:
+                if address in self._owner:
+                    raise ValueError(f"Sensor address {address} is configured on more than one bus")
+                self._owner[address] = handler
+            self.handlers.append(handler)
+
+        self.addresses = [a for h in self.handlers for a in h.addresses]
+        # One single-thread executor per bus: reads on a bus never overlap
+        # and always run on that bus's worker
+        self._workers = [
+            ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"bus{i}")
+            for i in range(len(self.handlers))
+        ] if len(self.handlers) > 1 else []
+
+    @property
+    def simulation_mode(self):
+        return all(h.simulation_mode for h in self.handlers)
+
+    def read_all(self):
+        """
+        Reads all buses at once and returns the merged sample. All buses
+        are started together, so one timestamp taken before the call
+        applies to every sensor.
+        """
+        if not self._workers:
+            return self.handlers[0].read_all()
+
+        futures = [worker.submit(handler.read_all)
+                   for worker, handler in zip(self._workers, self.handlers)]
+        data = {}
+        for handler, future in zip(self.handlers, futures):
+            try:
+                data.update(future.result())
+            except Exception as e:
+                print(f"Error polling bus {handler.port}: {e}")
+                data.update({address: None for address in handler.addresses})
+        return data
+
+    def reset_energy(self, address):
+        handler = self._owner.get(address)
+        if handler is None:
+            print(f"Unknown sensor address {address}")
+            return False
+        return handler.reset_energy(address)
+
+    def stats(self):
+        return {"buses": [h.stats() for h in self.handlers]}
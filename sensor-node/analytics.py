@@ -0,0 +1,573 @@
+"""
+Power quality statistics with NumPy.
+
+Samples are decoded one archived block or chunk of rows at a time into
+one array per column: blocks by undoing their deltas with cumsum, stored
+samples by viewing their packed blobs as a structured array, so no sample
+ever becomes a Python object. Columns stay in the integer register units
+of storage.py (shifted by one, 0 meaning unknown, as in the archive
+blocks). Each chunk is folded into an Analysis: sparse histograms
+(percentiles come from their cumulative counts instead of a sort) and
+per-minute energy totals, so memory follows the chunk size, not the
+selection. Histogram values from 4096 up are binned to 12 significant
+bits (0.05 %, a tenth of the PZEM's accuracy); counts, sums and extremes
+stay exact.
+
+Analyses merge, so the flush keeps one per hour and event in the
+analytics_1h table (HourSummaries), like the energy buckets: a month is
+answered from about 720 stored rows plus the raw samples of the partial
+hours at its edges (see DatabaseHandler.iter_analytics_parts).
+
+Voltage unbalance, the total power and the neutral ratio are taken over
+the phase sensors (derived.phases).
+
+NumPy is optional; app.py only offers /api/analytics when it imports.
+"""
+import struct
+import zlib
+
+import numpy as np
+
+import archive
+import derived
+import energy
+import storage
+
+# Percentiles reported for every statistic
+PERCENTILES = (1, 5, 50, 95, 99)
+# Rolling window of the peak demand (seconds, whole minutes)
+DEMAND_WINDOW = 900
+# Voltage unbalance above this (%) is reported as time over the limit
+# (EN 50160 allows 2 % for 95 % of the week)
+UNBALANCE_LIMIT = 2.0
+# Points of the load-duration curve
+DURATION_POINTS = 101
+# Bucket size of the stored summaries (seconds)
+SUMMARY_BUCKET = 3600
+
+# Fields decoded, with their divisors (see storage.py)
+FIELDS = {name: storage.DIVISORS[storage.FIELDS.index(name)] for name in ('v', 'i', 'p')}
+# Resolution of the voltage unbalance statistics (per %)
+_UNBALANCE_DIVISOR = 1000
+# Histogram precision; smaller values are kept exactly
+_SIGNIFICANT_BITS = 12
+# Histogram entries collected before they are merged, and the largest
+# value range merged by counting instead of sorting
+_COMPACT_AT = 1 << 18
+_DENSE_RANGE = 1 << 22
+# Keys of the histograms and power series in dump(): sensors by address
+_NEUTRAL, _TOTAL, _UNBALANCE = -1, -2, -3
+_SIZES = struct.Struct('<II')
+# Narrowest type for the histogram arrays of dump()
+_WIDTHS = ('<u2', '<u4', '<i8')
+_ITEMS = {'b': '<i1', 'h': '<i2', 'i': '<i4', 'q': '<i8'}
+_RECORD = np.dtype([('address', 'u1'), ('v', '<u2'), ('i', '<u4'), ('p', '<u4'), ('e', '<u4'),
+                    ('f', '<u2'), ('pf', 'u1'), ('alarm', 'u1')])
+
+
+def _undelta(bases, typecode, raw, count):
+    values = np.frombuffer(raw, dtype=_ITEMS[typecode]).astype(np.int64)
+    for base in reversed(bases):
+        values = np.concatenate(([base], values)).cumsum()
+    return values[:count]
+
+
+def _block_columns(block, addresses):
+    count, raw = archive.raw_columns(block)
+    cols = {'timestamp': _undelta(*raw['timestamp'], count) / 1000,
+            'neutral_i': _undelta(*raw['neutral'], count)}
+    for a in addresses:
+        for field in FIELDS:
+            parts = raw.get((a, field))
+            # A sensor missing from the block is unknown throughout
+            cols[f'p{a}_{field}'] = (np.zeros(count, dtype=np.int64) if parts is None
+                                     else _undelta(*parts, count))
+    return cols
+
+
+def _row_columns(rows, addresses):
+    """Columns of (timestamp, data) rows, in their order."""
+    names = ['neutral_i'] + [f'p{a}_{field}' for a in addresses for field in FIELDS]
+    cols = {name: np.zeros(len(rows), dtype=np.int64) for name in names}
+    cols['timestamp'] = np.fromiter((ts for ts, _ in rows), dtype=float, count=len(rows))
+    # Blobs differ in size with the number of sensors that answered
+    by_size = {}
+    for k, (_, data) in enumerate(rows):
+        by_size.setdefault(len(data), []).append(k)
+    for size, index in by_size.items():
+        n_records = (size - storage.HEADER.size) // storage.RECORD.size
+        dtype = np.dtype([('neutral', '<u4'), ('records', _RECORD, (n_records,))])
+        packed = np.frombuffer(b''.join(rows[k][1] for k in index), dtype=dtype)
+        index = np.array(index)
+        neutral = packed['neutral'].astype(np.int64)
+        cols['neutral_i'][index] = np.where(neutral == storage.NEUTRAL_MISSING, 0, neutral + 1)
+        records = packed['records']
+        for a in addresses:
+            for field in FIELDS:
+                missing = storage.MISSING[storage.FIELDS.index(field)]
+                # A sensor's slot depends on which others answered
+                for slot in range(n_records):
+                    raw = records[field][:, slot]
+                    hit = (records['address'][:, slot] == a) & (raw != missing)
+                    cols[f'p{a}_{field}'][index[hit]] = raw[hit].astype(np.int64) + 1
+    return cols
+
+
+def columns(kind, value, addresses, start=None, end=None):
+    """
+    Decodes a raw part of DatabaseHandler.iter_raw_samples ('block' or
+    'rows') into a dict of arrays named like the log columns (timestamp,
+    p<a>_v/_i/_p, neutral_i) in time order and limited to start..end, None
+    if no sample is left. timestamp is in seconds; the others are int64
+    register values plus one, 0 where unknown (divide value - 1 by
+    FIELDS[field] or storage.NEUTRAL_DIVISOR for engineering units).
+    """
+    cols = _block_columns(value, addresses) if kind == 'block' else _row_columns(value, addresses)
+    t = cols['timestamp']
+    first = 0 if start is None else np.searchsorted(t, start, side='left')
+    last = len(t) if end is None else np.searchsorted(t, end, side='right')
+    if first >= last:
+        return None
+    return {name: values[first:last] for name, values in cols.items()}
+
+
+def _known(column):
+    """The known register values of a column."""
+    return column[column > 0] - 1
+
+
+def _quantize(values):
+    """Values of 4096 and more rounded to _SIGNIFICANT_BITS, to the middle of their bin."""
+    shift = np.maximum(np.frexp(values.astype(float))[1] - _SIGNIFICANT_BITS, 0)
+    return ((values >> shift) << shift) + (np.left_shift(1, shift) >> 1)
+
+
+class Histogram:
+    """Count, sum, extremes and distribution of non-negative integers, added chunk by chunk."""
+
+    def __init__(self):
+        self.n = 0
+        self.total = 0
+        self.min = self.max = None
+        self._values, self._counts, self._steps = [], [], []
+        self._size = 0
+
+    def add(self, values):
+        if len(values):
+            self.merge(len(values), int(values.sum(dtype=np.int64)), int(values.min()),
+                       int(values.max()), *np.unique(_quantize(values), return_counts=True))
+
+    def merge(self, n, total, low, high, values, counts, steps=False):
+        """
+        Adds n values given by their sum, extremes and binned distribution,
+        values ascending or, with steps, as the differences between them.
+        """
+        self.n += n
+        self.total += total
+        self.min = low if self.min is None else min(self.min, low)
+        self.max = high if self.max is None else max(self.max, high)
+        self._values.append(values)
+        self._counts.append(counts)
+        self._steps.append(steps)
+        self._size += len(values)
+        if self._size > _COMPACT_AT:
+            self.items()
+
+    def items(self):
+        """(values, counts) of the distribution, values ascending."""
+        if not self._values:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        if len(self._values) > 1 or self._steps[0]:
+            values = np.concatenate(self._values).astype(np.int64)
+            weights = np.concatenate(self._counts)
+            if any(self._steps):
+                # One cumsum for all parts given as steps, restarted at each
+                lengths = [len(v) for v in self._values]
+                sums = values.cumsum()
+                before = np.concatenate(([0], sums))[np.cumsum([0] + lengths[:-1])]
+                values = np.where(np.repeat(self._steps, lengths), sums - np.repeat(before, lengths), values)
+            low = int(values.min())
+            if int(values.max()) - low < _DENSE_RANGE:
+                counts = np.bincount(values - low, weights=weights)
+                values = np.flatnonzero(counts)
+                counts = counts[values].astype(np.int64)
+                values += low
+            else:
+                values, inverse = np.unique(values, return_inverse=True)
+                counts = np.bincount(inverse, weights=weights).astype(np.int64)
+            self._values, self._counts, self._steps = [values], [counts], [False]
+            self._size = len(values)
+        return self._values[0], self._counts[0]
+
+    def ranked(self, ranks):
+        """Values at the given 0-based ranks in ascending order."""
+        values, counts = self.items()
+        return values[np.searchsorted(counts.cumsum(), ranks, side='right')]
+
+
+def stats(hist, divisor):
+    """
+    count/min/max/mean/percentiles of a Histogram in engineering units,
+    None if it is empty. Percentiles interpolate like numpy.percentile.
+    """
+    n = hist.n
+    if not n:
+        return None
+    position = (n - 1) * np.array(PERCENTILES) / 100
+    below = np.floor(position).astype(np.int64)
+    ranked = hist.ranked(np.concatenate((below, np.minimum(below + 1, n - 1))))
+    lower, upper = ranked[:len(below)], ranked[len(below):]
+    pct = (lower + (upper - lower) * (position - below)) / divisor
+    return {
+        "count": int(n),
+        "min": float(hist.min / divisor),
+        "max": float(hist.max / divisor),
+        "mean": float(hist.total / n / divisor),
+        "percentiles": {str(q): float(v) for q, v in zip(PERCENTILES, pct)},
+    }
+
+
+def unbalance_values(voltages):
+    """
+    Line voltage unbalance of the samples with every phase known, as the
+    largest deviation from the mean of the phases in percent of it (NEMA
+    definition; the PZEM gives magnitudes only), given voltage columns.
+    """
+    complete = np.logical_and.reduce([v > 0 for v in voltages])
+    phases = [v[complete] - 1 for v in voltages]
+    total = sum(phases)
+    # n * |v - mean| = |n * v - total|, in whole register units
+    deviation = np.abs(len(phases) * phases[0] - total)
+    for v in phases[1:]:
+        np.maximum(deviation, np.abs(len(phases) * v - total), out=deviation)
+    valid = total > 0
+    return deviation[valid] / total[valid] * 100
+
+
+def load_duration(hist, divisor):
+    """
+    Load-duration curve of a power Histogram: the power exceeded for a
+    given share of the samples (about the share of time at a fixed sample
+    interval).
+    """
+    n = hist.n
+    if not n:
+        return None
+    percent = np.linspace(0, 100, DURATION_POINTS)
+    # Descending rank k is ascending rank n - 1 - k
+    ranks = n - 1 - np.round(percent / 100 * (n - 1)).astype(np.int64)
+    return {"percent_time": percent.tolist(), "power": (hist.ranked(ranks) / divisor).tolist()}
+
+
+class Demand:
+    """
+    Highest average power over DEMAND_WINDOW, rolled on by the minute like
+    a demand meter: energy (trapezoids, none across gaps or next to unknown
+    power) is summed per minute since the epoch, by the minute each
+    interval ends in, then over every DEMAND_WINDOW of whole minutes in the
+    selection. Chunks are added in time order; the per-minute totals and
+    the last sample are all that is kept of them.
+    """
+
+    def __init__(self, names):
+        self.minutes = DEMAND_WINDOW // 60
+        self.per_minute = {name: np.zeros(0) for name in names}
+        # Minute of per_minute[...][0]
+        self.origin = None
+        # (timestamp, {name: power}) of the last sample, for the interval
+        # to the next chunk
+        self.prev = None
+
+    def _accumulate(self, name, first, sums):
+        """Adds per-minute sums starting at minute `first`."""
+        if self.origin is None:
+            self.origin = first
+        if first < self.origin:
+            pad = np.zeros(self.origin - first)
+            self.per_minute = {k: np.concatenate((pad, v)) for k, v in self.per_minute.items()}
+            self.origin = first
+        k = first - self.origin
+        total = self.per_minute[name]
+        if len(total) < k + len(sums):
+            # Grown geometrically; the zeros past the end are harmless
+            total = np.concatenate((total, np.zeros(max(k + len(sums), 2 * len(total)) - len(total))))
+            self.per_minute[name] = total
+        total[k:k + len(sums)] += sums
+
+    def add(self, t, powers):
+        """Adds a chunk: timestamps and {name: power in W, NaN where unknown}."""
+        if self.prev is not None:
+            prev_t, prev_p = self.prev
+            t = np.concatenate(([prev_t], t))
+            powers = {name: np.concatenate(([prev_p.get(name, np.nan)], p)) for name, p in powers.items()}
+        self.prev = (float(t[-1]), {name: float(p[-1]) for name, p in powers.items()})
+        if len(t) < 2:
+            return
+        dt = np.diff(t)
+        dt[(dt > energy.GAP) | (dt < 0)] = 0
+        minute = np.ceil(t[1:] / 60).astype(np.int64) - 1
+        first = int(minute.min())
+        minute -= first
+        for name, p in powers.items():
+            joules = (p[:-1] + p[1:]) * dt
+            joules[np.isnan(joules)] = 0
+            self._accumulate(name, first, np.bincount(minute, weights=joules))
+
+    def merge(self, origin, per_minute, prev):
+        """Adds the per-minute totals and last sample of another Demand."""
+        for name, sums in per_minute.items():
+            if name in self.per_minute and len(sums):
+                self._accumulate(name, origin, sums)
+        if prev is not None and (self.prev is None or prev[0] > self.prev[0]):
+            self.prev = prev
+
+    def peak(self, name, first_t, last_t):
+        """{power, timestamp (end of the window)} of a series, None if too short."""
+        first = int(np.ceil(first_t / 60))
+        # Whole minutes between the first and the last sample
+        n_minutes = int((last_t - first * 60) // 60)
+        if n_minutes < self.minutes:
+            return None
+        per_minute = np.zeros(n_minutes)
+        if self.origin is not None:
+            stored = self.per_minute[name]
+            lo, hi = max(first, self.origin), min(first + n_minutes, self.origin + len(stored))
+            if lo < hi:
+                per_minute[lo - first:hi - first] = stored[lo - self.origin:hi - self.origin]
+        cumulative = np.concatenate(([0.0], per_minute.cumsum()))
+        demand = (cumulative[self.minutes:] - cumulative[:-self.minutes]) / (2 * DEMAND_WINDOW)
+        j = int(demand.argmax())
+        return {"power": float(demand[j]), "timestamp": float((first + j + self.minutes) * 60)}
+
+
+def _watts(column):
+    """A power column in W, NaN where unknown."""
+    power = (column - 1) / FIELDS['p']
+    power[column == 0] = np.nan
+    return power
+
+
+class Analysis:
+    """
+    All statistics of a selection, accumulated from chunks of columns()
+    and merged with other analyses (dump/merge).
+    """
+
+    def __init__(self, addresses):
+        self.addresses = list(addresses)
+        self.phases = derived.phases(self.addresses)
+        self.hists = {(a, field): Histogram() for a in self.addresses for field in FIELDS}
+        self.neutral = Histogram()
+        self.total = Histogram()
+        self.unbalance = Histogram()
+        self.over_limit = 0
+        self.demand = Demand([str(a) for a in self.addresses] + ['total'])
+        self.samples = 0
+        self.start = self.end = None
+
+    def add(self, cols):
+        t = cols['timestamp']
+        self.samples += len(t)
+        self._span(t[0], t[-1])
+        for (a, field), hist in self.hists.items():
+            hist.add(_known(cols[f'p{a}_{field}']))
+        self.neutral.add(_known(cols['neutral_i']))
+        powers = {str(a): _watts(cols[f'p{a}_p']) for a in self.addresses}
+
+        if len(self.phases) > 1:
+            unbalance = unbalance_values([cols[f'p{a}_v'] for a in self.phases])
+            self.unbalance.add(np.rint(unbalance * _UNBALANCE_DIVISOR).astype(np.int64))
+            self.over_limit += int(np.count_nonzero(unbalance > UNBALANCE_LIMIT))
+
+        # Total of the phases that answered
+        total = np.zeros(len(t), dtype=np.int64)
+        answered = np.zeros(len(t), dtype=bool)
+        for a in self.phases:
+            p = cols[f'p{a}_p']
+            total += p
+            total -= p > 0
+            answered |= p > 0
+        self.total.add(total[answered])
+        powers['total'] = _watts(np.where(answered, total + 1, 0))
+        self.demand.add(t, powers)
+
+    def _span(self, start, end):
+        self.start = start if self.start is None else min(self.start, start)
+        self.end = end if self.end is None else max(self.end, end)
+
+    def _keyed_histograms(self):
+        keys = {'v': 0, 'i': 1, 'p': 2}
+        keyed = {a * 4 + keys[field]: hist for (a, field), hist in self.hists.items()}
+        keyed.update({_NEUTRAL: self.neutral, _TOTAL: self.total, _UNBALANCE: self.unbalance})
+        return keyed
+
+    def dump(self):
+        """The analysis as bytes for merge(): histograms, per-minute energy and last sample."""
+        hists = [(key, hist) for key, hist in self._keyed_histograms().items() if hist.n]
+        ints, arrays = [], []
+        for key, hist in hists:
+            values, counts = hist.items()
+            # Ascending values as steps, which compress well
+            ints += [key, hist.n, hist.total, hist.min, hist.max, len(values)]
+            arrays += [np.diff(values, prepend=0), counts]
+        arrays = np.concatenate(arrays) if arrays else np.zeros(0, dtype=np.int64)
+        # All in the narrowest type that holds them, read back in one go
+        largest = int(arrays.max()) if len(arrays) else 0
+        width = next(w for w, dtype in enumerate(_WIDTHS) if largest <= np.iinfo(dtype).max)
+        ints = [self.samples, self.over_limit, len(hists), width] + ints
+
+        demand = self.demand
+        prev_t, prev_p = demand.prev or (np.nan, {})
+        floats = [np.array([self.start, self.end, np.nan if demand.origin is None else demand.origin,
+                            prev_t, len(demand.per_minute)])]
+        for name, sums in demand.per_minute.items():
+            sums = np.trim_zeros(sums, 'b')
+            key = _TOTAL if name == 'total' else int(name)
+            floats += [np.array([key, prev_p.get(name, np.nan), len(sums)]), sums]
+
+        floats = np.concatenate(floats).astype('<f8')
+        return zlib.compress(_SIZES.pack(len(ints), len(floats)) + np.array(ints, dtype='<i8').tobytes()
+                             + floats.tobytes() + arrays.astype(_WIDTHS[width]).tobytes())
+
+    def merge(self, data):
+        """Adds an analysis from dump(), e.g. a stored hour summary."""
+        raw = zlib.decompress(data)
+        n_ints, n_floats = _SIZES.unpack_from(raw)
+        offset = _SIZES.size
+        ints = np.frombuffer(raw, dtype='<i8', count=n_ints, offset=offset).tolist()
+        offset += 8 * n_ints
+        floats = np.frombuffer(raw, dtype='<f8', count=n_floats, offset=offset)
+        arrays = np.frombuffer(raw, dtype=_WIDTHS[ints[3]], offset=offset + 8 * n_floats)
+
+        self.samples += ints[0]
+        self.over_limit += ints[1]
+        hists = self._keyed_histograms()
+        offset = 0
+        for pos in range(4, 4 + 6 * ints[2], 6):
+            key, n, total, low, high, k = ints[pos:pos + 6]
+            # Sensors not configured here are skipped
+            if key in hists:
+                hists[key].merge(n, total, low, high, arrays[offset:offset + k],
+                                 arrays[offset + k:offset + 2 * k], steps=True)
+            offset += 2 * k
+
+        start, end, origin, prev_t, n_series = floats[:5]
+        self._span(float(start), float(end))
+        per_minute, prev_p = {}, {}
+        pos = 5
+        for _ in range(int(n_series)):
+            key, power, length = floats[pos:pos + 3]
+            name = 'total' if key == _TOTAL else str(int(key))
+            per_minute[name] = floats[pos + 3:pos + 3 + int(length)]
+            prev_p[name] = float(power)
+            pos += 3 + int(length)
+        self.demand.merge(None if np.isnan(origin) else int(origin), per_minute,
+                          None if np.isnan(prev_t) else (float(prev_t), prev_p))
+
+    def result(self):
+        """The statistics as a JSON-ready dict, None without samples."""
+        if not self.samples:
+            return None
+        phases = {}
+        for a in self.addresses:
+            v, i, p = (self.hists[(a, field)] for field in FIELDS)
+            if not v.n and not p.n:
+                continue
+            phases[str(a)] = {"voltage": stats(v, FIELDS['v']),
+                              "current": stats(i, FIELDS['i']),
+                              "power": stats(p, FIELDS['p']),
+                              "peak_demand": self.demand.peak(str(a), self.start, self.end)}
+
+        unbalance = stats(self.unbalance, _UNBALANCE_DIVISOR)
+        if unbalance is not None:
+            unbalance["limit"] = UNBALANCE_LIMIT
+            unbalance["percent_over_limit"] = float(self.over_limit / self.unbalance.n * 100)
+
+        neutral = stats(self.neutral, storage.NEUTRAL_DIVISOR)
+        if neutral is not None:
+            currents = [self.hists[(a, 'i')] for a in self.phases]
+            n_current = sum(hist.n for hist in currents)
+            mean_phase = (sum(hist.total for hist in currents) / n_current / FIELDS['i']
+                          if n_current else 0)
+            neutral["ratio_to_phase_mean"] = float(neutral["mean"] / mean_phase) if mean_phase else None
+
+        return {
+            "start": float(self.start),
+            "end": float(self.end),
+            "samples": int(self.samples),
+            "phases": phases,
+            "voltage_unbalance": unbalance,
+            "load_duration": load_duration(self.total, FIELDS['p']),
+            "peak_demand": self.demand.peak('total', self.start, self.end) if self.total.n else None,
+            "neutral": neutral,
+        }
+
+
+class HourSummaries:
+    """
+    Analyses of the stored samples per SUMMARY_BUCKET and event (event_id
+    0 outside events) in the analytics_1h table, updated on the flush
+    transaction like the energy buckets. The interval to the first sample
+    of a batch is carried over from the previous one (after a restart,
+    from the newest stored sample).
+    """
+
+    def __init__(self, addresses):
+        self.addresses = addresses
+        self._prev = None
+        self._loaded = False
+
+    def invalidate(self):
+        """Drops the carried-over sample; the next batch reloads it from the DB."""
+        self._prev = None
+        self._loaded = False
+
+    def record(self, conn, rows):
+        """Adds packed (timestamp, event_id, data) rows, oldest first, on the caller's transaction."""
+        if not rows:
+            return
+        if not self._loaded:
+            last = conn.execute("SELECT timestamp, data FROM samples WHERE timestamp < ? "
+                                "ORDER BY timestamp DESC LIMIT 1", (rows[0][0],)).fetchone()
+            if last is not None:
+                analysis = Analysis(self.addresses)
+                analysis.add(_row_columns([last], self.addresses))
+                self._prev = analysis.demand.prev
+            self._loaded = True
+
+        cols = _row_columns([(ts, data) for ts, _, data in rows], self.addresses)
+        buckets = cols['timestamp'] // SUMMARY_BUCKET * SUMMARY_BUCKET
+        events = np.array([event_id or 0 for _, event_id, _ in rows])
+        cuts = np.flatnonzero((buckets[1:] != buckets[:-1]) | (events[1:] != events[:-1])) + 1
+        bounds = [0] + cuts.tolist() + [len(rows)]
+        analyses = {}
+        for lo, hi in zip(bounds[:-1], bounds[1:]):
+            key = (float(buckets[lo]), int(events[lo]))
+            analysis = analyses.setdefault(key, Analysis(self.addresses))
+            analysis.demand.prev = self._prev
+            analysis.add({name: values[lo:hi] for name, values in cols.items()})
+            self._prev = analysis.demand.prev
+
+        for (bucket, event_id), analysis in analyses.items():
+            stored = conn.execute("SELECT data FROM analytics_1h WHERE bucket = ? AND event_id = ?",
+                                  (bucket, event_id)).fetchone()
+            if stored is not None:
+                analysis.merge(stored[0])
+            conn.execute("INSERT OR REPLACE INTO analytics_1h (bucket, event_id, data) VALUES (?, ?, ?)",
+                         (bucket, event_id, analysis.dump()))
+
+
+def analyze(parts, addresses):
+    """
+    All statistics of DatabaseHandler.iter_analytics_parts output, None
+    without samples.
+    """
+    analysis = Analysis(addresses)
+    for kind, value, start, end in parts:
+        if kind == 'summary':
+            analysis.merge(value)
+            continue
+        cols = columns(kind, value, addresses, start, end)
+        if cols is not None:
+            analysis.add(cols)
+    return analysis.result()
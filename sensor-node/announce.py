@@ -0,0 +1,51 @@
+import json
+import socket
+import threading
+
+# Dashboards listen for announcements on this UDP port
+ANNOUNCE_PORT = 25501
+SERVICE = "voltwise-node"
+
+
+def identity(port, sensors):
+    """What a node says about itself, in announcements and /api/identity."""
+    return {
+        "service": SERVICE,
+        "hostname": socket.gethostname(),
+        "port": port,
+        "sensors": list(sensors),
+    }
+
+
+class Announcer:
+    """
+    Broadcasts the node's identity on the local network every `interval`
+    seconds, so dashboards find it without scanning the subnet.
+    """
+
+    def __init__(self, port, sensors, interval):
+        self.message = json.dumps(identity(port, sensors)).encode()
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        try:
+            while not self._stop.is_set():
+                try:
+                    sock.sendto(self.message, ('<broadcast>', ANNOUNCE_PORT))
+                except OSError as e:
+                    # No network yet (e.g. right after boot); try again later
+                    print(f"Error sending announcement: {e}")
+                self._stop.wait(self.interval)
+        finally:
+            sock.close()
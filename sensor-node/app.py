@@ -1,23 +1,115 @@
-from flask import Flask, render_template, jsonify, request
+from flask import Flask, Response, render_template, jsonify, request
 import time
 import threading
 import math
+import atexit
+import functools
+import queue
 import config
-from modbus_handler import PZEMHandler
-from database_handler import DatabaseHandler
+from acquisition import MultiBusReader, configured_buses
+from broadcast import Broadcaster
+from database_handler import DatabaseHandler, LOG_COLUMNS, SENSOR_ADDRESSES, build_log_row
+import export
+from maintenance import MaintenanceWorker
+import announce
+from scheduler import TickScheduler
+from ring_buffer import SampleRing
+import downsample
+try:
+    import analytics
+    import derived
+except ImportError:
+    # NumPy missing: /api/analytics and ?derived=1 answer 501
+    analytics = derived = None
 
 app = Flask(__name__)
+PORT = 25500
 
 # Global State
 latest_data = {}
 current_event_id = None
+# (start_at, event_id) of a recording scheduled to begin on a later tick
+pending_start = None
+# Event metadata served with incremental log updates, keyed by event id.
+# Entries are dropped whenever the event row changes.
+event_cache = {}
 db = DatabaseHandler()
-pzem = PZEMHandler(config.SERIAL_PORT, config.SENSOR_ADDRESSES)
+# One reader per serial bus, polled concurrently (see SERIAL_BUSES)
+pzem = MultiBusReader(configured_buses())
+# Sampling clock: ticks on absolute deadlines every SAMPLE_INTERVAL seconds
+scheduler = TickScheduler(getattr(config, 'SAMPLE_INTERVAL', 1.0))
+# Samples waiting to be written by background_writer. Bounded so a stuck
+# DB can't exhaust memory; when full the oldest queued sample is dropped.
+sample_queue = queue.Queue(maxsize=getattr(config, 'SAMPLE_QUEUE_SIZE', 3600))
+dropped_samples = 0
+# Pushes every new sample to the /api/stream subscribers
+broadcaster = Broadcaster(getattr(config, 'MAX_STREAMS', 8))
+
+# The last RING_BUFFER_HOURS of samples in memory, serving /api/history
+# without touching the disk. Seeded from the DB so it survives restarts.
+ring = SampleRing(LOG_COLUMNS, int(getattr(config, 'RING_BUFFER_HOURS', 6) * 3600 / scheduler.interval),
+                  integer=[col for col in LOG_COLUMNS if col == 'event_id' or col.endswith(('_e', '_alarm'))])
+for _row in reversed(db.get_logs(limit=ring.capacity)):
+    ring.append(tuple(_row[col] for col in LOG_COLUMNS))
+
+# Background components, owned by the process and started once by
+# start_background(), whichever server runs the app
+_background = {}
+
+def start_background():
+    """Starts acquisition, the DB writer and housekeeping threads."""
+    if _background:
+        return
+    print("Starting background poller thread...")
+    _background['poller'] = threading.Thread(target=background_poller, name="poller", daemon=True)
+    _background['writer'] = threading.Thread(target=background_writer, name="writer", daemon=True)
+    _background['poller'].start()
+    _background['writer'].start()
+
+    print("Starting database maintenance thread...")
+    _background['maintenance'] = MaintenanceWorker(db)
+    _background['maintenance'].start()
+
+    announce_interval = getattr(config, 'ANNOUNCE_INTERVAL', None)
+    if announce_interval:
+        _background['announcer'] = announce.Announcer(PORT, pzem.addresses, announce_interval)
+        _background['announcer'].start()
+
+def stop_background(timeout=5):
+    """
+    Stops the background threads and writes out every queued and
+    buffered sample. Runs on interpreter shutdown.
+    """
+    scheduler.stop()
+    for name in ('maintenance', 'announcer'):
+        if name in _background:
+            _background[name].stop()
+    if 'poller' in _background:
+        _background['poller'].join(timeout)
+    if 'writer' in _background:
+        # The writer exits once it reaches the sentinel, i.e. after
+        # everything queued before it
+        sample_queue.put(None)
+        _background['writer'].join(timeout)
+    _background.clear()
+
+    # Whatever the writer didn't get to
+    while True:
+        try:
+            item = sample_queue.get_nowait()
+        except queue.Empty:
+            break
+        if item is not None:
+            write_item(item)
+    db.close()
+
+atexit.register(stop_background)
 
 def calculate_neutral(i1, i2, i3):
     """
     Calculates Neutral Current for 3-phase system assuming 120 degree shift.
     Formula: sqrt(i1^2 + i2^2 + i3^2 - (i1*i2 + i2*i3 + i3*i1))
+    Used for live samples when NumPy (derived.py) is missing.
     """
     try:
         val = (i1**2 + i2**2 + i3**2) - (i1*i2 + i2*i3 + i3*i1)
@@ -27,52 +119,173 @@ def calculate_neutral(i1, i2, i3):
         return 0.0
 
 def background_poller():
-    global latest_data, current_event_id
+    """
+    Acquisition loop. Reads all sensors on every scheduler tick, stamps
+    the sample with the tick time and hands it to background_writer, so
+    slow DB writes never delay the next reading.
+    """
+    global latest_data, current_event_id, pending_start
     while True:
+        timestamp = scheduler.wait()
+        if timestamp is None:
+            break
+        # A scheduled start takes effect on the tick nearest to start_at,
+        # so nodes whose clocks differ by less than half an interval all
+        # start on the same sample slot
+        start = pending_start
+        if start and timestamp + scheduler.interval / 2 >= start[0]:
+            current_event_id = start[1]
+            pending_start = None
+            # Written by the writer, ahead of the event's first sample: a
+            # locked DB must not stall or kill the sampling thread
+            enqueue(functools.partial(db.set_event_start, current_event_id, timestamp))
         try:
-            timestamp = time.time()
             data = pzem.read_all()
-            
-            # Calculate Neutral if 3 phases
-            neutral_i = 0.0
-            if len(config.SENSOR_ADDRESSES) == 3:
-                # Helper to get currentsafely
-                def get_i(addr):
-                    return data.get(addr, {}).get('current', 0.0)
-                
-                i1 = get_i(config.SENSOR_ADDRESSES[0])
-                i2 = get_i(config.SENSOR_ADDRESSES[1])
-                i3 = get_i(config.SENSOR_ADDRESSES[2])
-                neutral_i = calculate_neutral(i1, i2, i3)
+            extra = {}
+            if derived:
+                # Same arithmetic as the derived series of the history
+                row = derived.add_to_rows(LOG_COLUMNS, [build_log_row(data, timestamp, current_event_id)],
+                                          SENSOR_ADDRESSES)[0]
+                item = row[:len(LOG_COLUMNS)]
+                extra = dict(zip(derived.extra_columns(SENSOR_ADDRESSES), row[len(LOG_COLUMNS):]))
+                # Stored as unknown when no phase answered; shown as 0 A
+                # live, as without NumPy
+                neutral_i = item[-1] if item[-1] is not None else 0.0
+            else:
+                # Calculate Neutral if 3 phases
+                neutral_i = 0.0
+                if len(pzem.addresses) == 3:
+                    # Helper to get currentsafely
+                    def get_i(addr):
+                        # Failed or quarantined sensors are None
+                        return (data.get(addr) or {}).get('current', 0.0)
+
+                    i1 = get_i(pzem.addresses[0])
+                    i2 = get_i(pzem.addresses[1])
+                    i3 = get_i(pzem.addresses[2])
+                    neutral_i = calculate_neutral(i1, i2, i3)
+                item = build_log_row(data, timestamp, current_event_id, neutral_i)
 
             # Update global state for API
             latest_data = {
                 "timestamp": timestamp,
                 "sensors": data,
                 "neutral_current": neutral_i,
+                "derived": extra,
                 "event_id": current_event_id
             }
+            broadcaster.publish(latest_data)
             
-            # Log to DB
-            db.log_data(data, timestamp, current_event_id, neutral_i)
+            # Keep in memory and queue for the DB writer
+            ring.append(item)
+            enqueue(item)
             
         except Exception as e:
             print(f"Error in poller: {e}")
-        
-        time.sleep(1)
+
+def enqueue(item):
+    """Queues a sample (or a DB call) for background_writer, dropping the oldest when full."""
+    global dropped_samples
+    try:
+        sample_queue.put_nowait(item)
+    except queue.Full:
+        try:
+            sample_queue.get_nowait()
+        except queue.Empty:
+            pass
+        dropped_samples += 1
+        sample_queue.put_nowait(item)
+
+def write_item(item):
+    # Queued DB calls (e.g. an event's actual start) run as they are
+    if callable(item):
+        item()
+    else:
+        db.log_row(item)
+
+def background_writer():
+    """Persists samples queued by background_poller."""
+    while True:
+        item = sample_queue.get()
+        if item is None:
+            break
+        try:
+            write_item(item)
+        except Exception as e:
+            print(f"Error in writer: {e}")
 
 # Start background thread - MOVED to __main__ to avoid reloader duplication
 # poller_thread = threading.Thread(target=background_poller, daemon=True)
 # poller_thread.start()
 
+def wants_derived():
+    # ?derived=1 adds the derived columns (see derived.py) to the logs
+    return bool(request.args.get('derived', 0, type=int))
+
+def numpy_missing():
+    return jsonify({"error": "Derived series and analytics need numpy (pip install numpy)"}), 501
+
 @app.route('/')
 def index():
-    return render_template('index.html', sensors=config.SENSOR_ADDRESSES)
+    return render_template('index.html', sensors=pzem.addresses)
 
 @app.route('/api/data')
 def get_data():
     return jsonify(latest_data)
 
+@app.route('/api/identity')
+def get_identity():
+    # Lets dashboards tell a VoltWise node from anything else on port 25500
+    return jsonify(announce.identity(PORT, pzem.addresses))
+
+@app.route('/api/stream')
+def stream_data():
+    # Server-Sent Events: one message per sample, same payload as /api/data.
+    # Each stream holds a server thread; past MAX_STREAMS clients poll.
+    messages = broadcaster.subscribe()
+    if messages is None:
+        return jsonify({"error": "Too many live streams, poll /api/data"}), 503
+    response = Response(messages, mimetype='text/event-stream',
+                        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+    response.call_on_close(broadcaster.unsubscribe)
+    return response
+
+@app.route('/api/stats')
+def get_stats():
+    # Acquisition diagnostics: per-address round-trip times, errors and
+    # quarantine state, sampling clock and DB write queue
+    return jsonify({
+        "modbus": pzem.stats(),
+        "scheduler": scheduler.stats(),
+        "queue": {"pending": sample_queue.qsize(), "dropped": dropped_samples},
+        "stream_subscribers": broadcaster.subscribers,
+    })
+
+@app.route('/api/health')
+def get_health():
+    # One-call summary for the central dashboard's health monitor
+    poll_errors = 0
+    quarantined, failing = [], []
+    for bus in pzem.stats()["buses"]:
+        for address, h in bus["addresses"].items():
+            poll_errors += h["errors"]
+            if h["quarantined"]:
+                quarantined.append(address)
+            elif h["consecutive_failures"]:
+                failing.append(address)
+    return jsonify({
+        "time": time.time(),
+        "last_sample": latest_data.get("timestamp"),
+        "recording": current_event_id is not None,
+        "event_id": current_event_id,
+        "simulation": pzem.simulation_mode,
+        "poll_errors": poll_errors,
+        "quarantined": quarantined,
+        "failing": failing,
+        "missed_ticks": scheduler.missed,
+        "queue": {"pending": sample_queue.qsize(), "dropped": dropped_samples},
+    })
+
 @app.route('/api/reset', methods=['POST'])
 def reset_energy():
     # Only allow reset if monitoring inactive? Or just do it.
@@ -105,9 +318,14 @@ def handle_events():
         event_id = db.create_event(name)
         return jsonify({"success": True, "event_id": event_id})
 
+@app.route('/api/time')
+def node_time():
+    """Node wall clock, for measuring clock offsets between machines."""
+    return jsonify({"time": time.time(), "interval": scheduler.interval})
+
 @app.route('/api/recording/start', methods=['POST'])
 def start_recording():
-    global current_event_id
+    global current_event_id, pending_start
     data = request.json
     event_id = data.get('event_id')
     
@@ -118,27 +336,52 @@ def start_recording():
     event = db.get_event_details(event_id)
     if not event:
         return jsonify({"error": "Event not found"}), 404
-        
+
+    # Optional start_at (epoch seconds, node clock) schedules the start;
+    # one that has already passed starts right away
+    start_at = data.get('start_at')
+    if start_at is not None:
+        try:
+            start_at = float(start_at)
+        except (TypeError, ValueError):
+            return jsonify({"error": "start_at must be a timestamp"}), 400
+        if start_at > time.time():
+            pending_start = (start_at, int(event_id))
+            return jsonify({"success": True, "pending": True, "start_at": start_at})
+
+    pending_start = None
     current_event_id = int(event_id)
-    return jsonify({"success": True})
+    return jsonify({"success": True, "pending": False})
 
 @app.route('/api/recording/stop', methods=['POST'])
 def stop_recording():
-    global current_event_id
+    global current_event_id, pending_start
     current_event_id = None
+    pending_start = None
     return jsonify({"success": True})
     
 @app.route('/api/recording/status')
 def recording_status():
-    return jsonify({"recording": current_event_id is not None, "event_id": current_event_id})
+    start = pending_start
+    return jsonify({
+        "recording": current_event_id is not None,
+        "event_id": current_event_id,
+        "pending_start": {"start_at": start[0], "event_id": start[1]} if start else None,
+    })
 
 @app.route('/api/events/stop', methods=['POST'])
 def stop_event():
-    global current_event_id
+    global current_event_id, pending_start
+    if not current_event_id and pending_start:
+        # Stopped before the scheduled start came around
+        db.stop_event(pending_start[1])
+        pending_start = None
+        return jsonify({"success": True})
     if not current_event_id:
         return jsonify({"error": "No event in progress"}), 400
         
     db.stop_event(current_event_id)
+    event_cache.pop(current_event_id, None)
     current_event_id = None
     return jsonify({"success": True})
 
@@ -160,17 +403,115 @@ def get_history():
         limit = int(limit)
     except:
         limit = 500
-    logs = db.get_logs(limit=limit)
+    # ?points=N reduces the rows server-side for charts
+    points = request.args.get('points', type=int)
+    # ?format=columns returns {column: [values]} instead of a list of rows
+    columnar = request.args.get('format') == 'columns'
+    derive = wants_derived()
+    if derive and derived is None:
+        return numpy_missing()
+
+    # Anything the ring buffer can answer is served from memory
+    if limit <= len(ring) or not ring.full:
+        columns = ring.latest(limit)
+        if derive:
+            derived.add_columns(columns, SENSOR_ADDRESSES)
+        names = tuple(columns)
+        if points:
+            rows = downsample.minmax_buckets(zip(*columns.values()), names,
+                                             len(columns['timestamp']), points)
+        elif columnar:
+            return jsonify(columns)
+        else:
+            rows = [dict(zip(names, row)) for row in zip(*columns.values())]
+        if columnar:
+            return jsonify({col: [row[col] for row in rows] for col in names})
+        return jsonify(rows)
+
+    if points:
+        return jsonify(db.get_logs_downsampled(points, limit=limit, derive=derive))
+    logs = db.get_logs(limit=limit, derive=derive)
     # Sort by timestamp ascending for charts
     logs.reverse()
     return jsonify(logs)
 
+@app.route('/api/logs')
+def get_logs_since():
+    """
+    Samples after the `since` cursor, oldest first, for the central
+    collector: {"columns": [...], "rows": [[...], ...], "more": bool}.
+    """
+    since = request.args.get('since', 0.0, type=float)
+    limit = max(1, min(request.args.get('limit', 1000, type=int), 10000))
+    rows = db.get_logs_after(since, limit)
+    return jsonify({"columns": LOG_COLUMNS, "rows": rows, "more": len(rows) == limit})
+
+@app.route('/api/history/range')
+def get_history_range():
+    # Long-range view: start/end epoch seconds, about `points` rows back.
+    # Picks the coarsest rollup (1m/1h/1d) that still gives enough points.
+    end = request.args.get('end', time.time(), type=float)
+    start = request.args.get('start', end - 86400, type=float)
+    points = request.args.get('points', 500, type=int)
+    # ?derived=1 applies to raw resolution only
+    derive = wants_derived()
+    if derive and derived is None:
+        return numpy_missing()
+    resolution, logs = db.get_history(start, end, max(points, 2), derive)
+    return jsonify({"resolution": resolution, "logs": logs})
+
+@app.route('/api/energy')
+def get_energy():
+    # Energy used per sensor between start and end (epoch seconds, default
+    # the last 24 h), resolved to the minute
+    end = request.args.get('end', time.time(), type=float)
+    start = request.args.get('start', end - 86400, type=float)
+    used = db.get_energy(start, end)
+    return jsonify({"start": start, "end": end, "wh": used, "total_wh": sum(used.values())})
+
+@app.route('/api/analytics')
+def get_analytics():
+    # Power quality statistics of an event (?event_id=) or a time range
+    # (start/end epoch seconds, default the last 24 h, at most
+    # ANALYTICS_MAX_DAYS), see analytics.py
+    if analytics is None:
+        return numpy_missing()
+    event_id = request.args.get('event_id', type=int)
+    if event_id:
+        start = end = None
+    else:
+        end = request.args.get('end', time.time(), type=float)
+        start = request.args.get('start', end - 86400, type=float)
+        max_days = getattr(config, 'ANALYTICS_MAX_DAYS', 31)
+        if end - start > max_days * 86400:
+            return jsonify({"error": f"Range longer than {max_days} days"}), 400
+    result = analytics.analyze(db.iter_analytics_parts(event_id, start, end), SENSOR_ADDRESSES)
+    if result is None:
+        return jsonify({"error": "No samples"}), 404
+    return jsonify(result)
+
 @app.route('/api/events/<int:event_id>', methods=['GET', 'PUT', 'DELETE'])
 def manage_event(event_id):
     if request.method == 'GET':
-        details = db.get_event_details(event_id)
-        logs = db.get_logs(event_id)
-        return jsonify({"details": details, "logs": logs})
+        # ?since=<timestamp> returns only the logs recorded after that
+        # cursor, so a polling client receives new rows only.
+        since = request.args.get('since', type=float)
+        # ?points=N reduces the logs server-side to about N chart points
+        points = request.args.get('points', type=int)
+        derive = wants_derived()
+        if derive and derived is None:
+            return numpy_missing()
+        if since is None or event_id not in event_cache:
+            event_cache[event_id] = db.get_event_details(event_id)
+        if points:
+            logs = db.get_logs_downsampled(points, event_id, since=since, derive=derive)
+        else:
+            logs = db.get_logs(event_id, since=since, derive=derive)
+        if logs:
+            cursor = logs[-1]['timestamp']
+        else:
+            cursor = since
+        return jsonify({"details": event_cache[event_id], "logs": logs, "cursor": cursor})
         
     if request.method == 'PUT':
         data = request.json
@@ -178,63 +519,90 @@ def manage_event(event_id):
         if not name:
             return jsonify({"error": "Name required"}), 400
         db.update_event(event_id, name)
+        event_cache.pop(event_id, None)
         return jsonify({"success": True})
         
     if request.method == 'DELETE':
         db.delete_event(event_id)
+        event_cache.pop(event_id, None)
         return jsonify({"success": True})
 
 @app.route('/api/events/<int:event_id>/export')
 def export_event_csv(event_id):
-    import csv
-    import io
-    from flask import Response
-    
+    """
+    Streams an event's logs (every field of every sensor and the neutral
+    current) as a download.
+    ?format=csv (default) or bin (columnar float64, see export.py)
+    ?compress=gzip compresses the stream on the fly
+    ?derived=1 adds the derived columns (see derived.py)
+    """
     event = db.get_event_details(event_id)
-    logs = db.get_logs(event_id)
-    
     if not event:
         return "Event not found", 404
-        
-    # Generate CSV
-    si = io.StringIO()
-    cw = csv.writer(si)
-    
-    # Headers
-    cw.writerow(['Timestamp', 'Voltage (V)', 'Current (A)', 'Power (W)', 'Energy (Wh)', 'Frequency (Hz)', 'PF'])
-    
-    for log in logs:
-        # Assuming sensor 1 for now, but could expand for multiple
-        cw.writerow([
-            log['timestamp'], 
-            log['p1_v'], log['p1_i'], log['p1_p'], log['p1_e'], 
-            # Freq/PF might not be logged in DB correctly if schema didn't include them?
-            # Checked schema: logs has pX_v, pX_i, pX_p, pX_e. No freq/pf in logs schema.
-            # We will just export what we have.
-        ])
-        
-    output = si.getvalue()
+
+    fmt = request.args.get('format', 'csv')
+    if fmt == 'csv':
+        encoder, mimetype, ext = export.csv_chunks, "text/csv", "csv"
+    elif fmt == 'bin':
+        encoder, mimetype, ext = export.columnar_chunks, "application/octet-stream", "bin"
+    else:
+        return jsonify({"error": "Unknown format"}), 400
+
+    derive = wants_derived()
+    if derive and derived is None:
+        return numpy_missing()
+    columns = [col for col in LOG_COLUMNS if col != 'event_id']
+    if derive:
+        columns += derived.extra_columns(SENSOR_ADDRESSES)
+    body = encoder(columns, db.iter_log_chunks(event_id, columns, derive=derive))
+    if request.args.get('compress') == 'gzip':
+        body = export.gzip_chunks(body)
+        mimetype, ext = "application/gzip", ext + ".gz"
+
     return Response(
-        output,
-        mimetype="text/csv",
-        headers={"Content-disposition": f"attachment; filename={event['name']}.csv"}
+        body,
+        mimetype=mimetype,
+        headers={"Content-disposition": f"attachment; filename={event['name']}.{ext}"}
     )
 
+def serve(host='0.0.0.0', port=PORT):
+    """
+    Production server: waitress when installed, otherwise Werkzeug's
+    threaded server without debugger or reloader.
+    """
+    threads = getattr(config, 'WSGI_THREADS', 16)
+    try:
+        from waitress import serve as waitress_serve
+    except ImportError:
+        print(f"waitress not installed, serving with Werkzeug on port {port}")
+        app.run(host=host, port=port, threaded=True, debug=False, use_reloader=False)
+        return
+    print(f"Serving with waitress on port {port} ({threads} threads)")
+    waitress_serve(app, host=host, port=port, threads=threads)
+
 if __name__ == '__main__':
+    import argparse
     import os
-    # Initialize DB (create tables)
-    db.init_db()
-    
-    # Configure debug mode here so we can check it reliably
-    app.debug = True
-    
-    # ONLY start the background poller if we are in the reloader child process
-    # or if the reloader is not being used.
-    # When debug=True, the reloader is used. The parent process (WERKZEUG_RUN_MAIN not set)
-    # just manages the child. The child process (WERKZEUG_RUN_MAIN='true') runs the app code.
-    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true' or not app.debug:
-        print("Starting background poller thread...")
-        poller_thread = threading.Thread(target=background_poller, daemon=True)
-        poller_thread.start()
-        
-    app.run(host='0.0.0.0', port=25500, debug=app.debug)
+    import signal
+    import sys
+
+    parser = argparse.ArgumentParser(description="VoltWise sensor node")
+    parser.add_argument('--dev', action='store_true',
+                        help="Flask development server with debugger and auto-reload")
+    args = parser.parse_args()
+
+    # systemd stops the service with SIGTERM; turn it into a normal exit
+    # so the atexit hook flushes buffered samples.
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    if args.dev:
+        app.debug = True
+        # ONLY start the background threads in the reloader child process.
+        # The parent process (WERKZEUG_RUN_MAIN not set) just manages the
+        # child. The child process (WERKZEUG_RUN_MAIN='true') runs the app code.
+        if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+            start_background()
+        app.run(host='0.0.0.0', port=PORT, debug=True)
+    else:
+        start_background()
+        serve()
@@ -0,0 +1,147 @@
+"""
+Compressed blocks of archived samples.
+
+Once samples are old enough, the maintenance task seals each hour of them
+into one block (per event) in the sample_blocks table. A block stores the
+samples column by column as raw register values (see storage.py):
+
+    ids, timestamps (ms)      delta-of-delta: 0 for evenly spaced samples
+    neutral and every field   delta from the previous sample
+
+Each column is written as a fixed-width integer array just wide enough for
+its largest step, and the whole block is zlib-compressed, which squeezes
+out the runs of zeros left by steady readings. Unknown values (the
+storage MISSING markers) are kept exactly. Decoding gives back the packed
+samples bit for bit, apart from timestamps being rounded to the
+millisecond.
+"""
+import itertools
+import struct
+import sys
+import zlib
+from array import array
+
+import storage
+
+FORMAT = 1
+
+_HEADER = struct.Struct('<BIB')      # format, sample count, sensor count
+_BASE = struct.Struct('<q')
+# Array typecodes by width, with the range each holds
+_WIDTHS = (('b', 1 << 7), ('h', 1 << 15), ('i', 1 << 31), ('q', 1 << 63))
+
+
+def _deltas(values):
+    return [b - a for a, b in zip(values, values[1:])]
+
+
+def _put(out, values, order):
+    """Appends a column, delta-encoded `order` times."""
+    for _ in range(order):
+        out += _BASE.pack(values[0] if values else 0)
+        values = _deltas(values)
+    lo, hi = min(values, default=0), max(values, default=0)
+    typecode = next(tc for tc, limit in _WIDTHS if -limit <= lo and hi < limit)
+    items = array(typecode, values)
+    if sys.byteorder == 'big':
+        items.byteswap()
+    out += typecode.encode()
+    out += items.tobytes()
+
+
+def _split(buf, pos, order, count):
+    """Reads a column written by _put as (bases, typecode, raw items, new pos)."""
+    bases = []
+    for _ in range(order):
+        bases.append(_BASE.unpack_from(buf, pos)[0])
+        pos += _BASE.size
+    typecode = chr(buf[pos])
+    pos += 1
+    # Each delta level is one item shorter than the one above it
+    size = max(count - order, 0) * array(typecode).itemsize
+    return bases, typecode, buf[pos:pos + size], pos + size
+
+
+def _get(buf, pos, order, count):
+    """Reads a column written by _put. Returns (values, new pos)."""
+    bases, typecode, raw, pos = _split(buf, pos, order, count)
+    items = array(typecode)
+    items.frombytes(raw)
+    if sys.byteorder == 'big':
+        items.byteswap()
+    values = items
+    for base in reversed(bases):
+        values = list(itertools.accumulate(values, initial=base))
+    return values[:count], pos
+
+
+def encode(rows):
+    """Encodes [(id, timestamp, data)] (data as packed by storage) into a block."""
+    parsed = [storage.records(data) for _, _, data in rows]
+    addresses = sorted({rec[0] for _, recs in parsed for rec in recs})
+
+    out = bytearray()
+    _put(out, [row[0] for row in rows], 2)
+    _put(out, [round(row[1] * 1000) for row in rows], 2)
+    # Shifted by one so unknown values become 0 and don't break the deltas
+    _put(out, [0 if n == storage.NEUTRAL_MISSING else n + 1 for n, _ in parsed], 1)
+    by_address = [{rec[0]: rec[1:] for rec in recs} for _, recs in parsed]
+    for address in addresses:
+        sensors = [sample.get(address, storage.MISSING) for sample in by_address]
+        for k, missing in enumerate(storage.MISSING):
+            _put(out, [0 if fields[k] == missing else fields[k] + 1 for fields in sensors], 1)
+
+    header = _HEADER.pack(FORMAT, len(rows), len(addresses)) + bytes(addresses)
+    return header + zlib.compress(bytes(out), 9)
+
+
+def _open(block):
+    """(count, addresses, decompressed columns) of a block."""
+    fmt, count, n_addresses = _HEADER.unpack_from(block)
+    if fmt != FORMAT:
+        raise ValueError(f"Unknown sample block format {fmt}")
+    addresses = block[_HEADER.size:_HEADER.size + n_addresses]
+    return count, addresses, zlib.decompress(block[_HEADER.size + n_addresses:])
+
+
+def raw_columns(block):
+    """
+    The columns of a block still delta-encoded, for vectorised decoding.
+    Returns (count, columns) with columns mapping 'id', 'timestamp' (ms),
+    'neutral' and (address, field) to (bases, typecode, little-endian
+    items): undo the deltas by prefixing each base in reverse order and
+    taking the running sum. Neutral and field values are raw register
+    values shifted by one, 0 meaning unknown.
+    """
+    count, addresses, buf = _open(block)
+    columns = {}
+    pos = 0
+    names = ['id', 'timestamp', 'neutral'] + [(a, field) for a in addresses for field in storage.FIELDS]
+    for name in names:
+        order = 2 if name in ('id', 'timestamp') else 1
+        bases, typecode, raw, pos = _split(buf, pos, order, count)
+        columns[name] = (bases, typecode, raw)
+    return count, columns
+
+
+def decode(block):
+    """Inverse of encode: [(id, timestamp, data)], oldest first."""
+    count, addresses, buf = _open(block)
+
+    ids, pos = _get(buf, 0, 2, count)
+    stamps, pos = _get(buf, pos, 2, count)
+    neutral, pos = _get(buf, pos, 1, count)
+    neutral = [n - 1 if n else storage.NEUTRAL_MISSING for n in neutral]
+    sensors = []
+    for address in addresses:
+        columns = []
+        for missing in storage.MISSING:
+            column, pos = _get(buf, pos, 1, count)
+            columns.append([v - 1 if v else missing for v in column])
+        sensors.append((address, list(zip(*columns))))
+
+    rows = []
+    for i in range(count):
+        records = [(address, *fields[i]) for address, fields in sensors if fields[i] != storage.MISSING]
+        rows.append((ids[i], stamps[i] / 1000, storage.pack_records(neutral[i], records)))
+    return rows
@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+"""
+Benchmarks the common log queries as the samples table grows.
+
+Fills a scratch database in stages and times each query after every
+stage. With the indexes in place the times should stay flat regardless
+of table size.
+
+Usage:
+    python3 benchmark_db.py                       # 100k, 1M, 5M rows
+    python3 benchmark_db.py --sizes 1000000 20000000
+"""
+import argparse
+import os
+import random
+import shutil
+import sqlite3
+import tempfile
+import time
+
+import database_handler
+from database_handler import DatabaseHandler, INSERT_SAMPLE_SQL
+import storage
+
+EVENT_ROWS = 3600
+REPEAT = 5
+
+
+def fake_rows(start_ts, count, event_id=None):
+    for k in range(count):
+        yield (start_ts + k, event_id, storage.pack(3.46, [
+            (1, (230 + random.random(), 2.0, 460.0, 1000 + k // 3600, 50.0, 0.95, 0)),
+            (2, (231 + random.random(), 4.0, 920.0, 2000 + k // 1800, 50.0, 0.95, 0)),
+            (3, (229 + random.random(), 6.0, 1380.0, 3000 + k // 1200, 50.0, 0.95, 0)),
+        ]))
+
+
+def timed(fn):
+    best = float('inf')
+    for _ in range(REPEAT):
+        started = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - started)
+    return best * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100_000, 1_000_000, 5_000_000])
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp()
+    database_handler.DB_NAME = os.path.join(workdir, 'benchmark.db')
+    db = DatabaseHandler()
+
+    # One event of fixed size at the start of the table; everything added
+    # later is background samples the queries have to skip over.
+    event_id = db.create_event("Benchmark")
+    conn = sqlite3.connect(database_handler.DB_NAME)
+    conn.executemany(INSERT_SAMPLE_SQL, fake_rows(0, EVENT_ROWS, event_id))
+    conn.execute("UPDATE events SET log_count = ? WHERE id = ?", (EVENT_ROWS, event_id))
+    conn.commit()
+    rows = EVENT_ROWS
+
+    print(f"{'rows':>12} {'event logs':>12} {'history 500':>12} {'details':>12} {'1h range':>12}")
+    for size in sorted(args.sizes):
+        if size > rows:
+            conn.executemany(INSERT_SAMPLE_SQL, fake_rows(rows, size - rows))
+            conn.commit()
+            rows = size
+
+        t_event = timed(lambda: db.get_logs(event_id))
+        t_history = timed(lambda: db.get_logs(limit=500))
+        t_details = timed(lambda: db.get_event_details(event_id))
+        t_range = timed(lambda: db.get_history(rows - 3600, rows, 500))
+        print(f"{rows:>12,} {t_event:>10.1f}ms {t_history:>10.1f}ms {t_details:>10.1f}ms {t_range:>10.1f}ms")
+
+    conn.close()
+    db.close()
+    shutil.rmtree(workdir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+"""
+Measures how many requests per second a running node serves.
+
+Each client is a thread with its own keep-alive connection, sending
+requests back to back for a fixed time. Start the node first (in the mode
+to be measured), then run this on the same machine or another one:
+
+Usage:
+    python3 app.py &                        # production server
+    python3 benchmark_http.py               # 1, 4, 16 clients, 10 s each
+    python3 benchmark_http.py --host 192.168.1.50 --clients 8 32 --duration 30
+"""
+import argparse
+import http.client
+import threading
+import time
+
+ENDPOINTS = [
+    "/api/data",
+    "/api/history?limit=500",
+    "/api/history?limit=3600&points=500",
+]
+
+
+def client(host, port, path, deadline, latencies, errors):
+    conn = http.client.HTTPConnection(host, port, timeout=10)
+    while time.perf_counter() < deadline:
+        started = time.perf_counter()
+        try:
+            conn.request("GET", path)
+            resp = conn.getresponse()
+            resp.read()
+            if resp.status != 200:
+                errors.append(resp.status)
+                continue
+        except (OSError, http.client.HTTPException) as e:
+            errors.append(str(e))
+            conn.close()
+            conn = http.client.HTTPConnection(host, port, timeout=10)
+            continue
+        latencies.append(time.perf_counter() - started)
+    conn.close()
+
+
+def run(host, port, path, clients, duration):
+    latencies, errors = [], []
+    deadline = time.perf_counter() + duration
+    threads = [threading.Thread(target=client, args=(host, port, path, deadline, latencies, errors))
+               for _ in range(clients)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    latencies.sort()
+
+    def pct(p):
+        return latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000 if latencies else float('nan')
+
+    return len(latencies) / duration, pct(0.5), pct(0.95), len(errors)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=25500)
+    parser.add_argument('--clients', type=int, nargs='+', default=[1, 4, 16])
+    parser.add_argument('--duration', type=float, default=10.0)
+    parser.add_argument('--endpoints', nargs='+', default=ENDPOINTS)
+    args = parser.parse_args()
+
+    print(f"{'endpoint':<38} {'clients':>7} {'req/s':>9} {'p50':>9} {'p95':>9} {'errors':>7}")
+    for path in args.endpoints:
+        for clients in args.clients:
+            rps, p50, p95, errors = run(args.host, args.port, path, clients, args.duration)
+            print(f"{path:<38} {clients:>7} {rps:>9.1f} {p50:>7.1f}ms {p95:>7.1f}ms {errors:>7}")
+
+
+if __name__ == "__main__":
+    main()
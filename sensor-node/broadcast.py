@@ -0,0 +1,63 @@
+import json
+import threading
+
+
+class Broadcaster:
+    """
+    Fans live samples out to any number of Server-Sent Events streams.
+
+    Each sample is serialised once in publish() and every subscriber just
+    picks up the latest message, so the per-sample cost doesn't grow with
+    the number of open browsers. A subscriber that falls behind skips to
+    the newest sample instead of queueing old ones.
+
+    Every open stream holds a server thread, so at most max_subscribers
+    (None: no limit) are handed out at once.
+    """
+
+    # Seconds without a sample before a keep-alive comment is sent, so
+    # proxies don't close idle streams and dead clients get noticed
+    KEEPALIVE = 15
+
+    def __init__(self, max_subscribers=None):
+        self.max_subscribers = max_subscribers
+        self._cond = threading.Condition()
+        self._seq = 0
+        self._message = None
+        self.subscribers = 0
+
+    def publish(self, payload):
+        message = f"data: {json.dumps(payload)}\n\n"
+        with self._cond:
+            self._seq += 1
+            self._message = message
+            self._cond.notify_all()
+
+    def subscribe(self):
+        """
+        Generator of SSE messages, starting with the latest sample, or None
+        when max_subscribers streams are open. The slot is taken right
+        away; call unsubscribe() once the stream is closed.
+        """
+        with self._cond:
+            if self.max_subscribers is not None and self.subscribers >= self.max_subscribers:
+                return None
+            self.subscribers += 1
+        return self._messages()
+
+    def unsubscribe(self):
+        with self._cond:
+            self.subscribers -= 1
+
+    def _messages(self):
+        seq = 0
+        while True:
+            with self._cond:
+                if self._seq == seq:
+                    self._cond.wait(self.KEEPALIVE)
+                if self._seq == seq:
+                    message = ": keep-alive\n\n"
+                else:
+                    seq = self._seq
+                    message = self._message
+            yield message
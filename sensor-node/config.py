@@ -9,6 +9,22 @@ SENSOR_ADDRESSES = [1, 2, 3]
 # On Raspberry Pi with direct GPIO (UART): '/dev/ttyS0' or '/dev/serial0'
 SERIAL_PORT = '/dev/ttyAMA0'
 
+# Multiple serial buses (optional)
+# Each bus is polled by its own worker thread, in parallel, so adding a
+# second adapter doubles the sensors that fit in one poll cycle. Sensor
+# addresses must be unique across buses. When set, this replaces
+# SERIAL_PORT and SENSOR_ADDRESSES.
+# SERIAL_BUSES = [
+#     {'port': '/dev/ttyUSB0', 'addresses': [1, 2, 3]},
+#     {'port': '/dev/ttyUSB1', 'addresses': [4, 5, 6]},
+# ]
+SERIAL_BUSES = None
+
+# Sensors on the L1, L2 and L3 phases, from which the neutral current and
+# the current imbalance are derived. None uses the first three sensors;
+# with fewer, the missing phases count as 0 A.
+PHASE_ADDRESSES = None
+
 # Modbus Configuration
 BAUDRATE = 9600
 BYTESIZE = 8
@@ -16,5 +32,78 @@ PARITY = 'N'
 STOPBITS = 1
 TIMEOUT = 0.5
 
+# Sensors that fail MODBUS_QUARANTINE_AFTER reads in a row are skipped and
+# retried after MODBUS_RETRY_BASE seconds, doubling up to MODBUS_RETRY_MAX,
+# so one dead sensor doesn't eat the poll cycle of the others.
+MODBUS_QUARANTINE_AFTER = 3
+MODBUS_RETRY_BASE = 2.0
+MODBUS_RETRY_MAX = 60.0
+
+# Sampling
+# Seconds between samples (e.g. 0.5, 1, 5). Samples are taken on fixed
+# deadlines, so timestamps are evenly spaced regardless of read time.
+SAMPLE_INTERVAL = 1.0
+# Samples that may wait for the DB writer before the oldest are dropped
+SAMPLE_QUEUE_SIZE = 3600
+
+# Hours of recent samples kept in memory for live charts and /api/history.
+# Fixed cost of 8 bytes per column and sample: 7 columns per sensor plus 3,
+# i.e. ~4.1 MB for 3 sensors over 6 h at 1 Hz.
+RING_BUFFER_HOURS = 6
+
+# Database write batching
+# Samples are buffered in memory and written in one transaction once
+# DB_BATCH_SIZE rows are queued or the oldest queued row is
+# DB_FLUSH_INTERVAL seconds old. DB_FLUSH_INTERVAL is therefore the most
+# data (in seconds) that can be lost on a power cut.
+DB_BATCH_SIZE = 60
+DB_FLUSH_INTERVAL = 30
+
+# Data retention
+# Raw 1 Hz samples that are not part of an event are deleted after
+# RETENTION_RAW_DAYS. Samples recorded during an event are kept until the
+# event is deleted. Rollups, the per-minute/hour energy totals and the
+# hourly analytics summaries are kept per table; None keeps them forever.
+# Energy windows reaching past energy_1m are resolved to the hour.
+RETENTION_RAW_DAYS = 30
+RETENTION_ROLLUP_DAYS = {
+    'logs_1m': 90,
+    'logs_1h': 365 * 5,
+    'logs_1d': None,
+    'energy_1m': 90,
+    'energy_1h': None,
+    'analytics_1h': 90,
+}
+
+# Archive tier
+# Samples older than ARCHIVE_AFTER_HOURS are sealed into compressed
+# per-hour blocks (see archive.py), several times smaller than the stored
+# rows. They are still returned by every query, just slower to read, so
+# keep this past the time ranges usually charted at full resolution.
+# None keeps all samples as rows.
+ARCHIVE_AFTER_HOURS = 48
+
+# Longest time range /api/analytics accepts (days). Whole hours are served
+# from the hourly summaries; this bounds the raw samples read for hours
+# without one (recorded before the summaries existed, or without NumPy).
+ANALYTICS_MAX_DAYS = 31
+
+# Background maintenance: how often it runs (seconds) and how many rows it
+# deletes per transaction
+MAINTENANCE_INTERVAL = 3600
+MAINTENANCE_CHUNK_ROWS = 500
+
+# Seconds between UDP broadcasts announcing this node to dashboards on
+# the local network. None disables announcements (dashboards then find
+# the node by scanning).
+ANNOUNCE_INTERVAL = 30
+
+# Requests the production server handles at once. Every open live
+# stream (/api/stream) occupies one for as long as it stays connected, so
+# at most MAX_STREAMS are accepted; further browsers get a 503 and poll
+# /api/data instead. Keep it well below WSGI_THREADS.
+WSGI_THREADS = 16
+MAX_STREAMS = 8
+
 # Debug Configuration
 DEBUG_MODE = False
@@ -1,54 +1,251 @@
 import sqlite3
+import threading
 import time
 import os
+import itertools
+import math
+import archive
+import config
+import downsample
+import energy
+import rollups
+import migrations
+import storage
+from acquisition import configured_buses
+try:
+    import analytics
+    import derived
+except ImportError:
+    # NumPy missing: derive=True is unavailable (app.py answers 501) and
+    # no analytics summaries are kept
+    analytics = derived = None
 
 DB_NAME = "energy_data.db"
 
+# Sensors whose readings make up a log row, in bus order
+SENSOR_ADDRESSES = tuple(a for bus in configured_buses() for a in bus['addresses'])
+
+# Column order used for buffered rows and everything read back from the
+# DB: p<address>_<field> for every configured sensor (see storage.FIELDS).
+LOG_COLUMNS = (
+    ('timestamp', 'event_id') +
+    tuple(f'p{a}_{field}' for a in SENSOR_ADDRESSES for field in storage.FIELDS) +
+    ('neutral_i',)
+)
+
+# Energy counters tracked per event (the events table has three phases)
+ENERGY_INDEXES = tuple(LOG_COLUMNS.index(col) if col in LOG_COLUMNS else None
+                       for col in ('p1_e', 'p2_e', 'p3_e'))
+
+# Analytics summaries (see analytics.HourSummaries), for retention
+ANALYTICS_TABLES = (('analytics_1h', 3600),)
+
+# (address, energy index, power index) of every sensor, for energy.EnergyMeter
+ENERGY_SENSORS = tuple((a, LOG_COLUMNS.index(f'p{a}_e'), LOG_COLUMNS.index(f'p{a}_p'))
+                       for a in SENSOR_ADDRESSES)
+
+INSERT_SAMPLE_SQL = "INSERT INTO samples (timestamp, event_id, data) VALUES (?, ?, ?)"
+SELECT_SAMPLE_SQL = "SELECT id, timestamp, event_id, data FROM samples"
+
+# Samples are sealed into blocks an hour at a time
+ARCHIVE_BLOCK = 3600
+
+def build_log_row(data_dict, timestamp, current_event_id=None, neutral_i=None):
+    """
+    Flattens a sample into a tuple in LOG_COLUMNS order.
+    data_dict: {address: reading dict or None}
+    """
+    values = []
+    for address in SENSOR_ADDRESSES:
+        reading = data_dict.get(address)
+        if reading:
+            values.extend(reading.get(key) for key in storage.READING_KEYS)
+        else:
+            values.extend(storage.NO_READING)
+    return (timestamp, current_event_id, *values, neutral_i)
+
+def pack_row(row):
+    """(timestamp, event_id, data) of a LOG_COLUMNS row, for the samples table."""
+    n = len(storage.FIELDS)
+    readings = []
+    for k, address in enumerate(SENSOR_ADDRESSES):
+        values = row[2 + k * n:2 + (k + 1) * n]
+        # Sensors that didn't answer are left out of the blob
+        if any(v is not None for v in values):
+            readings.append((address, values))
+    return row[0], row[1], storage.pack(row[-1], readings)
+
+def unpack_row(timestamp, event_id, data):
+    """A stored sample as a tuple in LOG_COLUMNS order."""
+    neutral_i, sensors = storage.unpack(data)
+    values = itertools.chain.from_iterable(
+        sensors.get(address, storage.NO_READING) for address in SENSOR_ADDRESSES)
+    return (timestamp, event_id, *values, neutral_i)
+
+def _unpack_rows(cursor):
+    """(id, *LOG_COLUMNS) tuples from a SELECT_SAMPLE_SQL cursor."""
+    for id, timestamp, event_id, data in cursor:
+        yield (id,) + unpack_row(timestamp, event_id, data)
+
+ID_LOG_COLUMNS = ('id',) + LOG_COLUMNS
+
+def _chunked(rows, size):
+    """Lists of up to `size` items of an iterable."""
+    rows = iter(rows)
+    while True:
+        chunk = list(itertools.islice(rows, size))
+        if not chunk:
+            break
+        yield chunk
+
+def _then_newer(stored, pending):
+    """
+    (id, *LOG_COLUMNS) rows of `stored`, oldest first, then those of
+    `pending` (read from the write buffer before the query) after the last
+    of them: rows flushed while the query ran are in both.
+    """
+    last = float('-inf')
+    for row in stored:
+        last = row[1]
+        yield row
+    for row in pending:
+        if row[1] > last:
+            yield row
+
+def _reduce(rows, total, points, derive=False):
+    """
+    minmax_buckets over (id, *LOG_COLUMNS) rows. derive: add the derived
+    columns (see derived.py) first, so each value belongs to one sample.
+    """
+    columns = ID_LOG_COLUMNS
+    if derive:
+        rows = itertools.chain.from_iterable(derived.add_to_rows(columns, chunk, SENSOR_ADDRESSES)
+                                             for chunk in _chunked(rows, 1000))
+        columns += derived.extra_columns(SENSOR_ADDRESSES)
+    return downsample.minmax_buckets(rows, columns, total, points)
+
+def _archived_rows(conn, where='', args=()):
+    """SELECT_SAMPLE_SQL-shaped rows from the sample blocks matching `where`, oldest first."""
+    c = conn.execute(f"SELECT event_id, data FROM sample_blocks {where} ORDER BY first_ts ASC", args)
+    for event_id, block in c:
+        for id, timestamp, data in archive.decode(block):
+            yield id, timestamp, event_id, data
+
+def _newest_archived(conn, n):
+    """The newest `n` archived samples, oldest first."""
+    if n <= 0:
+        return []
+    blocks, found = [], 0
+    c = conn.execute("SELECT event_id, data FROM sample_blocks ORDER BY last_ts DESC")
+    for event_id, block in c:
+        blocks.append([(id, timestamp, event_id, data) for id, timestamp, data in archive.decode(block)])
+        found += len(blocks[-1])
+        if found >= n:
+            break
+    rows = list(itertools.chain.from_iterable(reversed(blocks)))
+    return rows[max(len(rows) - n, 0):]
+
+def _sample_filters(event_id=None, after=None, start=None, end=None):
+    """
+    WHERE clauses selecting samples by event and time.
+    after: timestamp > after; start/end: timestamp within [start, end].
+    Returns (where, block_where, inside, args, keep): `where` for the
+    samples table; `block_where` for the sample blocks overlapping the
+    range and `inside` (a bare condition) for those entirely within it,
+    all taking `args`; `keep(timestamp)` filters the samples of the
+    overlapping blocks.
+    """
+    conds, block_conds, inside, args = [], [], [], []
+    if event_id:
+        conds.append("event_id = ?")
+        block_conds.append("event_id = ?")
+        inside.append("event_id = ?")
+        args.append(event_id)
+    if after is not None:
+        conds.append("timestamp > ?")
+        block_conds.append("last_ts > ?")
+        inside.append("first_ts > ?")
+        args.append(after)
+    if start is not None:
+        conds.append("timestamp >= ?")
+        block_conds.append("last_ts >= ?")
+        inside.append("first_ts >= ?")
+        args.append(start)
+    if end is not None:
+        conds.append("timestamp <= ?")
+        block_conds.append("first_ts <= ?")
+        inside.append("last_ts <= ?")
+        args.append(end)
+
+    def keep(ts):
+        return ((after is None or ts > after) and (start is None or ts >= start)
+                and (end is None or ts <= end))
+
+    where = "WHERE " + " AND ".join(conds) if conds else ""
+    block_where = "WHERE " + " AND ".join(block_conds) if block_conds else ""
+    return where, block_where, " AND ".join(inside) or "1", args, keep
+
+def _iter_samples(conn, event_id=None, after=None, start=None, end=None):
+    """
+    Stored samples (SELECT_SAMPLE_SQL rows) selected as by _sample_filters,
+    oldest first: the archived blocks, then the samples table.
+    """
+    where, block_where, _, args, keep = _sample_filters(event_id, after, start, end)
+    for row in _archived_rows(conn, block_where, args):
+        if keep(row[1]):
+            yield row
+    yield from conn.execute(f"{SELECT_SAMPLE_SQL} {where} ORDER BY timestamp ASC", args)
+
+def _count_samples(conn, event_id=None, after=None, start=None, end=None):
+    """Number of samples _iter_samples yields for the same filters."""
+    where, block_where, inside, args, keep = _sample_filters(event_id, after, start, end)
+    count = conn.execute(f"SELECT COUNT(*) FROM samples {where}", args).fetchone()[0]
+    count += conn.execute(f"SELECT COALESCE(SUM(count), 0) FROM sample_blocks WHERE {inside}",
+                          args).fetchone()[0]
+    # Only the blocks at the edges of the range need decoding
+    block_where = block_where or "WHERE 1"
+    edges = _archived_rows(conn, f"{block_where} AND NOT ({inside})", args + args)
+    return count + sum(1 for row in edges if keep(row[1]))
+
 class DatabaseHandler:
     def __init__(self):
+        # Samples are buffered in memory and written in batches over one
+        # persistent connection, so the SD card sees one commit per batch
+        # instead of one per second.
+        self.batch_size = getattr(config, 'DB_BATCH_SIZE', 60)
+        self.flush_interval = getattr(config, 'DB_FLUSH_INTERVAL', 30)
+        self._pending = []
+        self._pending_since = None
+        self._write_lock = threading.Lock()
+        self._writer = None
+        self.energy = energy.EnergyMeter(ENERGY_SENSORS)
+        self.summaries = analytics.HourSummaries(SENSOR_ADDRESSES) if analytics else None
         self.init_db()
 
     def get_connection(self):
-        return sqlite3.connect(DB_NAME)
+        return storage.register(sqlite3.connect(DB_NAME))
+
+    def _get_writer(self):
+        """Returns the persistent connection used for batched log writes."""
+        if self._writer is None:
+            conn = storage.register(sqlite3.connect(DB_NAME, check_same_thread=False))
+            # WAL + synchronous=NORMAL: commits append to the WAL without an
+            # fsync, the SD card is only synced on checkpoints.
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._writer = conn
+        return self._writer
 
     def init_db(self):
-        """Initialize database with tables."""
+        """Initialize database with tables, migrating older schemas."""
         conn = self.get_connection()
-        c = conn.cursor()
-        
-        # Events table
-        # Stores named time periods (e.g. "Test Run 1")
-        c.execute('''
-        CREATE TABLE IF NOT EXISTS events (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            name TEXT NOT NULL,
-            start_time REAL NOT NULL,
-            end_time REAL
-        )
-        ''')
-        
-        # Logs table
-        # Stores raw sensor data. 
-        # Structure: timestamp | p1_v | p1_i | p1_p | p1_e | p2_... | p3_... | neutral_i
-        # To make it flexible for 1-3 phases, we'll just have columns for 3 phases.
-        # Unused phases will be NULL.
-        c.execute('''
-        CREATE TABLE IF NOT EXISTS logs (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            timestamp REAL NOT NULL,
-            
-            p1_v REAL, p1_i REAL, p1_p REAL, p1_e REAL,
-            p2_v REAL, p2_i REAL, p2_p REAL, p2_e REAL,
-            p3_v REAL, p3_i REAL, p3_p REAL, p3_e REAL,
-            
-            neutral_i REAL,
-            
-            event_id INTEGER,
-            FOREIGN KEY(event_id) REFERENCES events(id)
-        )
-        ''')
-        
-        conn.commit()
+
+        # Lets the maintenance task hand freed pages back to the file system
+        # in small steps. Only takes effect on new databases; existing ones
+        # need a one-off `python3 db_tool.py vacuum`.
+        conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+
+        migrations.migrate(conn)
         conn.close()
 
     def create_event(self, name):
@@ -62,6 +259,14 @@ class DatabaseHandler:
         conn.close()
         return event_id
 
+    def set_event_start(self, event_id, start_time):
+        """Moves an event's start to when its recording actually began."""
+        conn = self.get_connection()
+        c = conn.cursor()
+        c.execute("UPDATE events SET start_time = ? WHERE id = ?", (start_time, event_id))
+        conn.commit()
+        conn.close()
+
     def stop_event(self, event_id):
         """Stops an event."""
         conn = self.get_connection()
@@ -72,36 +277,137 @@ class DatabaseHandler:
 
     def log_data(self, data_dict, timestamp, current_event_id=None, neutral_i=None):
         """
-        Logs data to DB.
+        Queues a sample for the DB.
         data_dict: {1: {...}, 2: {...}, 3: {...}}
         """
-        conn = self.get_connection()
-        c = conn.cursor()
-        
-        # Helper to safely get value
-        def g(addr, key):
-            if addr in data_dict and data_dict[addr]:
-                return data_dict[addr].get(key)
-            return None
+        self.log_row(build_log_row(data_dict, timestamp, current_event_id, neutral_i))
 
-        c.execute('''
-        INSERT INTO logs (
-            timestamp, event_id,
-            p1_v, p1_i, p1_p, p1_e,
-            p2_v, p2_i, p2_p, p2_e,
-            p3_v, p3_i, p3_p, p3_e,
-            neutral_i
-        ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        ''', (
-            timestamp, current_event_id,
-            g(1, 'voltage'), g(1, 'current'), g(1, 'power'), g(1, 'energy'),
-            g(2, 'voltage'), g(2, 'current'), g(2, 'power'), g(2, 'energy'),
-            g(3, 'voltage'), g(3, 'current'), g(3, 'power'), g(3, 'energy'),
-            neutral_i
-        ))
-        
-        conn.commit()
-        conn.close()
+    def log_row(self, row):
+        """
+        Queues a row built by build_log_row for the DB.
+        The buffer is written out once it holds DB_BATCH_SIZE rows or its
+        oldest row is DB_FLUSH_INTERVAL seconds old, whichever comes first.
+        """
+        with self._write_lock:
+            if not self._pending:
+                self._pending_since = time.monotonic()
+            self._pending.append(row)
+            due = (len(self._pending) >= self.batch_size or
+                   time.monotonic() - self._pending_since >= self.flush_interval)
+            if due:
+                self._flush_locked()
+
+    def flush(self):
+        """Writes all buffered samples to the DB."""
+        with self._write_lock:
+            self._flush_locked()
+
+    def _flush_locked(self):
+        if not self._pending:
+            return
+        rows = self._pending
+        conn = self._get_writer()
+        try:
+            with conn:
+                packed = [pack_row(row) for row in rows]
+                conn.executemany(INSERT_SAMPLE_SQL, packed)
+                self._update_event_stats(conn, rows)
+                self.energy.record(conn, rows)
+                if self.summaries:
+                    self.summaries.record(conn, packed)
+                rollups.refresh(conn, min(row[0] for row in rows))
+        except sqlite3.Error as e:
+            self.energy.invalidate()
+            if self.summaries:
+                self.summaries.invalidate()
+            # Keep the rows for the next attempt, but never beyond one
+            # extra batch so a broken DB can't grow the buffer unbounded.
+            print(f"Error flushing {len(rows)} samples: {e}")
+            if len(rows) > 2 * self.batch_size:
+                del rows[:len(rows) - 2 * self.batch_size]
+            return
+        self._pending = []
+        self._pending_since = None
+
+    def _update_event_stats(self, conn, rows):
+        """Folds a batch of rows into the running per-event statistics."""
+        stats = {}
+        for row in rows:
+            event_id = row[1]
+            if event_id is None:
+                continue
+            s = stats.get(event_id)
+            if s is None:
+                # count, first ts, last ts, first/last energy per phase
+                s = stats[event_id] = [0, row[0], row[0], [None] * 3, [None] * 3]
+            s[0] += 1
+            s[2] = row[0]
+            for k, idx in enumerate(ENERGY_INDEXES):
+                if idx is not None and row[idx] is not None:
+                    if s[3][k] is None:
+                        s[3][k] = row[idx]
+                    s[4][k] = row[idx]
+
+        for event_id, (count, first, last, e_first, e_last) in stats.items():
+            conn.execute('''
+            UPDATE events SET
+                log_count = log_count + ?,
+                first_sample = COALESCE(first_sample, ?),
+                last_sample = ?,
+                p1_e_first = COALESCE(p1_e_first, ?), p1_e_last = COALESCE(?, p1_e_last),
+                p2_e_first = COALESCE(p2_e_first, ?), p2_e_last = COALESCE(?, p2_e_last),
+                p3_e_first = COALESCE(p3_e_first, ?), p3_e_last = COALESCE(?, p3_e_last)
+            WHERE id = ?
+            ''', (count, first, last,
+                  e_first[0], e_last[0], e_first[1], e_last[1], e_first[2], e_last[2],
+                  event_id))
+
+    def close(self):
+        """Flushes buffered samples and closes the writer connection."""
+        with self._write_lock:
+            self._flush_locked()
+            if self._writer is not None:
+                self._writer.close()
+                self._writer = None
+
+    def _pending_rows(self):
+        with self._write_lock:
+            return list(self._pending)
+
+    def _pending_logs(self, event_id=None):
+        """Buffered rows as log dicts (no id yet), oldest first."""
+        with self._write_lock:
+            rows = list(self._pending)
+        logs = [dict(zip(LOG_COLUMNS, row), id=None) for row in rows]
+        if event_id:
+            logs = [log for log in logs if log['event_id'] == event_id]
+        return logs
+
+    def iter_log_chunks(self, event_id, columns, chunk_size=1000, derive=False):
+        """
+        Streams an event's logs as lists of tuples in `columns` order,
+        straight from the cursor, followed by its buffered samples.
+        derive: compute the derived columns per chunk (see derived.py);
+        `columns` may then name them.
+        """
+        full = ID_LOG_COLUMNS + (derived.extra_columns(SENSOR_ADDRESSES) if derive else ())
+        idx = [full.index(col) for col in columns]
+
+        def select(chunk):
+            if derive:
+                chunk = derived.add_to_rows(ID_LOG_COLUMNS, chunk, SENSOR_ADDRESSES)
+            return [tuple(row[i] for i in idx) for row in chunk]
+
+        # Buffered rows first: a flush during the download moves them to
+        # the DB after the cursor's snapshot was taken
+        pending = [tuple(log[col] for col in ID_LOG_COLUMNS) for log in self._pending_logs(event_id)]
+        conn = self.get_connection()
+        try:
+            rows = _then_newer(_unpack_rows(_iter_samples(conn, event_id=event_id)), pending)
+            for chunk in _chunked(rows, chunk_size):
+                yield select(chunk)
+        finally:
+            conn.close()
 
     def get_events(self):
         """Returns list of all events."""
@@ -127,33 +433,384 @@ class DatabaseHandler:
             end = event['end_time'] if event['end_time'] else time.time()
             event['duration'] = round(end - event['start_time'], 1)
             
-            # Get summary stats from logs (e.g. total energy consumed during event)
-            # This requires calculating delta between first and last log entry for Energy
-            # Or just sum of Powers? Energy meter is cumulative, so Last - First.
-            
-            # Simple aggregation for now: Count logs
-            c.execute("SELECT COUNT(*) as count FROM logs WHERE event_id = ?", (event_id,))
-            count = c.fetchone()['count']
-            event['log_count'] = count
+            # log_count and first/last energy per phase are kept up to
+            # date on every flush; add the samples still in the buffer.
+            event['log_count'] += len(self._pending_logs(event['id']))
+
+            # Energy used per sensor (Wh), including the buffered samples
+            used = energy.event_totals(conn, event_id)
+            _, pending, _ = self.energy.consume(conn, self._pending_rows())
+            for (ev, address), wh in pending.items():
+                if ev == event_id:
+                    used[address] = used.get(address, 0.0) + wh
+            event['energy_wh'] = used
             
         conn.close()
         return event
 
-    def get_logs(self, event_id=None, limit=100):
-        """Get logs, optionally filtered by event."""
+    def get_energy(self, start, end):
+        """
+        Energy used per sensor (Wh) between start and end, to the minute
+        (to the hour beyond the energy_1m retention), including buffered
+        samples. A couple of index lookups per sensor, whatever the span.
+        """
+        conn = self.get_connection()
+        pending, _, _ = self.energy.consume(conn, self._pending_rows())
+        used = energy.window(conn, SENSOR_ADDRESSES, start, end, pending)
+        conn.close()
+        return used
+
+    def get_logs(self, event_id=None, limit=100, since=None, derive=False):
+        """
+        Get logs, optionally filtered by event. Includes buffered samples.
+        since: only return event logs with a timestamp after this cursor.
+        derive: add the derived columns (see derived.py).
+        """
+        # Snapshot the buffer first: rows flushed while the query runs then
+        # show up twice (and are skipped below) rather than not at all
+        pending = self._pending_logs(event_id)
         conn = self.get_connection()
-        conn.row_factory = sqlite3.Row
         c = conn.cursor()
         
         if event_id:
-            c.execute("SELECT * FROM logs WHERE event_id = ? ORDER BY timestamp ASC", (event_id,))
+            rows = list(_iter_samples(conn, event_id, after=since))
         else:
-            c.execute("SELECT * FROM logs ORDER BY timestamp DESC LIMIT ?", (limit,))
+            c.execute(f"{SELECT_SAMPLE_SQL} ORDER BY timestamp DESC LIMIT ?", (limit,))
             # Reverse to get chronological order for charts if needed, but DESC is good for "latest"
+            rows = c.fetchall()
+            if len(rows) < limit:
+                rows.extend(reversed(_newest_archived(conn, limit - len(rows))))
             
-        rows = c.fetchall()
+        logs = [dict(zip(ID_LOG_COLUMNS, row)) for row in _unpack_rows(rows)]
+        conn.close()
+
+        if event_id:
+            last = logs[-1]['timestamp'] if logs else since
+        else:
+            last = logs[0]['timestamp'] if logs else None
+        if last is not None:
+            pending = [log for log in pending if log['timestamp'] > last]
+        if event_id:
+            logs.extend(pending)
+        elif pending:
+            pending.reverse()
+            logs = (pending + logs)[:limit]
+        if derive:
+            derived.add_to_logs(logs, SENSOR_ADDRESSES)
+        return logs
+
+    def get_logs_after(self, since, limit=1000):
+        """
+        Up to `limit` rows (tuples in LOG_COLUMNS order) with a timestamp
+        after `since`, oldest first, including buffered samples. Used by the
+        central collector to pull new samples by cursor.
+        """
+        # Snapshot the buffer first: rows flushed while the query runs then
+        # show up twice (and are skipped below) rather than not at all
+        with self._write_lock:
+            pending = list(self._pending)
+        conn = self.get_connection()
+        stored = itertools.islice(_iter_samples(conn, after=since), limit)
+        rows = [unpack_row(*row[1:]) for row in stored]
+        conn.close()
+
+        last = rows[-1][0] if rows else since
+        rows.extend(row for row in pending if row[0] > last)
+        return rows[:limit]
+
+    def iter_raw_samples(self, event_id=None, start=None, end=None, chunk_size=3600):
+        """
+        The stored form of an event's or time range's samples, for bulk
+        columnar decoding (see analytics.py), one part at a time, oldest
+        first: ('block', data) for each archived block overlapping the
+        selection (whole; filter its samples by time), then ('rows',
+        [(timestamp, data)]) of up to chunk_size other samples, including
+        buffered ones.
+        """
+        where, block_where, _, args, _ = _sample_filters(event_id, start=start, end=end)
+        pending = [pack_row(row) for row in self._pending_rows()
+                   if (not event_id or row[1] == event_id)
+                   and (start is None or row[0] >= start) and (end is None or row[0] <= end)]
+        conn = self.get_connection()
+        try:
+            for (data,) in conn.execute(
+                    f"SELECT data FROM sample_blocks {block_where} ORDER BY first_ts ASC", args):
+                yield 'block', data
+            last = float('-inf')
+            cursor = conn.execute(f"SELECT timestamp, data FROM samples {where} ORDER BY timestamp ASC",
+                                  args)
+            for rows in iter(lambda: cursor.fetchmany(chunk_size), []):
+                last = rows[-1][0]
+                yield 'rows', rows
+        finally:
+            conn.close()
+        # Rows flushed since the buffer was read were already yielded
+        rows = [(ts, data) for ts, _, data in pending if ts > last]
+        if rows:
+            yield 'rows', rows
+
+    def iter_analytics_parts(self, event_id=None, start=None, end=None):
+        """
+        An event's or time range's samples for analytics.analyze, oldest
+        first, as (kind, value, start, end): ('summary', data, None, None)
+        for the stored summaries of the whole hours in the selection, and
+        the raw parts of iter_raw_samples, with the range they are limited
+        to, for the rest (partial hours at the edges, hours without a
+        summary and those with samples still buffered).
+        """
+        pending = self._pending_rows()
+        size = ANALYTICS_TABLES[0][1]
+        conds = ["bucket >= ?", "bucket < ?"]
+        conn = self.get_connection()
+        # Summaries hold flushed samples only, and none from before the
+        # table existed unless backfilled
+        row = conn.execute("SELECT value FROM meta WHERE key = 'analytics_complete_since'").fetchone()
+        args = [row[0] if row else 0, pending[0][0] // size * size if pending else float('inf')]
+        if event_id:
+            conds.append("event_id = ?")
+            args.append(event_id)
+        if start is not None:
+            conds.append("bucket >= ?")
+            args.append(start)
+        if end is not None:
+            conds.append("bucket + ? <= ?")
+            args += [size, end]
+        summaries = conn.execute(f"SELECT bucket, data FROM analytics_1h WHERE {' AND '.join(conds)} "
+                                 "ORDER BY bucket ASC", args)
+        # Raw samples are read from `raw_from` up to the next summarised hour
+        raw_from = start
+        try:
+            for bucket, group in itertools.groupby(summaries, key=lambda row: row[0]):
+                if raw_from is None or raw_from < bucket:
+                    yield from self._raw_parts(event_id, raw_from, math.nextafter(bucket, -math.inf))
+                for _, data in group:
+                    yield 'summary', data, None, None
+                raw_from = bucket + size
+        finally:
+            conn.close()
+        if raw_from is None or end is None or raw_from <= end:
+            yield from self._raw_parts(event_id, raw_from, end)
+
+    def _raw_parts(self, event_id, start, end):
+        for kind, value in self.iter_raw_samples(event_id, start, end):
+            yield kind, value, start, end
+
+    def get_logs_downsampled(self, points, event_id=None, limit=100, since=None, derive=False):
+        """
+        Like get_logs, but reduced to about `points` rows with min/max
+        buckets. Rows are streamed from the cursor, never all loaded.
+        Always returns chronological order.
+        """
+        pending = self._pending_logs(event_id)
+        conn = self.get_connection()
+        c = conn.cursor()
+
+        if event_id:
+            if since is not None:
+                pending = [log for log in pending if log['timestamp'] > since]
+            total = _count_samples(conn, event_id, after=since) + len(pending)
+            stored = _iter_samples(conn, event_id, after=since)
+        else:
+            # The newest `limit` rows, oldest first
+            pending = pending[-limit:]
+            db_limit = limit - len(pending)
+            c.execute("SELECT COUNT(*) FROM (SELECT 1 FROM samples LIMIT ?)", (db_limit,))
+            count = c.fetchone()[0]
+            archived = _newest_archived(conn, db_limit - count)
+            total = len(archived) + count + len(pending)
+            c.execute(f"SELECT * FROM ({SELECT_SAMPLE_SQL} ORDER BY timestamp DESC LIMIT ?) "
+                      "ORDER BY timestamp ASC", (db_limit,))
+            stored = itertools.chain(archived, c)
+
+        pending_rows = [tuple(log.get(col) for col in ID_LOG_COLUMNS) for log in pending]
+        logs = _reduce(_then_newer(_unpack_rows(stored), pending_rows), total, points, derive)
+        conn.close()
+        return logs
+
+    def get_history(self, start, end, points=500, derive=False):
+        """
+        Returns (resolution, logs) for the time range [start, end].
+        Uses the coarsest rollup that still yields `points` buckets;
+        short ranges are served from raw logs, downsampled to `points`.
+        resolution is the bucket size in seconds, or None for raw logs.
+        Rollups only include flushed samples.
+        derive: add the derived columns to raw logs (rollups hold
+        per-column extremes and means, which don't combine into them).
+        """
+        table, size = rollups.pick_table(start, end, points)
+        if table:
+            conn = self.get_connection()
+            logs = rollups.query(conn, table, start, end)
+            conn.close()
+            return size, logs
+
+        pending = [log for log in self._pending_logs() if start <= log['timestamp'] <= end]
+        conn = self.get_connection()
+        total = _count_samples(conn, start=start, end=end) + len(pending)
+        stored = _iter_samples(conn, start=start, end=end)
+        pending_rows = [tuple(log.get(col) for col in ID_LOG_COLUMNS) for log in pending]
+        logs = _reduce(_then_newer(_unpack_rows(stored), pending_rows), total, points, derive)
+        conn.close()
+        return None, logs
+
+    def rebuild_rollups(self):
+        """Recomputes all rollup tables from the stored samples (backfill)."""
+        self.flush()
+        conn = self.get_connection()
+        with conn:
+            not_before = self._raw_complete_since(conn)
+            rollups.refresh(conn, 0, not_before=not_before,
+                            archived=self._archived_range(conn, not_before, None))
+        conn.close()
+
+    @staticmethod
+    def _archived_range(conn, start, end):
+        """(timestamp, data) of the archived samples around [start, end] for rollups.refresh."""
+        rows = _archived_rows(conn, "WHERE last_ts >= ? AND first_ts <= ?",
+                              (start - 60, float('inf') if end is None else end + 60))
+        return ((row[1], row[3]) for row in rows)
+
+    def rebuild_energy(self):
+        """
+        Recomputes all energy accounting from the stored samples (backfill).
+        Holds up writes until done, so no flush lands in between. One
+        transaction that locks out other processes: run it with the node
+        stopped (db_tool checks), whose meter would not see the new state.
+        """
+        with self._write_lock:
+            self._flush_locked()
+            conn = self.get_connection()
+            with conn:
+                for table, _ in energy.ENERGY_TABLES:
+                    conn.execute(f"DELETE FROM {table}")
+                conn.execute("DELETE FROM event_energy")
+                conn.execute("DELETE FROM energy_state")
+                meter = energy.EnergyMeter(ENERGY_SENSORS)
+                rows = (row[1:] for row in _unpack_rows(_iter_samples(conn)))
+                while True:
+                    chunk = list(itertools.islice(rows, 10000))
+                    if not chunk:
+                        break
+                    meter.record(conn, chunk)
+            conn.close()
+            self.energy.invalidate()
+
+    def rebuild_analytics(self):
+        """
+        Recomputes the analytics summaries from the stored samples
+        (backfill). One transaction, like rebuild_energy: run it with the
+        node stopped (db_tool checks).
+        """
+        if analytics is None:
+            raise RuntimeError("Analytics summaries need numpy (pip install numpy)")
+        with self._write_lock:
+            self._flush_locked()
+            conn = self.get_connection()
+            with conn:
+                conn.execute("DELETE FROM analytics_1h")
+                summaries = analytics.HourSummaries(SENSOR_ADDRESSES)
+                rows = ((ts, event_id, data) for _, ts, event_id, data in _iter_samples(conn))
+                for chunk in _chunked(rows, 3600):
+                    summaries.record(conn, chunk)
+                conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('analytics_complete_since', 0)")
+            conn.close()
+            self.summaries.invalidate()
+
+    def _raw_complete_since(self, conn):
+        """Time from which raw logs are complete (older ones were pruned)."""
+        row = conn.execute("SELECT value FROM meta WHERE key = 'logs_pruned_before'").fetchone()
+        return row[0] if row else 0
+
+    # --- Retention ---
+    # Each call deletes at most `chunk` rows in its own short transaction so
+    # the poller's writer never waits long for the lock.
+
+    def prune_logs(self, before, chunk):
+        """
+        Deletes up to `chunk` non-event samples older than `before`, and
+        up to `chunk` archived blocks of them.
+        """
+        conn = self.get_connection()
+        with conn:
+            c = conn.execute('''
+            DELETE FROM samples WHERE id IN (
+                SELECT id FROM samples WHERE event_id IS NULL AND timestamp < ? LIMIT ?
+            )
+            ''', (before, chunk))
+            blocks = conn.execute('''
+            DELETE FROM sample_blocks WHERE id IN (
+                SELECT id FROM sample_blocks WHERE event_id IS NULL AND last_ts < ? LIMIT ?
+            )
+            ''', (before, chunk))
+            conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('logs_pruned_before', "
+                         "MAX(?, COALESCE((SELECT value FROM meta WHERE key = 'logs_pruned_before'), 0)))",
+                         (before,))
+        conn.close()
+        return max(c.rowcount, blocks.rowcount)
+
+    def archive_samples(self, before):
+        """
+        Seals the samples of the oldest hour before `before` (hour-aligned)
+        into compressed blocks, one per event, and deletes them from the
+        samples table. Returns the number of samples archived, 0 once
+        there is nothing left to archive.
+        """
+        conn = self.get_connection()
+        first = conn.execute("SELECT MIN(timestamp) FROM samples WHERE timestamp < ?", (before,)).fetchone()[0]
+        if first is None:
+            conn.close()
+            return 0
+        with conn:
+            hour = (first // ARCHIVE_BLOCK) * ARCHIVE_BLOCK
+            rows = conn.execute(f"{SELECT_SAMPLE_SQL} WHERE timestamp >= ? AND timestamp < ? "
+                                "ORDER BY timestamp ASC", (hour, hour + ARCHIVE_BLOCK)).fetchall()
+            for event_id, group in itertools.groupby(rows, key=lambda row: row[2]):
+                group = list(group)
+                conn.execute("INSERT INTO sample_blocks (first_ts, last_ts, event_id, count, data) "
+                             "VALUES (?, ?, ?, ?, ?)",
+                             (group[0][1], group[-1][1], event_id, len(group),
+                              archive.encode([(row[0], row[1], row[3]) for row in group])))
+            conn.execute("DELETE FROM samples WHERE timestamp >= ? AND timestamp < ?",
+                         (hour, hour + ARCHIVE_BLOCK))
+        conn.close()
+        return len(rows)
+
+    def prune_rollups(self, table, before, chunk):
+        """Deletes up to `chunk` rollup buckets older than `before`."""
+        conn = self.get_connection()
+        with conn:
+            c = conn.execute(f'''
+            DELETE FROM {table} WHERE bucket IN (
+                SELECT bucket FROM {table} WHERE bucket < ? LIMIT ?
+            )
+            ''', (before, chunk))
+        conn.close()
+        return c.rowcount
+
+    def incremental_vacuum(self, pages):
+        """
+        Returns up to `pages` free pages to the file system.
+        Returns the number of free pages left, or None if the DB was not
+        created with auto_vacuum=INCREMENTAL.
+        """
+        conn = self.get_connection()
+        if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+            conn.close()
+            return None
+        # executescript steps the pragma to completion; a plain execute
+        # only frees a single page
+        conn.executescript(f"PRAGMA incremental_vacuum({int(pages)})")
+        remaining = conn.execute("PRAGMA freelist_count").fetchone()[0]
+        conn.close()
+        return remaining
+
+    def vacuum(self):
+        """Full VACUUM, switching the DB to incremental auto-vacuum. Slow."""
+        self.flush()
+        conn = self.get_connection()
+        conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        conn.execute("VACUUM")
         conn.close()
-        return [dict(row) for row in rows]
 
     def update_event(self, event_id, name):
         """Updates event name."""
@@ -165,10 +822,27 @@ class DatabaseHandler:
 
     def delete_event(self, event_id):
         """Deletes an event and its logs."""
+        with self._write_lock:
+            self._pending = [row for row in self._pending if row[1] != event_id]
         conn = self.get_connection()
         c = conn.cursor()
-        c.execute("DELETE FROM logs WHERE event_id = ?", (event_id,))
+        c.execute('''
+        SELECT MIN(first), MAX(last) FROM (
+            SELECT MIN(timestamp) AS first, MAX(timestamp) AS last FROM samples WHERE event_id = ?
+            UNION ALL
+            SELECT MIN(first_ts), MAX(last_ts) FROM sample_blocks WHERE event_id = ?
+        )
+        ''', (event_id, event_id))
+        first, last = c.fetchone()
+        c.execute("DELETE FROM samples WHERE event_id = ?", (event_id,))
+        c.execute("DELETE FROM sample_blocks WHERE event_id = ?", (event_id,))
+        c.execute("DELETE FROM event_energy WHERE event_id = ?", (event_id,))
+        c.execute("DELETE FROM analytics_1h WHERE event_id = ?", (event_id,))
         c.execute("DELETE FROM events WHERE id = ?", (event_id,))
+        # Drop the deleted samples from the rollups as well
+        if first is not None:
+            rollups.refresh(conn, first, last, not_before=self._raw_complete_since(conn),
+                            archived=self._archived_range(conn, first, last))
         conn.commit()
         conn.close()
 
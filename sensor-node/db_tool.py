@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+"""
+Maintenance commands for the sensor node database.
+
+Usage:
+    python3 db_tool.py backfill-rollups
+    python3 db_tool.py backfill-energy
+    python3 db_tool.py backfill-analytics
+    python3 db_tool.py prune
+    python3 db_tool.py vacuum
+
+backfill-energy, backfill-analytics and vacuum need the node service stopped
+(sudo systemctl stop voltwise) and refuse to run while it answers.
+"""
+import argparse
+import socket
+import sys
+import time
+from database_handler import DatabaseHandler
+from maintenance import MaintenanceWorker
+
+# Port of the node's web server (app.PORT)
+NODE_PORT = 25500
+
+
+def require_stopped(command):
+    """Exits unless the node service is stopped."""
+    try:
+        socket.create_connection(('127.0.0.1', NODE_PORT), timeout=1).close()
+    except OSError:
+        return
+    print(f"The node is running on port {NODE_PORT}; stop it before '{command}' "
+          "(sudo systemctl stop voltwise).")
+    sys.exit(1)
+
+
+def backfill_rollups(db, args):
+    print("Rebuilding minute/hour/day rollups from stored samples...")
+    started = time.time()
+    db.rebuild_rollups()
+    print(f"Done in {time.time() - started:.1f}s")
+
+
+def backfill_energy(db, args):
+    # One long transaction that would hold off the node's writes, and the
+    # running node would keep accounting from its cached meter state
+    require_stopped('backfill-energy')
+    print("Recomputing energy accounting from stored samples...")
+    started = time.time()
+    db.rebuild_energy()
+    print(f"Done in {time.time() - started:.1f}s")
+
+
+def backfill_analytics(db, args):
+    require_stopped('backfill-analytics')
+    print("Recomputing hourly analytics summaries from stored samples...")
+    started = time.time()
+    db.rebuild_analytics()
+    print(f"Done in {time.time() - started:.1f}s")
+
+
+def prune(db, args):
+    print("Applying retention policy and archiving old samples...")
+    MaintenanceWorker(db).run_once()
+
+
+def vacuum(db, args):
+    # Needed once on databases created before incremental auto-vacuum was
+    # enabled. Rewrites the whole file, so stop the service first.
+    require_stopped('vacuum')
+    print("Vacuuming database (this can take a while)...")
+    started = time.time()
+    db.vacuum()
+    print(f"Done in {time.time() - started:.1f}s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="VoltWise database maintenance")
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    p = sub.add_parser('backfill-rollups', help="Rebuild rollup tables from stored samples")
+    p.set_defaults(func=backfill_rollups)
+
+    p = sub.add_parser('backfill-energy', help="Recompute per-minute, per-hour and per-event energy")
+    p.set_defaults(func=backfill_energy)
+
+    p = sub.add_parser('backfill-analytics', help="Recompute the hourly power quality summaries")
+    p.set_defaults(func=backfill_analytics)
+
+    p = sub.add_parser('prune', help="Apply retention and archive old samples now")
+    p.set_defaults(func=prune)
+
+    p = sub.add_parser('vacuum', help="Compact the database and enable incremental vacuum")
+    p.set_defaults(func=vacuum)
+
+    args = parser.parse_args()
+    db = DatabaseHandler()
+    try:
+        args.func(db, args)
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,152 @@
+"""
+Quantities derived from the sensor readings, computed over whole columns.
+
+Every function works on float arrays in engineering units with NaN for
+unknown values, so the live sample, chart history and exports all go
+through the same vectorised arithmetic instead of per-row Python math:
+
+    neutral_i     neutral current of the phase sensors (A), assuming the
+                  phases are 120 degrees apart
+    total_p       power of all sensors that answered (W)
+    imbalance     current imbalance of the phases: largest deviation
+                  from their mean, in % of it (NEMA)
+    p<a>_s        apparent power V * I (VA)
+    p<a>_q        reactive power S * sqrt(1 - pf^2) (var); magnitude
+                  only, as the PZEM gives no sign
+
+neutral_i is also a log column: recomputing it fixes samples stored
+without it (e.g. recorded with other than three sensors configured).
+
+NumPy is optional; without it the node only computes the live neutral
+current (app.calculate_neutral) and derived series answer 501.
+"""
+import numpy as np
+
+import config
+
+# Sensors on the three phases of the supply; None means the first three
+# configured sensors
+PHASE_ADDRESSES = getattr(config, 'PHASE_ADDRESSES', None)
+
+# Log columns the derived ones are computed from
+_INPUTS = ('v', 'i', 'p', 'pf')
+
+
+def extra_columns(addresses):
+    """Names of the derived columns beyond the log columns, in output order."""
+    return ('total_p', 'imbalance') + tuple(f'p{a}_{k}' for a in addresses for k in ('s', 'q'))
+
+
+def input_columns(addresses):
+    """Log columns compute() needs."""
+    return ('neutral_i',) + tuple(f'p{a}_{field}' for a in addresses for field in _INPUTS)
+
+
+def phases(addresses):
+    """The phase sensors among `addresses`."""
+    return [a for a in (PHASE_ADDRESSES or addresses[:3]) if a in addresses]
+
+
+def neutral(currents):
+    """
+    Neutral current of up to three phase currents (magnitudes, as the
+    PZEM gives): |I1 + a I2 + a^2 I3| with a the 120 degree rotation, i.e.
+    sqrt(i1^2 + i2^2 + i3^2 - i1 i2 - i2 i3 - i3 i1). A phase without a
+    reading counts as 0 A; NaN where none has one.
+    """
+    i = [np.nan_to_num(c) for c in currents]
+    i += [np.zeros_like(i[0])] * (3 - len(i))
+    i1, i2, i3 = i
+    value = np.sqrt(np.maximum(i1 * i1 + i2 * i2 + i3 * i3 - (i1 * i2 + i2 * i3 + i3 * i1), 0))
+    known = np.logical_or.reduce([~np.isnan(c) for c in currents])
+    return np.where(known, np.round(value, 3), np.nan)
+
+
+def total_power(powers):
+    """Sum of the known powers; NaN where none is known."""
+    p = np.vstack(powers)
+    known = (~np.isnan(p)).any(axis=0)
+    return np.where(known, np.round(np.nansum(p, axis=0), 1), np.nan)
+
+
+def imbalance(currents):
+    """NEMA current imbalance (%); NaN where a phase is unknown or all are 0 A."""
+    i = np.vstack(currents)
+    mean = i.mean(axis=0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        value = np.abs(i - mean).max(axis=0) / mean * 100
+    return np.where(mean > 0, np.round(value, 2), np.nan)
+
+
+def apparent_reactive(voltage, current, pf):
+    """(apparent VA, reactive var) of one sensor."""
+    s = voltage * current
+    q = s * np.sqrt(1 - np.clip(pf, 0, 1) ** 2)
+    return np.round(s, 1), np.round(q, 1)
+
+
+def compute(cols, addresses):
+    """
+    Derived columns from {log column: float array}, which must hold
+    input_columns(addresses). Returns {column: float array} with neutral_i
+    (the stored value where no phase current is known) and
+    extra_columns(addresses).
+    """
+    neutral_i = cols['neutral_i']
+    currents = [cols[f'p{a}_i'] for a in phases(addresses)]
+    if currents:
+        computed = neutral(currents)
+        neutral_i = np.where(np.isnan(computed), neutral_i, computed)
+    result = {
+        'neutral_i': neutral_i,
+        'total_p': total_power([cols[f'p{a}_p'] for a in addresses]),
+        'imbalance': imbalance(currents) if len(currents) > 1 else np.full(len(neutral_i), np.nan),
+    }
+    for a in addresses:
+        result[f'p{a}_s'], result[f'p{a}_q'] = apparent_reactive(
+            cols[f'p{a}_v'], cols[f'p{a}_i'], cols[f'p{a}_pf'])
+    return result
+
+
+def _nullable(values):
+    """A float array as a list with None for NaN, for JSON and CSV."""
+    return np.where(np.isnan(values), None, values).tolist()
+
+
+def add_columns(cols, addresses):
+    """
+    Adds the derived columns to {column: list} (None for unknown values)
+    in place, replacing neutral_i.
+    """
+    arrays = {col: np.array(cols[col], dtype=float) for col in input_columns(addresses)}
+    for col, values in compute(arrays, addresses).items():
+        cols[col] = _nullable(values)
+    return cols
+
+
+def add_to_rows(columns, rows, addresses):
+    """
+    Tuples in `columns` order (which must include input_columns) with
+    neutral_i replaced and extra_columns(addresses) appended.
+    """
+    if not rows:
+        return rows
+    index = {col: k for k, col in enumerate(columns)}
+    arrays = {col: np.array([row[index[col]] for row in rows], dtype=float)
+              for col in input_columns(addresses)}
+    values = compute(arrays, addresses)
+    k = index['neutral_i']
+    neutral_i = _nullable(values['neutral_i'])
+    extra = zip(*(_nullable(values[col]) for col in extra_columns(addresses)))
+    return [row[:k] + (n,) + row[k + 1:] + e for row, n, e in zip(rows, neutral_i, extra)]
+
+
+def add_to_logs(logs, addresses):
+    """Adds the derived columns to log dicts in place, replacing neutral_i."""
+    if logs:
+        arrays = {col: np.array([log[col] for log in logs], dtype=float)
+                  for col in input_columns(addresses)}
+        for col, values in compute(arrays, addresses).items():
+            for log, value in zip(logs, _nullable(values)):
+                log[col] = value
+    return logs
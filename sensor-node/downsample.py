@@ -0,0 +1,80 @@
+"""
+Server-side downsampling of log rows for charts.
+
+Rows are consumed as plain tuples straight from a SQLite cursor, so a long
+event can be reduced to a fixed number of chart points without building a
+dict per raw row.
+"""
+
+# Columns carried over from the first row of a bucket instead of being
+# reduced to min/max.
+KEY_COLUMNS = ('id', 'timestamp', 'event_id')
+
+
+def minmax_buckets(rows, columns, total, points):
+    """
+    Reduces `rows` to at most `points` rows using min/max buckets.
+
+    rows: iterable of tuples in `columns` order, sorted by timestamp.
+    total: number of rows the iterable yields.
+
+    The rows are split into points // 2 equally sized buckets. Each bucket
+    becomes two rows, at the timestamps of its first and last sample. For
+    every value column the two rows hold the bucket's minimum and maximum,
+    in the order they occurred, so peaks and dips survive the reduction.
+    Returns a list of log dicts.
+    """
+    if total <= points or points < 2:
+        return [dict(zip(columns, row)) for row in rows]
+
+    n_buckets = points // 2
+    ts_idx = columns.index('timestamp')
+    value_idx = [i for i, col in enumerate(columns) if col not in KEY_COLUMNS]
+
+    result = []
+    bucket = -1
+    first = last = None
+    lo = hi = None  # per value column: [value, position in bucket]
+
+    def emit():
+        low_row = dict(zip(columns, first))
+        high_row = dict(low_row)
+        high_row['timestamp'] = last[ts_idx]
+        for k, i in enumerate(value_idx):
+            if lo[k] is None:
+                continue
+            # Keep the extreme that happened first on the first row
+            a, b = (lo[k], hi[k]) if lo[k][1] <= hi[k][1] else (hi[k], lo[k])
+            low_row[columns[i]] = a[0]
+            high_row[columns[i]] = b[0]
+        result.append(low_row)
+        if last is not first:
+            result.append(high_row)
+
+    for n, row in enumerate(rows):
+        b = n * n_buckets // total
+        if b != bucket:
+            if first is not None:
+                emit()
+            bucket = b
+            first = row
+            pos = 0
+            lo = [None] * len(value_idx)
+            hi = [None] * len(value_idx)
+        last = row
+        for k, i in enumerate(value_idx):
+            v = row[i]
+            if v is None:
+                continue
+            if lo[k] is None:
+                lo[k] = [v, pos]
+                hi[k] = [v, pos]
+            elif v < lo[k][0]:
+                lo[k] = [v, pos]
+            elif v > hi[k][0]:
+                hi[k] = [v, pos]
+        pos += 1
+
+    if first is not None:
+        emit()
+    return result
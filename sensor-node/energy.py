@@ -0,0 +1,199 @@
+"""
+Energy accounting per sensor, per event and per time window.
+
+The PZEM's energy register counts Wh since its last reset, so the energy
+used between two samples is normally the difference of their readings.
+consumed() also copes with what breaks a plain difference:
+
+- the register rolling over (at 9999.99 kWh, or the 32-bit limit):
+  the wrapped difference is used when it is plausible
+- a reset (/api/reset): power is integrated over that one interval, or,
+  when the reset happened during a gap, the new reading is counted
+- missing energy readings: power is integrated (trapezoid)
+- readings that jump more than the sensor could measure in the time:
+  treated like a missing reading
+- gaps longer than GAP: only a counter difference can span them
+
+The EnergyMeter applies this to every flushed batch and adds the result
+to per-minute and per-hour buckets that also hold the running total at
+the end of the bucket, so the energy of any window is the difference of
+two running totals: a few index lookups however long the window.
+Per-event totals are kept in event_energy.
+"""
+import config
+
+# Rated maximum of the PZEM-004T (100 A x 260 V) plus margin; larger
+# counter steps are read errors
+MAX_POWER = 30000
+# Values at which the energy register starts again from 0 (Wh)
+ROLLOVERS = (10_000_000, 1 << 32)
+# Seconds between two readings beyond which power is not integrated
+GAP = max(60, 5 * getattr(config, 'SAMPLE_INTERVAL', 1.0))
+
+# (table, bucket size in seconds), finest first
+ENERGY_TABLES = (
+    ('energy_1m', 60),
+    ('energy_1h', 3600),
+)
+
+
+def create_tables(c):
+    for table, _ in ENERGY_TABLES:
+        c.execute(f'''
+        CREATE TABLE IF NOT EXISTS {table} (
+            address INTEGER NOT NULL,
+            bucket REAL NOT NULL,
+            wh REAL NOT NULL,           -- used within the bucket
+            total REAL NOT NULL,        -- running total at its end
+            PRIMARY KEY (bucket, address)
+        ) WITHOUT ROWID
+        ''')
+    c.execute('''
+    CREATE TABLE IF NOT EXISTS event_energy (
+        event_id INTEGER NOT NULL,
+        address INTEGER NOT NULL,
+        wh REAL NOT NULL,
+        PRIMARY KEY (event_id, address)
+    ) WITHOUT ROWID
+    ''')
+    # Last reading and running total per sensor, to carry on after a restart
+    c.execute('''
+    CREATE TABLE IF NOT EXISTS energy_state (
+        address INTEGER PRIMARY KEY,
+        timestamp REAL NOT NULL,
+        energy REAL,
+        power REAL,
+        total REAL NOT NULL
+    )
+    ''')
+
+
+def consumed(prev, timestamp, energy, power):
+    """
+    Wh used between the reading prev = (timestamp, energy, power) and
+    this one. energy and power may be None.
+    """
+    prev_ts, prev_e, prev_p = prev
+    dt = timestamp - prev_ts
+    limit = MAX_POWER * dt / 3600 + 1
+    if energy is not None and prev_e is not None:
+        delta = energy - prev_e
+        if 0 <= delta <= limit:
+            return float(delta)
+        if delta < 0:
+            for rollover in ROLLOVERS:
+                wrapped = rollover - prev_e + energy
+                if prev_e < rollover and 0 <= wrapped <= limit:
+                    return float(wrapped)
+            if dt > GAP:
+                # Reset while we weren't looking: used since then
+                return float(energy)
+    if dt > GAP:
+        return 0.0
+    known = [p for p in (prev_p, power) if p is not None]
+    return sum(known) / len(known) * dt / 3600 if known else 0.0
+
+
+class EnergyMeter:
+    """
+    Turns batches of log rows into energy per sensor, bucket and event.
+
+    sensors: (address, energy index, power index) of each sensor in the
+    rows; the timestamp and event_id are the first two values of a row.
+    The running state is loaded from energy_state on first use.
+    """
+
+    def __init__(self, sensors):
+        self.sensors = sensors
+        self._state = None
+
+    def invalidate(self):
+        """Drops the in-memory state; the next batch reloads it from the DB."""
+        self._state = None
+
+    def _load(self, conn):
+        if self._state is None:
+            rows = conn.execute("SELECT address, timestamp, energy, power, total FROM energy_state")
+            self._state = {address: (ts, e, p, total) for address, ts, e, p, total in rows}
+        return self._state
+
+    def consume(self, conn, rows):
+        """
+        Accounts for `rows` (oldest first) without storing anything.
+        Returns (buckets, events, state): buckets maps (table, address,
+        bucket) to [wh, total], events maps (event_id, address) to wh,
+        state is the per-sensor state after the rows.
+        """
+        state = dict(self._load(conn))
+        buckets, events = {}, {}
+        for row in rows:
+            timestamp, event_id = row[0], row[1]
+            for address, e_idx, p_idx in self.sensors:
+                energy, power = row[e_idx], row[p_idx]
+                if energy is None and power is None:
+                    continue
+                prev = state.get(address)
+                if prev is not None and timestamp <= prev[0]:
+                    continue
+                wh = 0.0 if prev is None else consumed(prev[:3], timestamp, energy, power)
+                total = (0.0 if prev is None else prev[3]) + wh
+                state[address] = (timestamp, energy, power, total)
+                for table, size in ENERGY_TABLES:
+                    key = (table, address, (timestamp // size) * size)
+                    bucket = buckets.setdefault(key, [0.0, 0.0])
+                    bucket[0] += wh
+                    bucket[1] = total
+                if event_id is not None and wh:
+                    events[(event_id, address)] = events.get((event_id, address), 0.0) + wh
+        return buckets, events, state
+
+    def record(self, conn, rows):
+        """Accounts for `rows` and stores the result on the caller's transaction."""
+        buckets, events, state = self.consume(conn, rows)
+        for (table, address, bucket), (wh, total) in buckets.items():
+            conn.execute(f'''
+            INSERT INTO {table} (address, bucket, wh, total) VALUES (?, ?, ?, ?)
+            ON CONFLICT (bucket, address) DO UPDATE SET wh = wh + excluded.wh, total = excluded.total
+            ''', (address, bucket, wh, total))
+        conn.executemany('''
+        INSERT INTO event_energy (event_id, address, wh) VALUES (?, ?, ?)
+        ON CONFLICT (event_id, address) DO UPDATE SET wh = wh + excluded.wh
+        ''', [(event_id, address, wh) for (event_id, address), wh in events.items()])
+        conn.executemany("INSERT OR REPLACE INTO energy_state (address, timestamp, energy, power, total) "
+                         "VALUES (?, ?, ?, ?, ?)",
+                         [(address, *values) for address, values in state.items()])
+        self._state = state
+
+
+def total_at(conn, address, t, pending=None):
+    """
+    Running total of a sensor at time t, as of the end of the latest
+    bucket that ended by then (minute resolution while energy_1m still
+    holds the time, hour resolution beyond it).
+    pending: buckets from EnergyMeter.consume for rows not stored yet.
+    """
+    best = None
+    for table, size in ENERGY_TABLES:
+        row = conn.execute(f"SELECT bucket, total FROM {table} WHERE address = ? AND bucket <= ? "
+                           "ORDER BY bucket DESC LIMIT 1", (address, t - size)).fetchone()
+        if row is not None and (best is None or row[0] + size > best[0]):
+            best = (row[0] + size, row[1])
+    sizes = dict(ENERGY_TABLES)
+    for (table, a, bucket), (_, total) in (pending or {}).items():
+        end = bucket + sizes[table]
+        # On a tie the pending rows come after the stored part of the bucket
+        if a == address and end <= t and (best is None or end >= best[0]):
+            best = (end, total)
+    return best[1] if best else 0.0
+
+
+def window(conn, addresses, start, end, pending=None):
+    """{address: Wh used between start and end}, to the bucket."""
+    return {address: total_at(conn, address, end, pending) - total_at(conn, address, start, pending)
+            for address in addresses}
+
+
+def event_totals(conn, event_id):
+    """{address: Wh} used during an event."""
+    rows = conn.execute("SELECT address, wh FROM event_energy WHERE event_id = ?", (event_id,))
+    return dict(rows.fetchall())
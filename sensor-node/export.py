@@ -0,0 +1,94 @@
+"""
+Streaming encoders for event exports.
+
+All encoders take the column names and an iterable of row chunks (lists
+of tuples, as produced by DatabaseHandler.iter_log_chunks) and yield
+bytes, so a download never holds more than one chunk in memory.
+"""
+import array
+import csv
+import io
+import struct
+import sys
+import zlib
+
+# Human readable CSV headers for the log columns; per-sensor columns
+# (p<address>_<field>) are labelled L<address> plus the field name
+CSV_HEADERS = {
+    'timestamp': 'Timestamp',
+    'neutral_i': 'Neutral Current (A)',
+    'total_p': 'Total Power (W)',
+    'imbalance': 'Current Imbalance (%)',
+}
+FIELD_HEADERS = {
+    'v': 'Voltage (V)',
+    'i': 'Current (A)',
+    'p': 'Power (W)',
+    'e': 'Energy (Wh)',
+    'f': 'Frequency (Hz)',
+    'pf': 'Power Factor',
+    'alarm': 'Alarm',
+    's': 'Apparent Power (VA)',
+    'q': 'Reactive Power (var)',
+}
+
+
+def csv_header(col):
+    if col in CSV_HEADERS:
+        return CSV_HEADERS[col]
+    sensor, _, field = col.partition('_')
+    if sensor[:1] == 'p' and sensor[1:].isdigit() and field in FIELD_HEADERS:
+        return f'L{sensor[1:]} {FIELD_HEADERS[field]}'
+    return col
+
+# Columnar binary format ("VWC1"), little-endian:
+#   magic b'VWC1', uint16 column count,
+#   per column: uint8 name length + UTF-8 name
+#   blocks: uint32 row count n, then per column n float64 values (NaN = NULL)
+#   a block with n = 0 ends the stream
+COLUMNAR_MAGIC = b'VWC1'
+
+
+def csv_chunks(columns, chunks):
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    writer.writerow([csv_header(col) for col in columns])
+    for rows in chunks:
+        writer.writerows(rows)
+        yield buf.getvalue().encode('utf-8')
+        buf.seek(0)
+        buf.truncate()
+    if buf.tell():
+        yield buf.getvalue().encode('utf-8')
+
+
+def columnar_chunks(columns, chunks):
+    header = bytearray(COLUMNAR_MAGIC)
+    header += struct.pack('<H', len(columns))
+    for col in columns:
+        name = col.encode('utf-8')
+        header += struct.pack('<B', len(name)) + name
+    yield bytes(header)
+
+    nan = float('nan')
+    for rows in chunks:
+        if not rows:
+            continue
+        block = bytearray(struct.pack('<I', len(rows)))
+        for k in range(len(columns)):
+            values = array.array('d', (nan if row[k] is None else row[k] for row in rows))
+            if sys.byteorder == 'big':
+                values.byteswap()
+            block += values.tobytes()
+        yield bytes(block)
+    yield struct.pack('<I', 0)
+
+
+def gzip_chunks(chunks, level=6):
+    """Gzip-compresses a byte stream on the fly."""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
@@ -0,0 +1,107 @@
+import threading
+import time
+import config
+import energy
+import rollups
+from database_handler import ANALYTICS_TABLES
+
+DAY = 86400
+HOUR = 3600
+
+# Pause between delete chunks so other writers get the lock in between
+CHUNK_PAUSE = 0.05
+# Free pages handed back to the file system per incremental vacuum step
+VACUUM_PAGES = 256
+
+
+class MaintenanceWorker:
+    """
+    Background task enforcing the retention policy from config.py.
+
+    Old rows are deleted a chunk at a time, each chunk in its own short
+    transaction, samples past ARCHIVE_AFTER_HOURS are sealed into
+    compressed blocks an hour at a time, and the freed pages are released
+    with incremental vacuum in small steps, so the poller is never blocked
+    for long.
+    """
+
+    def __init__(self, db):
+        self.db = db
+        self.interval = getattr(config, 'MAINTENANCE_INTERVAL', 3600)
+        self.chunk = getattr(config, 'MAINTENANCE_CHUNK_ROWS', 500)
+        self.raw_days = getattr(config, 'RETENTION_RAW_DAYS', None)
+        self.rollup_days = getattr(config, 'RETENTION_ROLLUP_DAYS', {})
+        self.archive_hours = getattr(config, 'ARCHIVE_AFTER_HOURS', None)
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.run_once()
+            except Exception as e:
+                print(f"Error in maintenance: {e}")
+            self._stop.wait(self.interval)
+
+    def run_once(self):
+        """Runs one full retention + vacuum pass."""
+        now = time.time()
+        deleted = 0
+
+        if self.raw_days is not None:
+            deleted += self._delete_chunked(
+                lambda: self.db.prune_logs(self._cutoff(now, self.raw_days), self.chunk))
+
+        for table, _ in rollups.ROLLUP_TABLES + energy.ENERGY_TABLES + ANALYTICS_TABLES:
+            days = self.rollup_days.get(table)
+            if days is None:
+                continue
+            deleted += self._delete_chunked(
+                lambda: self.db.prune_rollups(table, self._cutoff(now, days), self.chunk))
+
+        if deleted:
+            print(f"Maintenance: deleted {deleted} expired rows")
+
+        if self.archive_hours is not None:
+            before = ((now - self.archive_hours * HOUR) // HOUR) * HOUR
+            archived = self._archive(before)
+            if archived:
+                print(f"Maintenance: archived {archived} samples")
+
+        while not self._stop.is_set():
+            remaining = self.db.incremental_vacuum(VACUUM_PAGES)
+            if not remaining:
+                break
+            time.sleep(CHUNK_PAUSE)
+
+    def _delete_chunked(self, delete_chunk):
+        total = 0
+        while not self._stop.is_set():
+            n = delete_chunk()
+            total += n
+            if n < self.chunk:
+                break
+            time.sleep(CHUNK_PAUSE)
+        return total
+
+    def _archive(self, before):
+        total = 0
+        while not self._stop.is_set():
+            n = self.db.archive_samples(before)
+            if not n:
+                break
+            total += n
+            time.sleep(CHUNK_PAUSE)
+        return total
+
+    @staticmethod
+    def _cutoff(now, days):
+        # Day-aligned so pruned ranges line up with the rollup buckets
+        return ((now - days * DAY) // DAY) * DAY
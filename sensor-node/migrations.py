@@ -0,0 +1,225 @@
+"""
+Versioned schema migrations for the sensor node database.
+
+The schema version is stored in `PRAGMA user_version`. Each migration
+brings the schema from version N-1 to N and runs in its own transaction
+together with the version bump, so an interrupted upgrade is simply
+retried on the next start. Append new migrations at the end; never edit
+one that has shipped.
+"""
+import time
+
+import energy
+import rollups
+import storage
+
+
+def _v1_base_schema(c):
+    # Events table
+    # Stores named time periods (e.g. "Test Run 1")
+    c.execute('''
+    CREATE TABLE IF NOT EXISTS events (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        name TEXT NOT NULL,
+        start_time REAL NOT NULL,
+        end_time REAL
+    )
+    ''')
+
+    # Logs table
+    # Stores raw sensor data.
+    # Structure: timestamp | p1_v | p1_i | p1_p | p1_e | p2_... | p3_... | neutral_i
+    # To make it flexible for 1-3 phases, we'll just have columns for 3 phases.
+    # Unused phases will be NULL.
+    c.execute('''
+    CREATE TABLE IF NOT EXISTS logs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        timestamp REAL NOT NULL,
+
+        p1_v REAL, p1_i REAL, p1_p REAL, p1_e REAL,
+        p2_v REAL, p2_i REAL, p2_p REAL, p2_e REAL,
+        p3_v REAL, p3_i REAL, p3_p REAL, p3_e REAL,
+
+        neutral_i REAL,
+
+        event_id INTEGER,
+        FOREIGN KEY(event_id) REFERENCES events(id)
+    )
+    ''')
+
+
+def _v2_rollups_and_meta(c):
+    # Rollup refreshes and range queries look samples up by time
+    c.execute("CREATE INDEX IF NOT EXISTS idx_logs_timestamp ON logs (timestamp)")
+
+    # Minute/hour/day aggregates, kept up to date on every flush
+    rollups.create_tables(c)
+
+    # Small key/value store for DB housekeeping state
+    c.execute('''
+    CREATE TABLE IF NOT EXISTS meta (
+        key TEXT PRIMARY KEY,
+        value
+    )
+    ''')
+
+
+def _v3_event_index(c):
+    # Serves `WHERE event_id = ? ORDER BY timestamp` and the retention
+    # scan (`event_id IS NULL AND timestamp < ?`) straight from the index
+    c.execute("CREATE INDEX IF NOT EXISTS idx_logs_event_ts ON logs (event_id, timestamp)")
+
+
+EVENT_STATS_COLUMNS = (
+    ('log_count', 'INTEGER NOT NULL DEFAULT 0'),
+    ('first_sample', 'REAL'),
+    ('last_sample', 'REAL'),
+    ('p1_e_first', 'REAL'), ('p1_e_last', 'REAL'),
+    ('p2_e_first', 'REAL'), ('p2_e_last', 'REAL'),
+    ('p3_e_first', 'REAL'), ('p3_e_last', 'REAL'),
+)
+
+
+def _v4_event_stats(c):
+    # Running per-event statistics, updated on every flush, so event
+    # details no longer need COUNT(*) over the logs
+    for name, decl in EVENT_STATS_COLUMNS:
+        c.execute(f"ALTER TABLE events ADD COLUMN {name} {decl}")
+
+    # Backfill from the existing logs
+    c.execute('''
+    UPDATE events SET
+        log_count = (SELECT COUNT(*) FROM logs WHERE event_id = events.id),
+        first_sample = (SELECT MIN(timestamp) FROM logs WHERE event_id = events.id),
+        last_sample = (SELECT MAX(timestamp) FROM logs WHERE event_id = events.id)
+    ''')
+    for phase in (1, 2, 3):
+        col = f"p{phase}_e"
+        for suffix, order in (('first', 'ASC'), ('last', 'DESC')):
+            c.execute(f'''
+            UPDATE events SET {col}_{suffix} = (
+                SELECT {col} FROM logs
+                WHERE event_id = events.id AND {col} IS NOT NULL
+                ORDER BY timestamp {order} LIMIT 1
+            )
+            ''')
+
+
+def _v5_packed_samples(c):
+    # One packed BLOB per sample (see storage.py) replaces the wide logs
+    # table: all fields of any number of sensors, in about half the space
+    c.execute('''
+    CREATE TABLE samples (
+        id INTEGER PRIMARY KEY,
+        timestamp REAL NOT NULL,
+        event_id INTEGER,
+        data BLOB NOT NULL,
+        FOREIGN KEY(event_id) REFERENCES events(id)
+    )
+    ''')
+
+    # Copy the old rows over. They only have voltage, current, power and
+    # energy of sensors 1-3; frequency, power factor and alarm are unknown.
+    read = c.connection.cursor()
+    read.execute('''
+    SELECT id, timestamp, event_id,
+           p1_v, p1_i, p1_p, p1_e, p2_v, p2_i, p2_p, p2_e, p3_v, p3_i, p3_p, p3_e,
+           neutral_i
+    FROM logs ORDER BY id
+    ''')
+    unknown = (None, None, None)
+    copied = 0
+    while True:
+        rows = read.fetchmany(5000)
+        if not rows:
+            break
+        packed = []
+        for row in rows:
+            readings = []
+            for k, address in enumerate((1, 2, 3)):
+                values = row[3 + 4 * k:7 + 4 * k]
+                if any(v is not None for v in values):
+                    readings.append((address, tuple(values) + unknown))
+            packed.append((row[0], row[1], row[2], storage.pack(row[15], readings)))
+        c.executemany("INSERT INTO samples (id, timestamp, event_id, data) VALUES (?, ?, ?, ?)", packed)
+        copied += len(rows)
+        if copied % 500000 < len(rows):
+            print(f"  {copied} samples converted")
+
+    c.execute("DROP TABLE logs")
+    c.execute("CREATE INDEX idx_samples_timestamp ON samples (timestamp)")
+    c.execute("CREATE INDEX idx_samples_event_ts ON samples (event_id, timestamp)")
+
+
+def _v6_sample_blocks(c):
+    # Archive tier: old samples sealed into compressed per-hour blocks
+    # (see archive.py) by the maintenance task
+    c.execute('''
+    CREATE TABLE sample_blocks (
+        id INTEGER PRIMARY KEY,
+        first_ts REAL NOT NULL,
+        last_ts REAL NOT NULL,
+        event_id INTEGER,
+        count INTEGER NOT NULL,
+        data BLOB NOT NULL,
+        FOREIGN KEY(event_id) REFERENCES events(id)
+    )
+    ''')
+    c.execute("CREATE INDEX idx_sample_blocks_ts ON sample_blocks (last_ts)")
+    c.execute("CREATE INDEX idx_sample_blocks_event_ts ON sample_blocks (event_id, last_ts)")
+
+
+def _v7_energy(c):
+    # Energy accounting (see energy.py). Existing samples are accounted
+    # for by `python3 db_tool.py backfill-energy`.
+    energy.create_tables(c)
+
+
+def _v8_analytics_summaries(c):
+    # Power quality statistics per hour and event (see analytics.py),
+    # kept up to date on every flush when NumPy is installed. Hours from
+    # analytics_complete_since on are covered; earlier ones are analysed
+    # from the raw samples until `python3 db_tool.py backfill-analytics`.
+    c.execute('''
+    CREATE TABLE analytics_1h (
+        bucket REAL NOT NULL,
+        event_id INTEGER NOT NULL,      -- 0 outside events
+        data BLOB NOT NULL,
+        PRIMARY KEY (bucket, event_id)
+    ) WITHOUT ROWID
+    ''')
+    c.execute("CREATE INDEX idx_analytics_1h_event ON analytics_1h (event_id, bucket)")
+    c.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('analytics_complete_since', ?)",
+              ((time.time() // 3600 + 1) * 3600,))
+
+
+MIGRATIONS = [
+    _v1_base_schema,
+    _v2_rollups_and_meta,
+    _v3_event_index,
+    _v4_event_stats,
+    _v5_packed_samples,
+    _v6_sample_blocks,
+    _v7_energy,
+    _v8_analytics_summaries,
+]
+
+
+def migrate(conn):
+    """Applies all pending migrations. Returns the resulting version."""
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    for target, migration in enumerate(MIGRATIONS, start=1):
+        if version >= target:
+            continue
+        print(f"Migrating database to version {target} ({migration.__name__})")
+        c = conn.cursor()
+        c.execute("BEGIN")
+        try:
+            migration(c)
+            c.execute(f"PRAGMA user_version = {target}")
+            c.execute("COMMIT")
+        except Exception:
+            c.execute("ROLLBACK")
+            raise
+        version = target
+    return version
@@ -1,32 +1,199 @@
-import minimalmodbus
 import serial
 import random
+import struct
+import threading
 import time
+from collections import namedtuple
 import config
 
+# --- Modbus RTU codec for the PZEM-004T ---
+# The PZEM only needs two transactions: read the 10 input registers and the
+# vendor-specific energy reset (0x42). Encoding them directly avoids the
+# per-register overhead of a generic Modbus library.
+
+FUNC_READ_INPUT = 0x04
+FUNC_RESET_ENERGY = 0x42
+REGISTER_COUNT = 10
+
+# Read response: addr, func, byte count, 20 data bytes, CRC
+READ_RESPONSE_LEN = 3 + 2 * REGISTER_COUNT + 2
+# Exception response: addr, func | 0x80, exception code, CRC
+EXCEPTION_RESPONSE_LEN = 5
+
+# Registers are big-endian words. 32-bit values are low word first.
+# 0: Voltage (0.1V)
+# 1-2: Current (0.001A)
+# 3-4: Power (0.1W)
+# 5-6: Energy (1Wh)
+# 7: Frequency (0.1Hz)
+# 8: PF (0.01)
+# 9: Alarm status
+REGISTERS = struct.Struct('>10H')
+
+# One decoded reading in raw register units
+PZEMRecord = namedtuple('PZEMRecord', 'voltage current power energy frequency pf alarm')
+
+
+def _build_crc_table():
+    table = []
+    for byte in range(256):
+        crc = byte
+        for _ in range(8):
+            if crc & 1:
+                crc = (crc >> 1) ^ 0xA001
+            else:
+                crc >>= 1
+        table.append(crc)
+    return tuple(table)
+
+CRC_TABLE = _build_crc_table()
+
+
+def crc16(data):
+    """Modbus CRC16, one table lookup per byte."""
+    crc = 0xFFFF
+    for byte in data:
+        crc = (crc >> 8) ^ CRC_TABLE[(crc ^ byte) & 0xFF]
+    return crc
+
+
+def with_crc(payload):
+    """Appends the CRC (low byte first) to a frame."""
+    payload = bytes(payload)
+    return payload + struct.pack('<H', crc16(payload))
+
+
+def read_request(address):
+    """Frame reading the 10 measurement input registers of one sensor."""
+    return with_crc(struct.pack('>BBHH', address, FUNC_READ_INPUT, 0x0000, REGISTER_COUNT))
+
+
+def reset_request(address):
+    """Frame resetting the energy counter of one sensor."""
+    return with_crc(struct.pack('>BB', address, FUNC_RESET_ENERGY))
+
+
+def decode_registers(data):
+    """Decodes the 20 data bytes of a read response into a PZEMRecord."""
+    v, i_lo, i_hi, p_lo, p_hi, e_lo, e_hi, f, pf, alarm = REGISTERS.unpack(data)
+    return PZEMRecord(v, (i_hi << 16) | i_lo, (p_hi << 16) | p_lo, (e_hi << 16) | e_lo, f, pf, alarm)
+
+
+def record_to_dict(record):
+    """Scales a raw PZEMRecord to the engineering units used by the API."""
+    return {
+        "voltage": round(record.voltage * 0.1, 1),
+        "current": round(record.current * 0.001, 3),
+        "power": round(record.power * 0.1, 1),
+        "energy": record.energy, # Wh
+        "frequency": round(record.frequency * 0.1, 1),
+        "pf": round(record.pf * 0.01, 2),
+        "alarm": record.alarm,
+    }
+
+
+class ModbusError(IOError):
+    """A missing, malformed or exception response from a sensor."""
+
+
+def frame_gap(baudrate):
+    """
+    Minimum silent interval between Modbus RTU frames (3.5 characters of
+    11 bits). The spec fixes it at 1.75 ms above 19200 baud.
+    """
+    if baudrate > 19200:
+        return 0.00175
+    return 3.5 * 11 / baudrate
+
+
+class AddressHealth:
+    """Per-address poll statistics and retry state."""
+
+    # Weight of the newest sample in the moving average round-trip time
+    RTT_ALPHA = 0.2
+
+    def __init__(self):
+        self.reads = 0
+        self.errors = 0
+        self.skipped = 0
+        self.consecutive_failures = 0
+        self.next_attempt = 0.0
+        self.last_rtt = None
+        self.avg_rtt = None
+        self.last_error = None
+
+    def record_success(self, rtt):
+        self.reads += 1
+        self.consecutive_failures = 0
+        self.next_attempt = 0.0
+        self.last_rtt = rtt
+        if self.avg_rtt is None:
+            self.avg_rtt = rtt
+        else:
+            self.avg_rtt += self.RTT_ALPHA * (rtt - self.avg_rtt)
+
+    def record_failure(self, error, now, quarantine_after, retry_base, retry_max):
+        """Returns the retry delay if the address is (still) quarantined."""
+        self.errors += 1
+        self.consecutive_failures += 1
+        self.last_error = str(error)
+        excess = self.consecutive_failures - quarantine_after
+        if excess < 0:
+            return None
+        # Exponential back-off: base, 2*base, 4*base ... up to retry_max
+        delay = min(retry_base * (2 ** excess), retry_max)
+        self.next_attempt = now + delay
+        return delay
+
+    def to_dict(self, now):
+        return {
+            "reads": self.reads,
+            "errors": self.errors,
+            "skipped": self.skipped,
+            "consecutive_failures": self.consecutive_failures,
+            "quarantined": self.next_attempt > now,
+            "retry_in": round(max(0.0, self.next_attempt - now), 1),
+            "last_rtt_ms": None if self.last_rtt is None else round(self.last_rtt * 1000, 1),
+            "avg_rtt_ms": None if self.avg_rtt is None else round(self.avg_rtt * 1000, 1),
+            "last_error": self.last_error,
+        }
+
+
 class PZEMHandler:
     def __init__(self, port, addresses):
         self.port = port
         self.addresses = addresses
-        self.instrument = None
+        self.serial = None
         self.simulation_mode = False
+        self.debug = getattr(config, 'DEBUG_MODE', False)
+
+        self.baudrate = getattr(config, 'BAUDRATE', 9600)
+        self.timeout = getattr(config, 'TIMEOUT', 0.5)
+        self.frame_gap = frame_gap(self.baudrate)
+        # Unresponsive addresses are skipped after QUARANTINE_AFTER
+        # consecutive failures and retried with exponential back-off.
+        self.quarantine_after = getattr(config, 'MODBUS_QUARANTINE_AFTER', 3)
+        self.retry_base = getattr(config, 'MODBUS_RETRY_BASE', 2.0)
+        self.retry_max = getattr(config, 'MODBUS_RETRY_MAX', 60.0)
+        self.health = {address: AddressHealth() for address in addresses}
+        self.last_cycle_time = None
+        self._bus_idle_at = 0.0
+        # Serialises bus access between the poller and API calls (reset)
+        self._bus_lock = threading.Lock()
+        # Request frames never change, so build them once per address
+        self._read_frames = {address: read_request(address) for address in addresses}
 
         try:
-            # Setup minimalmodbus instrument
-            # We use a dummy address initially, will be changed per request
-            self.instrument = minimalmodbus.Instrument(self.port, 1)
-            self.instrument.serial.baudrate = 9600
-            self.instrument.serial.bytesize = 8
-            self.instrument.serial.parity = serial.PARITY_NONE
-            self.instrument.serial.stopbits = 1
-            self.instrument.serial.timeout = 0.5
-            self.instrument.mode = minimalmodbus.MODE_RTU
-            self.instrument.clear_buffers_before_each_transaction = True
-            
-            # Enable debug mode if configured
-            if hasattr(config, 'DEBUG_MODE') and config.DEBUG_MODE:
-                self.instrument.debug = True
-                print(f"MinimalModbus debug mode enabled for port {self.port}")
+            self.serial = serial.Serial(
+                port=self.port,
+                baudrate=self.baudrate,
+                bytesize=getattr(config, 'BYTESIZE', 8),
+                parity=getattr(config, 'PARITY', serial.PARITY_NONE),
+                stopbits=getattr(config, 'STOPBITS', 1),
+                timeout=self.timeout,
+            )
+            if self.debug:
+                print(f"Modbus frame debugging enabled for port {self.port}")
         except Exception as e:
             print(f"Error opening serial port {self.port}: {e}")
             print("Switching to SIMULATION MODE")
@@ -36,85 +203,104 @@ class PZEMHandler:
         """
         Reads data from all configured sensors.
         Returns a dictionary keyed by address.
+        Quarantined addresses are skipped (None) without touching the bus.
         """
         data = {}
+        cycle_start = time.monotonic()
         for address in self.addresses:
-            if self.simulation_mode:
-                data[address] = self._simulate_data(address)
-            else:
-                try:
-                    self.instrument.address = address
-                    # Read Input Registers (Function Code 0x04)
-                    # Register 0x0000: Voltage (0.1V)
-                    # Register 0x0001: Current Low (0.001A)
-                    # Register 0x0002: Current High 
-                    # ... and so on.
-                    # minimalmodbus read_registers reads N registers starting from addr
-                    
-                    # Reading 10 registers starting from 0x0000
-                    # 0: Voltage
-                    # 1-2: Current (32bit)
-                    # 3-4: Power (32bit)
-                    # 5-6: Energy (32bit)
-                    # 7: Frequency
-                    # 8: Power Factor
-                    # 9: Alarm Status
-                    
-                    # Note: read_registers returns list of integers
-                    # We can also use read_float/long but bulk read is more efficient
-                    
-                    # Using read_registers to get raw values then parse
-                    
-                    # Read 10 registers starting from 0x0000
-                    # 0: Voltage (0.1V)
-                    # 1: Current Low (0.001A)
-                    # 2: Current High
-                    # 3: Power Low (0.1W)
-                    # 4: Power High
-                    # 5: Energy Low (1Wh)
-                    # 6: Energy High
-                    # 7: Frequency (0.1Hz)
-                    # 8: PF (0.01)
-                    # 9: Alarm
-                    
-                    values = self.instrument.read_registers(0x0000, 10, functioncode=4)
-                    
-                    # Parse values (Little Endian Word Order for 32-bit values per manual)
-                    voltage = values[0] * 0.1
-                    
-                    # Current: High<<16 | Low
-                    current_low = values[1]
-                    current_high = values[2]
-                    current = ((current_high << 16) | current_low) * 0.001
-                    
-                    # Power: High<<16 | Low
-                    power_low = values[3]
-                    power_high = values[4]
-                    power = ((power_high << 16) | power_low) * 0.1
-                    
-                    # Energy: High<<16 | Low
-                    energy_low = values[5]
-                    energy_high = values[6]
-                    energy = ((energy_high << 16) | energy_low)
-                    
-                    frequency = values[7] * 0.1
-                    pf = values[8] * 0.01
-                    
-                    data[address] = {
-                        "voltage": round(voltage, 1),
-                        "current": round(current, 3),
-                        "power": round(power, 1),
-                        "energy": energy, # Wh
-                        "frequency": round(frequency, 1),
-                        "pf": round(pf, 2)
-                    }
-                    
-                except Exception as e:
+            health = self.health[address]
+            now = time.monotonic()
+            if now < health.next_attempt:
+                health.skipped += 1
+                data[address] = None
+                continue
+
+            started = time.monotonic()
+            try:
+                if self.simulation_mode:
+                    data[address] = self._simulate_data(address)
+                else:
+                    data[address] = self._read_address(address)
+            except Exception as e:
+                data[address] = None
+                delay = health.record_failure(e, time.monotonic(), self.quarantine_after,
+                                              self.retry_base, self.retry_max)
+                if health.consecutive_failures == 1:
                     print(f"Error reading sensor {address}: {e}")
-                    # Return None or error state?
-                    data[address] = None
+                elif delay is not None:
+                    print(f"Sensor {address} not responding ({health.consecutive_failures} failures), "
+                          f"retrying in {delay:.0f}s")
+                continue
+            health.record_success(time.monotonic() - started)
+
+        self.last_cycle_time = time.monotonic() - cycle_start
         return data
 
+    def _wait_frame_gap(self):
+        # Keep the RTU inter-frame gap before addressing the next device
+        wait = self._bus_idle_at + self.frame_gap - time.monotonic()
+        if wait > 0:
+            time.sleep(wait)
+
+    def _read_address(self, address):
+        with self._bus_lock:
+            response = self._transact(address, self._read_frames[address], FUNC_READ_INPUT,
+                                      READ_RESPONSE_LEN)
+        if response[2] != 2 * REGISTER_COUNT:
+            raise ModbusError(f"Unexpected byte count {response[2]}")
+        return record_to_dict(decode_registers(response[3:-2]))
+
+    def _transact(self, address, request, function, response_len):
+        """
+        Sends one request frame and returns the validated response frame.
+        Reads the 3-byte header first so an exception response is
+        recognised without waiting for the timeout.
+        """
+        self._wait_frame_gap()
+        try:
+            if self.debug:
+                print(f"[{self.port}] TX {request.hex(' ')}")
+            self.serial.write(request)
+            response = self.serial.read(3)
+            if len(response) < 3:
+                raise ModbusError("No answer from sensor" if not response else "Incomplete response")
+            if response[1] == function | 0x80:
+                response += self.serial.read(EXCEPTION_RESPONSE_LEN - 3)
+            else:
+                response += self.serial.read(response_len - 3)
+            if self.debug:
+                print(f"[{self.port}] RX {response.hex(' ')}")
+
+            if len(response) < 4 or crc16(response[:-2]) != struct.unpack('<H', response[-2:])[0]:
+                raise ModbusError("CRC error in response")
+            if response[0] != address:
+                raise ModbusError(f"Response from address {response[0]}, expected {address}")
+            if response[1] == function | 0x80:
+                raise ModbusError(f"Sensor returned exception code {response[2]}")
+            if response[1] != function or len(response) != response_len:
+                raise ModbusError("Malformed response")
+            return response
+        except Exception:
+            # Drop any partial/late response so it can't corrupt the next read
+            try:
+                self.serial.reset_input_buffer()
+            except Exception:
+                pass
+            raise
+        finally:
+            self._bus_idle_at = time.monotonic()
+
+    def stats(self):
+        """Per-address poll statistics and timing of the last cycle."""
+        now = time.monotonic()
+        return {
+            "port": self.port,
+            "simulation": self.simulation_mode,
+            "frame_gap_ms": round(self.frame_gap * 1000, 2),
+            "last_cycle_ms": None if self.last_cycle_time is None else round(self.last_cycle_time * 1000, 1),
+            "addresses": {address: h.to_dict(now) for address, h in self.health.items()},
+        }
+
     def reset_energy(self, address):
         """
         Resets energy counter for a specific address.
@@ -125,28 +311,17 @@ class PZEMHandler:
             return True
             
         try:
-            self.instrument.address = address
-            # minimalmodbus doesn't have a generic "send raw" easily for specific non-std codes
-            # But the PZEM reset command is: Address, 0x42, CRC-Low, CRC-High
-            # minimalmodbus `_perform_command` might be needed OR `write_register` if mapped
-            # Actually PZEM reset is just a 4-byte frame: Addr, 0x42, CRC
-            
-            # Implementing raw serial write for reset
-            payload = bytearray([address, 0x42])
-            # Calculate CRC
-            crc = self._calculate_crc(payload)
-            payload.extend(crc)
-            
-            self.instrument.serial.write(payload)
-            time.sleep(0.5)
-            # Response is same as sent (4 bytes)
-            # We MUST read it to clear the buffer for the next transaction
-            _ = self.instrument.serial.read(4) 
+            with self._bus_lock:
+                self._send_reset(address)
             return True
         except Exception as e:
             print(f"Error resetting energy for {address}: {e}")
             return False
 
+    def _send_reset(self, address):
+        # The PZEM acknowledges a reset by echoing the 4-byte request
+        self._transact(address, reset_request(address), FUNC_RESET_ENERGY, 4)
+
     def _simulate_data(self, address):
         """Generates random data for testing."""
         # Make values slightly different based on address to distinguish phases
@@ -159,18 +334,6 @@ class PZEMHandler:
             "power": round((base_v * base_i) + random.uniform(-10, 10), 1),
             "energy": int(time.time() // 60), # Just some increasing number
             "frequency": round(50 + random.uniform(-0.1, 0.1), 1),
-            "pf": round(0.95 + random.uniform(-0.05, 0.0), 2)
+            "pf": round(0.95 + random.uniform(-0.05, 0.0), 2),
+            "alarm": 0
         }
-
-    def _calculate_crc(self, data):
-        """Calculates CRC16 for Modbus."""
-        crc = 0xFFFF
-        for pos in data:
-            crc ^= pos
-            for i in range(8):
-                if (crc & 1) != 0:
-                    crc >>= 1
-                    crc ^= 0xA001
-                else:
-                    crc >>= 1
-        return bytearray([crc & 0xFF, (crc >> 8) & 0xFF])
@@ -0,0 +1,56 @@
+import array
+import threading
+
+NAN = float('nan')
+
+
+class SampleRing:
+    """
+    Fixed-size, columnar buffer of the most recent samples.
+
+    Every column is one preallocated array of doubles, written in a circle,
+    so memory use is fixed at capacity * columns * 8 bytes and appending a
+    sample allocates nothing. NULL values are stored as NaN. Columns named
+    in `integer` (ids, counters, flags) come back as ints.
+    """
+
+    def __init__(self, columns, capacity, integer=()):
+        self.columns = tuple(columns)
+        self.capacity = capacity
+        self.integer = frozenset(integer)
+        self._arrays = [array.array('d', [NAN]) * capacity for _ in self.columns]
+        self._next = 0
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return self._count
+
+    @property
+    def full(self):
+        return self._count == self.capacity
+
+    def append(self, row):
+        """Adds one sample (a tuple in `columns` order)."""
+        with self._lock:
+            i = self._next
+            for arr, value in zip(self._arrays, row):
+                arr[i] = NAN if value is None else value
+            self._next = (i + 1) % self.capacity
+            self._count = min(self._count + 1, self.capacity)
+
+    def latest(self, n):
+        """
+        Returns the newest `n` samples, oldest first, as {column: list}.
+        NaN comes back as None, values of integer columns as int.
+        """
+        with self._lock:
+            n = min(n, self._count)
+            start = (self._next - n) % self.capacity
+            if start + n <= self.capacity:
+                parts = [arr[start:start + n] for arr in self._arrays]
+            else:
+                parts = [arr[start:] + arr[:self._next] for arr in self._arrays]
+        # NaN is the only value not equal to itself
+        return {col: [None if v != v else int(v) if col in self.integer else v for v in values]
+                for col, values in zip(self.columns, parts)}
@@ -0,0 +1,155 @@
+"""
+Minute/hour/day rollups of the stored samples.
+
+Each rollup table holds one row per time bucket with min/max/avg of every
+phase metric and the min/max of the cumulative energy counters (their
+difference is the energy used in the bucket). Minutes are built from raw
+logs, hours from minutes and days from hours, so refreshing a range only
+ever reads a few hundred rows. Buckets are aligned to UTC.
+
+Rollups cover sensors 1-3. Raw values are read from the packed samples
+with the sample_* SQL functions (storage.register). Samples sealed
+into archive blocks are passed in by the caller when a refresh reaches
+back that far (backfill, deleting an event).
+"""
+import storage
+
+# (table, bucket size in seconds), finest first
+ROLLUP_TABLES = (
+    ('logs_1m', 60),
+    ('logs_1h', 3600),
+    ('logs_1d', 86400),
+)
+
+# Instantaneous values: min/max/avg per bucket
+METRICS = (
+    'p1_v', 'p1_i', 'p1_p',
+    'p2_v', 'p2_i', 'p2_p',
+    'p3_v', 'p3_i', 'p3_p',
+    'neutral_i',
+)
+
+# Cumulative counters: min/max per bucket
+COUNTERS = ('p1_e', 'p2_e', 'p3_e')
+
+
+def _columns():
+    cols = ['samples']
+    for m in METRICS:
+        cols += [f'{m}_min', f'{m}_max', f'{m}_avg']
+    for m in COUNTERS:
+        cols += [f'{m}_min', f'{m}_max']
+    return cols
+
+COLUMNS = _columns()
+
+
+def _raw_aggregates():
+    exprs = ['COUNT(*)']
+    for m in METRICS:
+        v = storage.sql_value(m)
+        exprs += [f'MIN({v})', f'MAX({v})', f'AVG({v})']
+    for m in COUNTERS:
+        v = storage.sql_value(m)
+        exprs += [f'MIN({v})', f'MAX({v})']
+    return exprs
+
+
+def _child_aggregates():
+    exprs = ['SUM(samples)']
+    for m in METRICS:
+        # Sample-weighted average, ignoring buckets where the metric was NULL
+        exprs += [f'MIN({m}_min)', f'MAX({m}_max)',
+                  f'SUM({m}_avg * samples) / SUM(CASE WHEN {m}_avg IS NOT NULL THEN samples END)']
+    for m in COUNTERS:
+        exprs += [f'MIN({m}_min)', f'MAX({m}_max)']
+    return exprs
+
+
+def create_tables(c):
+    """Creates the rollup tables if missing."""
+    cols = ",\n            ".join(
+        f"{col} INTEGER" if col == 'samples' else f"{col} REAL" for col in COLUMNS
+    )
+    for table, _ in ROLLUP_TABLES:
+        c.execute(f'''
+        CREATE TABLE IF NOT EXISTS {table} (
+            bucket REAL PRIMARY KEY,
+            {cols}
+        )
+        ''')
+
+
+def refresh(conn, start, end=None, not_before=0, archived=None):
+    """
+    Recomputes all rollup buckets overlapping [start, end] from the data
+    below them. end=None means up to the newest sample. Runs on the
+    caller's transaction.
+    not_before: day-aligned time before which raw samples are incomplete
+    (pruned by retention); older buckets are left untouched.
+    archived: (timestamp, data) of the samples in the range that were
+    sealed into blocks (archive.py), aggregated along with the samples
+    table.
+    """
+    start = max(start, not_before)
+    if end is not None and end < start:
+        return
+    source = 'samples'
+    if archived is not None:
+        conn.execute("CREATE TEMP TABLE IF NOT EXISTS archived_samples (timestamp REAL, data BLOB)")
+        conn.execute("DELETE FROM archived_samples")
+        conn.executemany("INSERT INTO archived_samples (timestamp, data) VALUES (?, ?)", archived)
+        source = '(SELECT timestamp, data FROM samples UNION ALL SELECT timestamp, data FROM archived_samples)'
+    source_ts = 'timestamp'
+    aggregates = _raw_aggregates()
+    for table, size in ROLLUP_TABLES:
+        lo = (start // size) * size
+        hi = float('inf') if end is None else (end // size) * size + size
+        conn.execute(f"DELETE FROM {table} WHERE bucket >= ? AND bucket < ?", (lo, hi))
+        conn.execute(f'''
+        INSERT INTO {table} (bucket, {", ".join(COLUMNS)})
+        SELECT CAST({source_ts} / {size} AS INTEGER) * {size} AS b, {", ".join(aggregates)}
+        FROM {source}
+        WHERE {source_ts} >= ? AND {source_ts} < ?
+        GROUP BY b
+        ''', (lo, hi))
+        source = table
+        source_ts = 'bucket'
+        aggregates = _child_aggregates()
+    if archived is not None:
+        conn.execute("DELETE FROM archived_samples")
+
+
+def pick_table(start, end, points):
+    """
+    Returns (table, bucket size) of the coarsest rollup that still gives
+    at least `points` buckets for the range, or (None, None) if the range
+    is short enough to be served from raw logs.
+    """
+    span = end - start
+    for table, size in reversed(ROLLUP_TABLES):
+        if span / size >= points:
+            return table, size
+    return None, None
+
+
+def query(conn, table, start, end):
+    """
+    Returns rollup rows in [start, end] shaped like log dicts: each metric
+    holds the bucket average (with _min/_max alongside) and each energy
+    counter the value at the end of the bucket.
+    """
+    c = conn.cursor()
+    c.execute(f"SELECT * FROM {table} WHERE bucket >= ? AND bucket <= ? ORDER BY bucket ASC",
+              (start, end))
+    columns = [d[0] for d in c.description]
+    rows = []
+    for values in c:
+        row = dict(zip(columns, values))
+        row['timestamp'] = row.pop('bucket')
+        for m in METRICS:
+            row[m] = row[f'{m}_avg']
+        for m in COUNTERS:
+            row[m] = row[f'{m}_max']
+        rows.append(row)
+    return rows
@@ -1,2 +1,3 @@
 #!/bin/bash
-python3 app.py
+# Production server; add --dev for the Flask debugger and auto-reload
+python3 app.py "$@"
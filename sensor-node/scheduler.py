@@ -0,0 +1,81 @@
+import threading
+import time
+
+
+class TickScheduler:
+    """
+    Fixed-rate sampling clock.
+
+    Ticks fall on absolute deadlines aligned to multiples of `interval` on
+    the wall clock (e.g. every whole second), so the time spent reading
+    sensors doesn't accumulate as drift. A tick that starts more than
+    `late_tolerance` after its deadline counts as late; deadlines that
+    passed entirely while the previous cycle was still running are skipped
+    and counted as missed.
+    """
+
+    # A jump of the wall clock by more than this many intervals (e.g. NTP
+    # setting the time after boot) re-anchors the schedule instead of
+    # being counted as missed ticks.
+    RESYNC_INTERVALS = 60
+
+    def __init__(self, interval, late_tolerance=None):
+        self.interval = interval
+        self.late_tolerance = interval * 0.1 if late_tolerance is None else late_tolerance
+        self.ticks = 0
+        self.late = 0
+        self.missed = 0
+        self.resyncs = 0
+        self.max_lateness = 0.0
+        self._next = None
+        self._stop = threading.Event()
+
+    def stop(self):
+        self._stop.set()
+
+    def wait(self):
+        """
+        Blocks until the next tick and returns its scheduled timestamp,
+        or None once stop() was called.
+        """
+        now = time.time()
+        if self._next is None:
+            self._next = self._align(now)
+        elif now < self._next - self.RESYNC_INTERVALS * self.interval or \
+                now > self._next + self.RESYNC_INTERVALS * self.interval:
+            self.resyncs += 1
+            self._next = self._align(now)
+        elif now >= self._next + self.interval:
+            skipped = int((now - self._next) // self.interval)
+            self.missed += skipped
+            self._next += skipped * self.interval
+
+        delay = self._next - time.time()
+        if delay > 0:
+            if self._stop.wait(delay):
+                return None
+        else:
+            lateness = -delay
+            self.max_lateness = max(self.max_lateness, lateness)
+            if lateness > self.late_tolerance:
+                self.late += 1
+        if self._stop.is_set():
+            return None
+
+        tick = self._next
+        self._next += self.interval
+        self.ticks += 1
+        return tick
+
+    def _align(self, now):
+        return (now // self.interval + 1) * self.interval
+
+    def stats(self):
+        return {
+            "interval": self.interval,
+            "ticks": self.ticks,
+            "late": self.late,
+            "missed": self.missed,
+            "resyncs": self.resyncs,
+            "max_lateness_ms": round(self.max_lateness * 1000, 1),
+        }
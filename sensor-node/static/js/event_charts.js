@@ -7,6 +7,7 @@ document.addEventListener("DOMContentLoaded", async () => {
     const startEl = document.getElementById('event-start');
     const durationEl = document.getElementById('event-duration');
     const pointsEl = document.getElementById('event-points');
+    const energyEl = document.getElementById('event-energy');
     const statusEl = document.getElementById('event-status-indicator');
     
     const btnRecordStart = document.getElementById('btn-start-recording');
@@ -17,24 +18,16 @@ document.addEventListener("DOMContentLoaded", async () => {
     let pollInterval = null;
     let charts = {};
 
-    // --- Initial Load ---
-    try {
-        await fetchEventDetails();
-        initCharts();
-        checkRecordingStatus();
-        
-        // Start polling for updates (charts + status)
-        pollInterval = setInterval(async () => {
-            await updateCharts();
-            checkRecordingStatus();
-        }, 1000);
-        
-    } catch (e) {
-        console.error("Error init event view", e);
-    }
+    // All logs received so far. After the initial load we only ask the
+    // server for rows newer than `cursor` and append them here.
+    let currentLogs = [];
+    let cursor = null;
+
+    // Full loads are downsampled by the server to about this many rows
+    const CHART_POINTS = 1500;
 
     async function fetchEventDetails() {
-        const res = await fetch(`/api/events/${EVENT_ID}`);
+        const res = await fetch(`/api/events/${EVENT_ID}?points=${CHART_POINTS}`);
         const data = await res.json();
         
         if (!data.details) return;
@@ -43,7 +36,10 @@ document.addEventListener("DOMContentLoaded", async () => {
         nameEl.textContent = d.name;
         nameHeaderEl.textContent = d.name;
         startEl.textContent = new Date(d.start_time * 1000).toLocaleString();
-        pointsEl.textContent = data.logs.length;
+        currentLogs = data.logs;
+        cursor = data.cursor;
+        pointsEl.textContent = currentLogs.length;
+        showEnergy(d.energy_wh);
         
         // Duration
         if (d.end_time) {
@@ -55,7 +51,7 @@ document.addEventListener("DOMContentLoaded", async () => {
         btnDownload.href = `/api/events/${EVENT_ID}/export`;
         
         // Initial Chart Data
-        renderCharts(data.logs);
+        renderCharts(currentLogs);
     }
     
     // --- Chart Controls ---
@@ -66,26 +62,42 @@ document.addEventListener("DOMContentLoaded", async () => {
     const btnUpdate = document.getElementById('btn-update-charts');
 
     btnUpdate.addEventListener('click', () => {
-        // Re-render with current full data but applied scale options
-        // We need 'currentLogs' stored globally or refetch? 
-        // Best to just trigger updateCharts which fetches latest
-        updateCharts();
+        // Re-render the logs we already have with the new scale options
+        renderCharts(currentLogs);
     });
 
-    // --- Chart Logic ---
+    function showEnergy(energyWh) {
+        // Wh per sensor, summed over all phases
+        const wh = Object.values(energyWh || {}).reduce((a, b) => a + b, 0);
+        energyEl.textContent = (wh / 1000).toFixed(3) + " kWh";
+    }
 
-    // Store latest logs to apply local filtering without refetch if needed, 
-    // but refetch is safer for live data.
-    let currentLogs = [];
+    // --- Chart Logic ---
 
     async function updateCharts() {
-        const res = await fetch(`/api/events/${EVENT_ID}`);
+        // Once enough raw rows have been appended, reload the downsampled
+        // history so the chart size stays bounded on long recordings.
+        if (currentLogs.length > 2 * CHART_POINTS) {
+            cursor = null;
+        }
+        const url = cursor === null
+            ? `/api/events/${EVENT_ID}?points=${CHART_POINTS}`
+            : `/api/events/${EVENT_ID}?since=${cursor}`;
+        const res = await fetch(url);
         const data = await res.json();
-        if (data.logs) {
+        if (!data.logs) return;
+
+        if (cursor === null) {
             currentLogs = data.logs;
-            pointsEl.textContent = data.logs.length;
-            renderCharts(data.logs);
+            showEnergy(data.details.energy_wh);
+        } else if (data.logs.length > 0) {
+            currentLogs.push(...data.logs);
+        } else {
+            return; // Nothing new
         }
+        cursor = data.cursor;
+        pointsEl.textContent = currentLogs.length;
+        renderCharts(currentLogs);
     }
 
     function renderCharts(logs) {
@@ -164,4 +176,50 @@ document.addEventListener("DOMContentLoaded", async () => {
         
         chart.update('none');
     }
+
+    // --- Recording Controls ---
+
+    async function checkRecordingStatus() {
+        try {
+            const res = await fetch('/api/recording/status');
+            const status = await res.json();
+            isRecording = status.recording && String(status.event_id) === String(EVENT_ID);
+            btnRecordStart.classList.toggle('hidden', isRecording);
+            btnRecordStop.classList.toggle('hidden', !isRecording);
+            statusEl.textContent = isRecording ? "Recording" : "Idle";
+        } catch (e) {
+            console.error("Error checking recording status", e);
+        }
+    }
+
+    btnRecordStart.addEventListener('click', async () => {
+        await fetch('/api/recording/start', {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({ event_id: EVENT_ID })
+        });
+        checkRecordingStatus();
+    });
+
+    btnRecordStop.addEventListener('click', async () => {
+        await fetch('/api/recording/stop', { method: 'POST' });
+        checkRecordingStatus();
+    });
+
+    // --- Initial Load ---
+    // Runs last so the chart controls above are initialised before the
+    // first render. Charts are created lazily by renderCharts.
+    try {
+        await fetchEventDetails();
+        checkRecordingStatus();
+        
+        // Start polling for updates (charts + status)
+        pollInterval = setInterval(async () => {
+            await updateCharts();
+            checkRecordingStatus();
+        }, 1000);
+        
+    } catch (e) {
+        console.error("Error init event view", e);
+    }
 });
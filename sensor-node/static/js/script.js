@@ -6,33 +6,54 @@ document.addEventListener("DOMContentLoaded", () => {
   // Chart Instances
   let charts = {};
   
-  // Polling interval
-  let pollInterval = setInterval(fetchData, 1000);
-
   // --- Initialization ---
   initCharts();
   loadHistory();
   fetchInitialHistory(); // Load past data for charts
+  connectStream();
+
+  // --- Live Data ---
+  // The node pushes every sample over Server-Sent Events. EventSource
+  // reconnects on its own after network errors. Browsers without it, and
+  // streams the node turns away (503 when too many are open), fall back to
+  // polling /api/data.
+  function connectStream() {
+    if (!window.EventSource) {
+      setInterval(fetchData, 1000);
+      return;
+    }
+    const source = new EventSource("/api/stream");
+    source.onmessage = (event) => handleData(JSON.parse(event.data));
+    source.onerror = () => {
+      setConnected(false);
+      if (source.readyState === EventSource.CLOSED) {
+        setInterval(fetchData, 1000);
+      }
+    };
+  }
 
-  // --- Data Polling ---
   async function fetchData() {
     try {
       const response = await fetch("/api/data");
-      const data = await response.json();
-
-      updateDashboard(data);
-      updateLiveCharts(data);
-      
-      statusEl.textContent = "Connected";
-      statusEl.style.color = "green";
-
+      handleData(await response.json());
     } catch (error) {
       console.error("Error fetching data:", error);
-      statusEl.textContent = "Disconnected";
-      statusEl.style.color = "red";
+      setConnected(false);
     }
   }
 
+  function handleData(data) {
+    if (!data.sensors) return; // No sample yet
+    updateDashboard(data);
+    updateLiveCharts(data);
+    setConnected(true);
+  }
+
+  function setConnected(connected) {
+    statusEl.textContent = connected ? "Connected" : "Disconnected";
+    statusEl.style.color = connected ? "green" : "red";
+  }
+
   function updateDashboard(data) {
     // Update per-sensor cards
     for (const [address, values] of Object.entries(data.sensors)) {
@@ -67,10 +88,14 @@ document.addEventListener("DOMContentLoaded", () => {
   // --- Live Charts ---
   async function fetchInitialHistory() {
       try {
-          const res = await fetch('/api/history?limit=100'); // Load last 100 points
-          const logs = await res.json();
+          // Last 100 points, as one array per column
+          const res = await fetch('/api/history?limit=100&format=columns');
+          const cols = await res.json();
           // Populate charts
-          logs.forEach(log => {
+          cols.timestamp.forEach((_, idx) => {
+             const log = {};
+             for (const key in cols) log[key] = cols[key][idx];
+
              // Convert log structure to chart format if needed, but updateLiveCharts expects 'data' object structure from /api/data
              // The logs from DB have p1_v etc.
              // We need to map DB log format to the format updateLiveCharts expects, OR make updateLiveCharts handle DB format?
@@ -0,0 +1,122 @@
+"""
+Packed on-disk format of a sample.
+
+Each sample is stored as one BLOB holding the readings of every sensor as
+fixed-point integers in the PZEM's own register units, so nothing is lost
+to float rounding and a three-sensor sample takes 61 bytes instead of a
+row of REAL columns. Any number of sensors fit; a sensor that didn't
+answer is left out.
+
+Layout, little-endian:
+    uint32  neutral current (mA)
+    per sensor, 19 bytes:
+    uint8   address
+    uint16  voltage (0.1 V)
+    uint32  current (mA)
+    uint32  power (0.1 W)
+    uint32  energy (Wh)
+    uint16  frequency (0.1 Hz)
+    uint8   power factor (0.01)
+    uint8   alarm (1 if the register reads 0xFFFF, else 0)
+A value that is unknown (e.g. in migrated rows) is stored as its field's
+all-ones value.
+"""
+import functools
+import struct
+
+# Per-sensor fields in record order. Log columns are named p<address>_<field>.
+FIELDS = ('v', 'i', 'p', 'e', 'f', 'pf', 'alarm')
+# Matching keys of the reading dicts from PZEMHandler.read_all
+READING_KEYS = ('voltage', 'current', 'power', 'energy', 'frequency', 'pf', 'alarm')
+# Register units per engineering unit
+DIVISORS = (10, 1000, 10, 1, 10, 100, 1)
+
+HEADER = struct.Struct('<I')
+RECORD = struct.Struct('<BHIIIHBB')
+NEUTRAL_DIVISOR = 1000
+
+# Raw value stored for an unknown reading, per field
+MISSING = (0xFFFF, 0xFFFFFFFF, 0xFFFFFFFF, 0xFFFFFFFF, 0xFFFF, 0xFF, 0xFF)
+NEUTRAL_MISSING = 0xFFFFFFFF
+_ENERGY = FIELDS.index('e')
+_ALARM = FIELDS.index('alarm')
+ALARM_ON = 0xFFFF
+
+NO_READING = (None,) * len(FIELDS)
+
+
+def _raw(value, divisor, missing):
+    if value is None:
+        return missing
+    raw = round(value * divisor)
+    return raw if 0 <= raw < missing else missing
+
+
+def pack(neutral_i, readings):
+    """
+    Packs one sample. readings: iterable of (address, values) with values
+    in FIELDS order and engineering units; None means no reading.
+    """
+    parts = [HEADER.pack(_raw(neutral_i, NEUTRAL_DIVISOR, NEUTRAL_MISSING))]
+    for address, values in readings:
+        raw = [_raw(v, d, m) for v, d, m in zip(values, DIVISORS, MISSING)]
+        if values[_ALARM] is not None:
+            raw[_ALARM] = 1 if values[_ALARM] else 0
+        parts.append(RECORD.pack(address, *raw))
+    return b''.join(parts)
+
+
+@functools.lru_cache(maxsize=256)
+def unpack(data):
+    """
+    Returns (neutral_i, {address: values}) with values in FIELDS order.
+    Cached, as SQL aggregates ask for one value at a time.
+    """
+    (neutral,) = HEADER.unpack_from(data)
+    sensors = {}
+    for address, *raw in RECORD.iter_unpack(memoryview(data)[HEADER.size:]):
+        values = [None if r == m else r / d for r, d, m in zip(raw, DIVISORS, MISSING)]
+        # Energy and alarm stay ints, as in the live readings
+        if values[_ENERGY] is not None:
+            values[_ENERGY] = raw[_ENERGY]
+        if values[_ALARM] is not None:
+            values[_ALARM] = ALARM_ON if raw[_ALARM] else 0
+        sensors[address] = tuple(values)
+    return (None if neutral == NEUTRAL_MISSING else neutral / NEUTRAL_DIVISOR), sensors
+
+
+def records(data):
+    """(neutral, [(address, *fields)]) of a packed sample, as raw register values."""
+    (neutral,) = HEADER.unpack_from(data)
+    return neutral, list(RECORD.iter_unpack(memoryview(data)[HEADER.size:]))
+
+
+def pack_records(neutral, records):
+    """Inverse of records()."""
+    return HEADER.pack(neutral) + b''.join(RECORD.pack(*record) for record in records)
+
+
+def sample_value(data, address, field):
+    """SQL function sample_value(data, address, field index)."""
+    values = unpack(data)[1].get(address)
+    return None if values is None else values[field]
+
+
+def sample_neutral(data):
+    """SQL function sample_neutral(data)."""
+    return unpack(data)[0]
+
+
+def register(conn):
+    """Makes the sample_* SQL functions available on a connection."""
+    conn.create_function('sample_value', 3, sample_value, deterministic=True)
+    conn.create_function('sample_neutral', 1, sample_neutral, deterministic=True)
+    return conn
+
+
+def sql_value(column):
+    """SQL expression reading a log column (e.g. 'p2_v') from samples.data."""
+    if column == 'neutral_i':
+        return 'sample_neutral(data)'
+    sensor, field = column[1:].split('_', 1)
+    return f'sample_value(data, {int(sensor)}, {FIELDS.index(field)})'